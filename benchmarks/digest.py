@@ -0,0 +1,91 @@
+"""
+Compares how many SMS segments we would send for a burst of notifications if
+we forwarded every notification on its own, against what the Coalescer sends.
+
+Run it from the top level of the repo with `python -m benchmarks.digest`
+"""
+import argparse
+import random
+import time
+
+from sms_gateway.digest import Coalescer, render_notification
+from sms_gateway.sms import segment_count
+
+WORDS = ('toot', 'elephant', 'federation', 'instance', 'timeline', 'boost',
+         'thread', 'cat', 'coffee', 'tea', 'weather', 'today', 'really')
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def burst(users: int, notifications: int, mention_ratio: float, seed: int):
+    """
+    A viral thread: most of the notifications are favourites and boosts,
+    with a few mentions and follows mixed in, spread over ten minutes
+    """
+    rng = random.Random(seed)
+    for i in range(notifications):
+        kind = rng.random()
+        if kind < mention_ratio:
+            kind = 'mention'
+        elif kind < 0.6:
+            kind = 'favourite'
+        elif kind < 0.9:
+            kind = 'reblog'
+        else:
+            kind = 'follow'
+        n = {'type': kind,
+             'account': {'acct': 'user{0}@instance{1}.social'.format(
+                 rng.randrange(10000), rng.randrange(50))}}
+        if kind == 'mention':
+            n['status'] = {'content': '<p>{0}</p>'.format(' '.join(
+                rng.choice(WORDS) for _ in range(rng.randrange(3, 30))))}
+        yield 600.0 * i / notifications, rng.randrange(users), n
+
+
+def run(users: int, notifications: int, interval: int, mention_ratio: float,
+        seed: int):
+    naive_messages = naive_segments = 0
+    for _, _, n in burst(users, notifications, mention_ratio, seed):
+        naive_messages += 1
+        naive_segments += segment_count(render_notification(n))
+
+    clock = Clock()
+    coalescer = Coalescer(default_interval=interval, clock=clock)
+    digests = []
+    start = time.perf_counter()
+    for at, user_id, n in burst(users, notifications, mention_ratio, seed):
+        clock.now = at
+        digests.extend(coalescer.add(user_id, n))
+        digests.extend(coalescer.due())
+    digests.extend(coalescer.flush())
+    elapsed = time.perf_counter() - start
+
+    coalesced_segments = sum(d.segments for d in digests)
+    print('notifications:       {0} for {1} users'.format(notifications, users))
+    print('digest interval:     {0}s'.format(interval))
+    print('naive:               {0} messages, {1} segments'.format(
+        naive_messages, naive_segments))
+    print('coalesced:           {0} messages, {1} segments'.format(
+        len(digests), coalesced_segments))
+    print('segment reduction:   {0:.1f}%'.format(
+        100.0 * (1 - coalesced_segments / max(naive_segments, 1))))
+    print('coalescer overhead:  {0:.2f}us per notification'.format(
+        1e6 * elapsed / notifications))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--notifications', type=int, default=50000)
+    parser.add_argument('--interval', type=int, default=300)
+    parser.add_argument('--mention-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.users, args.notifications, args.interval, args.mention_ratio,
+        args.seed)
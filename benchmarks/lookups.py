@@ -0,0 +1,165 @@
+"""
+Compares the hot lookups (user by uuid, user by phone, domain by id) going
+through records, the way every query used to, against the prepared
+statements they use now. Prints the time per lookup, how much memory a
+lookup churns through on the way, and how big the object it hands back is.
+
+Runs against a throwaway SQLite database by default; pass `--url` to run it
+against an empty PostgreSQL database instead.
+
+Run it from the top level of the repo with `python -m benchmarks.lookups`
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+from flask_login import UserMixin
+
+from sms_gateway.controllers.domain import DomainController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.migrations import migrate, unmigrate
+from sms_gateway.models.domain import Domain
+from sms_gateway.storage import get_backend
+
+DOMAINS = 50
+
+
+class RecordsUser(namedtuple('User', ['id', 'uuid', 'user', 'auth_token',
+                                      'domain_id']), UserMixin):
+    """
+    User as it was before it got __slots__
+    """
+    @staticmethod
+    def fromrecord(record):
+        return RecordsUser(id=record.id, uuid=record.uuid, user=record.user,
+                           auth_token=record.auth_token,
+                           domain_id=record.domain_id)
+
+
+def populate(backend, db, users: int):
+    migrate(db)
+    backend.bulk_load(db, 'domains', ['domain', 'client_id', 'client_secret'],
+                      [('instance{0}.social'.format(i), 'id', 'secret')
+                       for i in range(DOMAINS)])
+    backend.bulk_load(db, 'users', ['uuid', '"user"', 'auth_token', 'domain_id',
+                                    'phone'],
+                      [('uuid-{0}'.format(i), 'user{0}'.format(i), 'token',
+                        i % DOMAINS + 1, '+1555{0:07d}'.format(i))
+                       for i in range(users)])
+
+
+def records_lookups(db):
+    def user_by_uuid(uuid):
+        return RecordsUser.fromrecord(db.query('''
+        select id, uuid, "user", auth_token, domain_id
+        from users
+        where uuid = :uuid
+        ''', uuid=uuid).first())
+
+    def user_by_phone(phone):
+        return RecordsUser.fromrecord(db.query('''
+        select id, uuid, "user", auth_token, domain_id
+        from users
+        where phone = :phone
+        ''', phone=phone).first())
+
+    def domain_by_id(id):
+        return Domain.fromrecord(db.query('''
+        select id, domain, client_id, client_secret
+        from domains
+        where id = :id
+        ''', id=id).first())
+
+    return user_by_uuid, user_by_phone, domain_by_id
+
+
+def prepared_lookups(db):
+    user_controller = UserController(db)
+    domain_controller = DomainController(db)
+    return (user_controller.get_by_id, user_controller.get_by_phone,
+            domain_controller.get_by_id)
+
+
+def size(obj) -> int:
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__)
+                                 if hasattr(obj, '__dict__') else 0)
+
+
+def measure(fn, keys: list, samples: int) -> (float, float, float):
+    # warm up, so statement caches and the like are filled
+    for key in keys[:100]:
+        fn(key)
+
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    latency = (time.perf_counter() - start) / len(keys)
+
+    peak = 0
+    for key in keys[:samples]:
+        tracemalloc.start()
+        fn(key)
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return latency, peak / samples, size(fn(keys[0]))
+
+
+def run(url: str, users: int, lookups: int, samples: int, seed: int):
+    backend = get_backend(url)
+    db = backend.connect()
+    populate(backend, db, users)
+    try:
+        rng = random.Random(seed)
+        keys = [[] for _ in range(3)]
+        for _ in range(lookups):
+            i = rng.randrange(users)
+            keys[0].append('uuid-{0}'.format(i))
+            keys[1].append('+1555{0:07d}'.format(i))
+            keys[2].append(rng.randrange(DOMAINS) + 1)
+
+        print('{0}, {1} users, {2} lookups each\n'.format(
+            backend.dialect, users, lookups))
+        print('{0:<14} {1:<9} {2:>10} {3:>12} {4:>12}'.format(
+            'lookup', 'path', 'us/lookup', 'peak bytes', 'result bytes'))
+        names = ('user by uuid', 'user by phone', 'domain by id')
+        paths = (('records', records_lookups(db)),
+                 ('prepared', prepared_lookups(db)))
+        for i, name in enumerate(names):
+            results = []
+            for path, fns in paths:
+                latency, peak, result = measure(fns[i], keys[i], samples)
+                results.append(latency)
+                print('{0:<14} {1:<9} {2:>10.1f} {3:>12.0f} {4:>12}'.format(
+                    name, path, 1e6 * latency, peak, result))
+            print('{0:<14} {1:<9} {2:>9.1f}x'.format(
+                '', 'speedup', results[0] / results[1]))
+    finally:
+        unmigrate(db)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=None,
+                        help='database to run against, defaults to a '
+                        'temporary SQLite file')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=500,
+                        help='lookups to trace allocations for')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if args.url is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            run('sqlite:///{0}'.format(path), args.users, args.lookups,
+                args.samples, args.seed)
+        finally:
+            os.unlink(path)
+    else:
+        run(args.url, args.users, args.lookups, args.samples, args.seed)
@@ -0,0 +1,114 @@
+"""
+Measures queue throughput against the number of worker processes. Every
+message "costs" `--work-ms` of waiting, standing in for the round trip to
+Twilio or a mastodon instance, which is where real workers spend their time.
+
+Also checks that every user's messages were handled in the order they were
+queued, no matter which worker ended up handling them.
+
+Run it from the top level of the repo with `python -m benchmarks.queue_scaling`
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import records
+from sqlalchemy.pool import SingletonThreadPool
+
+from sms_gateway.migrations import migrate
+from sms_gateway.queue import LeaseManager, QueueWorker, partition_for
+
+
+def get_db(path: str) -> records.Database:
+    return records.Database('sqlite:///{0}'.format(path),
+                            poolclass=SingletonThreadPool,
+                            connect_args={'timeout': 60})
+
+
+def populate(path: str, users: int, messages: int):
+    db = get_db(path)
+    migrate(db)
+    db.bulk_query('''
+    insert into outbound_messages (user_id, body, segments, partition_id)
+    values (:user_id, :body, 1, :partition_id)
+    ''', [dict(user_id=i % users, body=str(i),
+               partition_id=partition_for(i % users))
+          for i in range(messages)])
+
+
+def work(path: str, work_ms: float, results):
+    db = get_db(path)
+    handled = []
+
+    def handler(row):
+        time.sleep(work_ms / 1000.0)
+        handled.append((time.time(), row.user_id, row.id))
+
+    worker = QueueWorker(db, 'outbound_messages', handler,
+                         LeaseManager(db, 'outbound'), done_status='sent',
+                         batch_size=10)
+    worker.leases.setup()
+    try:
+        while True:
+            if worker.run_once():
+                continue
+            pending = db.query('''
+            select count(*) as count from outbound_messages
+            where status = 'pending'
+            ''', fetchall=True).first().count
+            if not pending:
+                break
+            time.sleep(0.05)
+    finally:
+        worker.leases.release_all()
+    results.put(handled)
+
+
+def run(workers: int, users: int, messages: int, work_ms: float) -> float:
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        populate(path, users, messages)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=work,
+                                         args=(path, work_ms, results))
+                 for _ in range(workers)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        handled = []
+        for _ in procs:
+            handled.extend(results.get())
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.unlink(path)
+
+    last = {}
+    for _, user_id, id in sorted(handled):
+        if id < last.get(user_id, -1):
+            raise AssertionError('user {0} out of order'.format(user_id))
+        last[user_id] = id
+    if len(handled) != messages:
+        raise AssertionError('handled {0} of {1} messages'.format(
+            len(handled), messages))
+    return messages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--work-ms', type=float, default=5.0)
+    args = parser.parse_args()
+    print('{0:>8} {1:>14} {2:>8}'.format('workers', 'messages/s', 'speedup'))
+    baseline = None
+    for n in args.workers:
+        throughput = run(n, args.users, args.messages, args.work_ms)
+        baseline = baseline or throughput
+        print('{0:>8} {1:>14.1f} {2:>7.2f}x'.format(n, throughput,
+                                                    throughput / baseline))
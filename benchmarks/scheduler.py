@@ -0,0 +1,129 @@
+"""
+Fills the scheduled_posts table with `--posts` pending posts spread evenly
+over the next `--days` days, and `--overdue` more that came due during the
+hour before, starts a scheduler on it, and runs the clock
+forward `--minutes` minutes a second at a time. Prints how long the first
+window took to load, how many posts ended up in memory and how much memory
+that took, and then how long a round takes and how many posts a second went
+out. Posting itself costs nothing here, only the scheduler's own work is
+measured.
+
+Runs against a throwaway SQLite database by default; pass `--url` to run it
+against an empty PostgreSQL database instead.
+
+Run it from the top level of the repo with `python -m benchmarks.scheduler`
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import Mock
+
+from sms_gateway.controllers.user import UserController
+from sms_gateway.migrations import migrate, unmigrate
+from sms_gateway.queue import LeaseManager, partition_for
+from sms_gateway.scheduler import Scheduler
+from sms_gateway.storage import get_backend
+
+START = 1e9
+
+
+class Clock(object):
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def populate(backend, db, users: int, posts: int, overdue: int, days: float,
+             seed: int):
+    migrate(db)
+    backend.bulk_load(db, 'domains', ['domain', 'client_id', 'client_secret'],
+                      [('instance.social', 'id', 'secret')])
+    backend.bulk_load(db, 'users', ['uuid', '"user"', 'auth_token',
+                                    'domain_id'],
+                      [('uuid-{0}'.format(i), 'user{0}'.format(i), 'token', 1)
+                       for i in range(users)])
+    rng = random.Random(seed)
+    batch = 100000
+    for start in range(0, posts + overdue, batch):
+        rows = []
+        for i in range(start, min(start + batch, posts + overdue)):
+            user_id = rng.randrange(users) + 1
+            if i < posts:
+                due_at = START + rng.uniform(0, days * 24 * 3600)
+            else:
+                due_at = START - rng.uniform(0, 3600)
+            rows.append(('SM{0}'.format(i), user_id, 'post {0}'.format(i),
+                         due_at, partition_for(user_id)))
+        backend.bulk_load(db, 'scheduled_posts',
+                          ['message_sid', 'user_id', 'body', 'due_at',
+                           'partition_id'], rows)
+
+
+def run(url: str, users: int, posts: int, overdue: int, days: float,
+        minutes: int, seed: int):
+    backend = get_backend(url)
+    db = backend.connect()
+    start = time.perf_counter()
+    populate(backend, db, users, posts, overdue, days, seed)
+    print('{0}, {1} posts over {2} days and {3} overdue, loaded in '
+          '{4:.1f}s\n'.format(backend.dialect, posts, days, overdue,
+                              time.perf_counter() - start))
+    try:
+        clock = Clock(START)
+        user_controller = UserController(db)
+        user_controller.get_masto_client = Mock(return_value=Mock())
+        scheduler = Scheduler(db, LeaseManager(db, 'scheduled', clock=clock),
+                              user_controller=user_controller, clock=clock)
+        scheduler.leases.setup()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        scheduler.run_once()
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('first window: {0:.3f}s, {1} posts in memory, {2:.0f} KiB'.format(
+            elapsed, len(scheduler.wheel), size / 1024))
+
+        sent = 0
+        rounds = minutes * 60
+        start = time.perf_counter()
+        for _ in range(rounds):
+            clock.now += 1
+            sent += scheduler.run_once()
+        elapsed = time.perf_counter() - start
+        print('{0} rounds: {1:.2f}ms a round, {2} posted, {3:.0f} posts/s'.format(
+            rounds, 1e3 * elapsed / rounds, sent, sent / elapsed))
+        print('{0} posts in memory at the end'.format(len(scheduler.wheel)))
+    finally:
+        unmigrate(db)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=None,
+                        help='database to run against, defaults to a '
+                        'temporary SQLite file')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--overdue', type=int, default=0)
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--minutes', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if args.url is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            run('sqlite:///{0}'.format(path), args.users, args.posts,
+                args.overdue, args.days, args.minutes, args.seed)
+        finally:
+            os.unlink(path)
+    else:
+        run(args.url, args.users, args.posts, args.overdue, args.days,
+            args.minutes, args.seed)
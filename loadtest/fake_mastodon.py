@@ -0,0 +1,276 @@
+"""
+A stand-in mastodon instance, good enough to take the gateway through app
+registration, the OAuth flow, posting statuses and the user notification
+stream, without talking to anything outside of this machine.
+
+Every API call can be slowed down and made to fail some of the time, see
+`FakeMastodon.__init__`
+"""
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, urlencode
+from uuid import uuid4
+
+__all__ = ['FakeMastodon', 'ThreadingHTTPServer']
+
+VERSION = '3.0.0'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server only has this built in from 3.7 on
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeMastodon(object):
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 on_status=None, seed: int = None):
+        """
+        `latency` is the mean number of seconds every API call takes, the
+        actual delay is picked uniformly between half and one and a half times
+        that. `error_rate` is the fraction of API calls that fail with a 503.
+        `on_status` gets called with the idempotency key and the status for
+        every status that gets posted
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.on_status = on_status
+        self.random = random.Random(seed)
+        self.ids = count(1)
+        self.lock = threading.Lock()
+        self.apps = {}
+        self.codes = {}
+        self.tokens = {}
+        self.statuses = []
+        self.idempotency = {}
+        self.streams = {}
+        self.requests = 0
+
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.thread = None
+
+    @property
+    def domain(self) -> str:
+        host, port = self.server.server_address[:2]
+        return '{0}:{1}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_id(self) -> str:
+        with self.lock:
+            return str(next(self.ids))
+
+    def account(self, username: str) -> dict:
+        return {'id': str(abs(hash(username)) % 10 ** 9), 'username': username,
+                'acct': username, 'display_name': username,
+                'url': 'http://{0}/@{1}'.format(self.domain, username),
+                'created_at': now_iso()}
+
+    def notify(self, username: str, notification: dict) -> int:
+        """
+        Pushes `notification` to every open notification stream `username`
+        has. Returns how many streams it went to
+        """
+        notification = dict(notification)
+        notification.setdefault('id', self.next_id())
+        notification.setdefault('created_at', now_iso())
+        with self.lock:
+            streams = list(self.streams.get(username, ()))
+        for stream in streams:
+            stream.put(notification)
+        return len(streams)
+
+    def stream_count(self, username: str = None) -> int:
+        with self.lock:
+            if username is not None:
+                return len(self.streams.get(username, ()))
+            return sum(len(s) for s in self.streams.values())
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status: int, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def form(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                raw = self.rfile.read(length).decode('utf-8') if length else ''
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    return json.loads(raw or '{}')
+                return {k: v[-1] for k, v in parse_qs(raw).items()}
+
+            def token_user(self) -> str:
+                auth = self.headers.get('Authorization', '')
+                if not auth.startswith('Bearer '):
+                    return None
+                with fake.lock:
+                    return fake.tokens.get(auth[len('Bearer '):], None)
+
+            def slow_down(self) -> bool:
+                """
+                Applies the configured latency, and answers with a 503 for the
+                configured fraction of requests. Returns True if it did
+                """
+                with fake.lock:
+                    fake.requests += 1
+                    delay = fake.latency * fake.random.uniform(0.5, 1.5)
+                    fail = fake.random.random() < fake.error_rate
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    self.send_json(503, {'error': 'Service Unavailable'})
+                return fail
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                url = url._replace(path=url.path.rstrip('/'))
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if url.path == '/api/v1/streaming/user':
+                    return self.stream()
+                if self.slow_down():
+                    return
+                if url.path == '/api/v1/instance':
+                    return self.send_json(200, {
+                        'uri': fake.domain, 'title': 'fake', 'version': VERSION,
+                        'urls': {'streaming_api': 'ws://{0}'.format(fake.domain)}})
+                if url.path == '/oauth/authorize':
+                    return self.authorize(query)
+                if url.path == '/api/v1/accounts/verify_credentials':
+                    username = self.token_user()
+                    if username is None:
+                        return self.send_json(401, {'error': 'The access token is invalid'})
+                    return self.send_json(200, fake.account(username))
+                self.send_json(404, {'error': 'Record not found'})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                url = url._replace(path=url.path.rstrip('/'))
+                if self.slow_down():
+                    return
+                form = self.form()
+                if url.path == '/api/v1/apps':
+                    client_id, client_secret = uuid4().hex, uuid4().hex
+                    with fake.lock:
+                        fake.apps[client_id] = dict(secret=client_secret,
+                                                    redirect_uris=form.get('redirect_uris'))
+                    return self.send_json(200, {'id': fake.next_id(),
+                                                'client_id': client_id,
+                                                'client_secret': client_secret})
+                if url.path == '/oauth/token':
+                    return self.token(form)
+                if url.path == '/api/v1/statuses':
+                    return self.status(form)
+                self.send_json(404, {'error': 'Record not found'})
+
+            def authorize(self, query: dict):
+                """
+                A real instance would have the user log in and click
+                "authorize" here. We take the user from `login_as` instead
+                and send them straight back
+                """
+                with fake.lock:
+                    app = fake.apps.get(query.get('client_id'), None)
+                if app is None:
+                    return self.send_json(401, {'error': 'unknown client'})
+                code = uuid4().hex
+                with fake.lock:
+                    fake.codes[code] = query.get('login_as', 'user')
+                params = dict(code=code)
+                if 'state' in query:
+                    params['state'] = query['state']
+                self.send_response(302)
+                self.send_header('Location', '{0}?{1}'.format(
+                    query.get('redirect_uri'), urlencode(params)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def token(self, form: dict):
+                with fake.lock:
+                    username = fake.codes.pop(form.get('code'), None)
+                if username is None:
+                    return self.send_json(400, {'error': 'invalid_grant'})
+                token = uuid4().hex
+                with fake.lock:
+                    fake.tokens[token] = username
+                self.send_json(200, {'access_token': token, 'token_type': 'Bearer',
+                                     'scope': form.get('scope', 'read write'),
+                                     'created_at': int(time.time())})
+
+            def status(self, form: dict):
+                username = self.token_user()
+                if username is None:
+                    return self.send_json(401, {'error': 'The access token is invalid'})
+                key = self.headers.get('Idempotency-Key', None)
+                with fake.lock:
+                    existing = fake.idempotency.get((username, key), None)
+                if key is not None and existing is not None:
+                    return self.send_json(200, existing)
+                status = {'id': fake.next_id(), 'content': form.get('status', ''),
+                          'created_at': now_iso(), 'account': fake.account(username),
+                          'visibility': form.get('visibility') or 'public'}
+                with fake.lock:
+                    fake.statuses.append(status)
+                    if key is not None:
+                        fake.idempotency[(username, key)] = status
+                if fake.on_status is not None:
+                    fake.on_status(key, status)
+                self.send_json(200, status)
+
+            def stream(self):
+                username = self.token_user()
+                if username is None:
+                    return self.send_json(401, {'error': 'The access token is invalid'})
+                events = Queue()
+                with fake.lock:
+                    fake.streams.setdefault(username, []).append(events)
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.end_headers()
+                    self.wfile.write(b':)\n')
+                    self.wfile.flush()
+                    while True:
+                        try:
+                            notification = events.get(timeout=15)
+                        except Empty:
+                            self.wfile.write(b':thump\n')
+                        else:
+                            self.wfile.write('event: notification\ndata: {0}\n\n'.format(
+                                json.dumps(notification)).encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with fake.lock:
+                        fake.streams[username].remove(events)
+
+        return Handler
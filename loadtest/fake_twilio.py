@@ -0,0 +1,127 @@
+"""
+A stand-in for Twilio. It plays both of Twilio's parts: it delivers inbound
+SMS to the gateway's webhook the way Twilio would, retrying on timeouts with
+the same MessageSid, and it accepts the messages the gateway sends through the
+REST API
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
+import requests
+from twilio.http.http_client import TwilioHttpClient
+
+from loadtest.fake_mastodon import ThreadingHTTPServer
+
+__all__ = ['FakeTwilio', 'FakeTwilioHttpClient']
+
+TWILIO_API = 'https://api.twilio.com'
+
+
+class FakeTwilioHttpClient(TwilioHttpClient):
+    """
+    Lets the regular Twilio client talk to a FakeTwilio instead of
+    api.twilio.com
+    """
+    def __init__(self, base_url: str, *args, **kwargs):
+        super(FakeTwilioHttpClient, self).__init__(*args, **kwargs)
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(TWILIO_API):
+            url = self.base_url + url[len(TWILIO_API):]
+        return super(FakeTwilioHttpClient, self).request(method, url, *args,
+                                                         **kwargs)
+
+
+class FakeTwilio(object):
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, on_send=None):
+        """
+        `on_send` gets called with the recipient and body of every message the
+        gateway sends
+        """
+        self.latency = latency
+        self.on_send = on_send
+        self.lock = threading.Lock()
+        self.sent = []
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, webhook_url: str, from_number: str, body: str,
+                to_number: str = '+15555550000', timeout: float = 15,
+                retries: int = 3, session=None) -> (str, int):
+        """
+        Posts an inbound SMS to `webhook_url`. Like Twilio, a webhook that
+        times out gets tried again with the same MessageSid. Returns the
+        MessageSid and how many attempts it took
+        """
+        session = session or requests
+        message_sid = 'SM' + uuid4().hex
+        data = dict(MessageSid=message_sid, AccountSid='AC' + '0' * 32,
+                    From=from_number, To=to_number, Body=body, NumMedia='0')
+        for attempt in range(1, retries + 1):
+            try:
+                response = session.post(webhook_url, data=data, timeout=timeout)
+                response.raise_for_status()
+                return message_sid, attempt
+            except requests.Timeout:
+                if attempt == retries:
+                    raise
+        return message_sid, retries
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                form = {k: v[-1] for k, v in parse_qs(
+                    self.rfile.read(length).decode('utf-8')).items()}
+                if not path.endswith('/Messages.json'):
+                    return self.send_json(404, {'message': 'not found'})
+                if fake.latency:
+                    time.sleep(fake.latency)
+                sid = 'SM' + uuid4().hex
+                with fake.lock:
+                    fake.sent.append((form.get('To'), form.get('Body')))
+                if fake.on_send is not None:
+                    fake.on_send(form.get('To'), form.get('Body'))
+                self.send_json(201, {
+                    'sid': sid, 'account_sid': path.split('/')[3],
+                    'to': form.get('To'), 'from': form.get('From'),
+                    'body': form.get('Body'), 'status': 'queued',
+                    'num_segments': '1', 'direction': 'outbound-api',
+                    'uri': path[:-len('.json')] + '/' + sid + '.json'})
+
+            def send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
@@ -0,0 +1,314 @@
+"""
+Drives simulated users through the whole gateway against local stand-ins
+for mastodon and Twilio: signup, login, inbound SMS and notification fan-out.
+Prints throughput and tail latencies for every stage.
+
+Run it from the top level of the repo with `python -m loadtest.harness`
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+from twilio.rest import Client
+from werkzeug.serving import make_server
+
+from loadtest.fake_mastodon import FakeMastodon
+from loadtest.fake_twilio import FakeTwilio, FakeTwilioHttpClient
+from loadtest.stats import Recorder
+
+# The app reads these when it needs them, so they have to be in place before
+# anything talks to the database or to an instance
+os.environ['MASTODON_SCHEME'] = 'http'
+# FakeTwilio doesn't sign its webhooks
+os.environ['TWILIO_SKIP_VALIDATION'] = '1'
+
+WEBHOOK_TIMEOUT = 15
+
+
+class Harness(object):
+    def __init__(self, args):
+        self.args = args
+        self.recorder = Recorder()
+        self.statuses = {}
+        self.sent = {}
+        self.arrived = threading.Condition()
+        self.stop = threading.Event()
+        self.threads = []
+
+    # -- setup --
+
+    def start(self):
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.environ['DATABASE_URL'] = 'sqlite:///{0}'.format(self.db_path)
+
+        from sms_gateway import app
+        from sms_gateway.migrations import migrate
+        from sms_gateway.utils import get_db
+        migrate(get_db())
+
+        self.instances = [FakeMastodon(latency=self.args.mastodon_latency / 1000.0,
+                                       error_rate=self.args.error_rate,
+                                       on_status=self.on_status, seed=i).start()
+                          for i in range(self.args.instances)]
+        self.twilio = FakeTwilio(latency=self.args.twilio_latency / 1000.0,
+                                 on_send=self.on_send).start()
+
+        app.secret_key = os.urandom(24)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.server.socket.listen(1024)
+        self.app_url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.spawn(self.server.serve_forever)
+
+    def spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def shutdown(self):
+        self.stop.set()
+        self.server.shutdown()
+        for instance in self.instances:
+            instance.stop()
+        self.twilio.stop()
+        os.unlink(self.db_path)
+
+    def user(self, i: int) -> (str, FakeMastodon):
+        instance = self.instances[i % len(self.instances)]
+        return 'user{0}'.format(i), instance
+
+    def phone(self, i: int) -> str:
+        return '+1555{0:07d}'.format(i)
+
+    # -- callbacks from the fakes --
+
+    def on_status(self, key, status):
+        with self.arrived:
+            self.statuses.setdefault(key, time.perf_counter())
+            self.arrived.notify_all()
+
+    def on_send(self, to, body):
+        with self.arrived:
+            for line in body.splitlines():
+                # mentions come out as "@fan<n>: ..."
+                if line.startswith('@fan'):
+                    self.sent.setdefault(line[1:].split(':')[0],
+                                         time.perf_counter())
+            self.arrived.notify_all()
+
+    # -- stages --
+
+    def run_stage(self, name: str, fn, items):
+        self.recorder.start(name)
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            for _ in pool.map(lambda item: self.timed(name, fn, item), items):
+                pass
+        self.recorder.finish(name)
+
+    def timed(self, name: str, fn, item):
+        start = time.perf_counter()
+        try:
+            fn(item)
+        except Exception:
+            self.recorder.error(name)
+        else:
+            self.recorder.record(name, time.perf_counter() - start)
+
+    def authorize(self, i: int, path: str):
+        """
+        The browser side of signing up or logging in: post the form, go to
+        the instance, come back with the code
+        """
+        username, instance = self.user(i)
+        session = requests.Session()
+        response = session.post(self.app_url + path, allow_redirects=False,
+                                data=dict(user='{0}@{1}'.format(username,
+                                                                instance.domain)))
+        if response.status_code != 302:
+            raise RuntimeError('{0} returned {1}'.format(path, response.status_code))
+        location = response.headers['Location']
+        response = session.get('{0}&{1}'.format(location, urlencode(
+            dict(login_as=username))), allow_redirects=False)
+        if response.status_code != 302:
+            raise RuntimeError('authorize returned {0}'.format(response.status_code))
+        response = session.get(response.headers['Location'], allow_redirects=False)
+        if response.status_code != 302 or \
+                not response.headers['Location'].endswith('/app'):
+            raise RuntimeError('redirect returned {0}'.format(response.status_code))
+
+    def signup(self, i: int):
+        self.authorize(i, '/signup')
+
+    def login(self, i: int):
+        self.authorize(i, '/login')
+
+    def inbound(self, i: int):
+        start = time.perf_counter()
+        message_sid, _ = self.twilio.deliver(self.app_url + '/sms', self.phone(i),
+                                             'toot number {0}'.format(i),
+                                             timeout=WEBHOOK_TIMEOUT)
+        with self.arrived:
+            self.pending_inbound[message_sid] = start
+
+    def fanout(self, i: int):
+        username, instance = self.user(i % self.args.stream_users)
+        with self.arrived:
+            self.pending_fanout['fan{0}'.format(i)] = time.perf_counter()
+        instance.notify(username, {
+            'type': 'mention',
+            'account': instance.account('fan{0}'.format(i)),
+            'status': {'id': str(i), 'content': '<p>hi there {0}</p>'.format(i),
+                       'created_at': '2018-01-01T00:00:00Z'}})
+
+    def wait_for(self, name: str, pending: dict, arrived: dict):
+        """
+        Records how long it took from when we started something until the
+        matching status/SMS showed up at the other end
+        """
+        deadline = time.time() + self.args.drain_timeout
+        with self.arrived:
+            while pending and time.time() < deadline:
+                for key in [k for k in pending if k in arrived]:
+                    self.recorder.record(name, arrived[key] - pending.pop(key))
+                if pending:
+                    self.arrived.wait(0.5)
+        for _ in pending:
+            self.recorder.error(name)
+        self.recorder.finish(name)
+
+    # -- workers --
+
+    def start_workers(self):
+        from sms_gateway.controllers.outbound import OutboundController, SENT
+        from sms_gateway.controllers.user import UserController
+        from sms_gateway.models.outbound import OutboundMessage
+        from sms_gateway.notifications import NotificationSource
+        from sms_gateway.queue import LeaseManager, QueueWorker
+        from sms_gateway.utils import get_db
+        from sms_gateway.workers import inbound_worker
+
+        def twilio():
+            return Client('AC' + '0' * 32, 'token',
+                          http_client=FakeTwilioHttpClient(self.twilio.base_url))
+
+        def outbound_worker(db):
+            controller = OutboundController(db, twilio=twilio(),
+                                            from_number='+15555550000')
+            return QueueWorker(db, 'outbound_messages',
+                               lambda row: controller.send(
+                                   OutboundMessage.fromrecord(row)),
+                               LeaseManager(db, 'outbound', lease_seconds=10),
+                               done_status=SENT)
+
+        def run(make):
+            make(get_db()).run(should_stop=self.stop.is_set, idle_sleep=0.05)
+
+        for _ in range(self.args.workers):
+            self.spawn(run, lambda db: inbound_worker(db, lease_seconds=10))
+            self.spawn(run, outbound_worker)
+
+        def run_source():
+            # sqlite connections can't move between threads, so everything
+            # that touches this one has to happen in here
+            db = get_db()
+            user_controller = UserController(db)
+            # only the users picked here get streamed, so the source
+            # doesn't go looking for everybody else
+            source = NotificationSource(db, flush_interval=0.05,
+                                        refresh_interval=None)
+            streamed = set(self.user(i)[0] for i in range(self.args.stream_users))
+            for user, interval in user_controller.get_sms_users():
+                if user.user in streamed:
+                    source.watch(user, user_controller.get_masto_client(user),
+                                 interval)
+            source.run(self.stop.is_set)
+
+        self.spawn(run_source)
+
+    def bind_phones(self):
+        """
+        There is no UI for adding a phone number yet, so that part happens
+        straight in the database
+        """
+        from sms_gateway.controllers.user import UserController
+        from sms_gateway.utils import get_db
+        user_controller = UserController(get_db())
+        for i in range(self.args.users):
+            username, instance = self.user(i)
+            user = user_controller.get_by_user_and_domain(username, instance.domain)
+            user_controller.set_phone(user, self.phone(i))
+            # fan-out is measured per notification, so nothing gets held back
+            user_controller.set_digest_interval(user, 0)
+
+    def run(self):
+        users = range(self.args.users)
+        # the first signup for an instance registers the app with it; do that
+        # up front so the signup stage measures users, not app registration
+        for i in range(len(self.instances)):
+            self.signup(i)
+        self.run_stage('signup', self.signup, range(len(self.instances), len(users)))
+        self.run_stage('login', self.login, users)
+        self.bind_phones()
+        self.start_workers()
+
+        self.pending_inbound = {}
+        self.recorder.start('inbound end-to-end')
+        self.run_stage('inbound webhook', self.inbound,
+                       range(self.args.users * self.args.messages))
+        self.wait_for('inbound end-to-end', self.pending_inbound, self.statuses)
+
+        deadline = time.time() + self.args.drain_timeout
+        while sum(i.stream_count() for i in self.instances) < \
+                min(self.args.stream_users, self.args.users) and \
+                time.time() < deadline:
+            time.sleep(0.1)
+        self.pending_fanout = {}
+        self.recorder.start('fan-out end-to-end')
+        self.run_stage('fan-out notify', self.fanout, range(self.args.notifications))
+        self.wait_for('fan-out end-to-end', self.pending_fanout, self.sent)
+
+        print(self.recorder.report())
+        print('mastodon requests: {0}, twilio sends: {1}'.format(
+            sum(i.requests for i in self.instances), len(self.twilio.sent)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='inbound and outbound workers each')
+    parser.add_argument('--messages', type=int, default=1,
+                        help='inbound SMS per user')
+    parser.add_argument('--stream-users', type=int, default=200,
+                        help='users with an open notification stream')
+    parser.add_argument('--notifications', type=int, default=2000)
+    parser.add_argument('--mastodon-latency', type=float, default=20,
+                        help='mean ms per mastodon API call')
+    parser.add_argument('--twilio-latency', type=float, default=10,
+                        help='ms per Twilio API call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of mastodon API calls that fail')
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    harness = Harness(args)
+    harness.start()
+    try:
+        harness.run()
+    finally:
+        harness.shutdown()
+
+
+if __name__ == '__main__':
+    main()
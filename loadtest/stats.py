@@ -0,0 +1,76 @@
+import threading
+import time
+
+__all__ = ['Recorder']
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Stage(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+
+class Recorder(object):
+    """
+    Collects latencies and errors per stage and prints a summary of
+    throughput and tail latencies
+    """
+    def __init__(self):
+        self.stages = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def stage(self, name: str) -> Stage:
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+                self.order.append(name)
+            return self.stages[name]
+
+    def start(self, name: str):
+        self.stage(name).started = time.perf_counter()
+
+    def finish(self, name: str):
+        self.stage(name).finished = time.perf_counter()
+
+    def record(self, name: str, latency: float):
+        stage = self.stage(name)
+        with self.lock:
+            stage.latencies.append(latency)
+
+    def error(self, name: str):
+        stage = self.stage(name)
+        with self.lock:
+            stage.errors += 1
+
+    def report(self) -> str:
+        lines = ['{0:<22} {1:>7} {2:>6} {3:>9} {4:>8} {5:>8} {6:>8} {7:>8}'.format(
+            'stage', 'ok', 'err', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms',
+            'max ms')]
+        for name in self.order:
+            stage = self.stages[name]
+            latencies = sorted(stage.latencies)
+            elapsed = (stage.finished or time.perf_counter()) - \
+                (stage.started or time.perf_counter())
+            rate = len(latencies) / elapsed if elapsed > 0 else 0.0
+            lines.append(
+                '{0:<22} {1:>7} {2:>6} {3:>9.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} '
+                '{7:>8.1f}'.format(
+                    name, len(latencies), stage.errors, rate,
+                    1000 * percentile(latencies, 0.5),
+                    1000 * percentile(latencies, 0.9),
+                    1000 * percentile(latencies, 0.99),
+                    1000 * (latencies[-1] if latencies else 0)))
+        return '\n'.join(lines)
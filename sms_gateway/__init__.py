@@ -1,15 +1,19 @@
 from flask import Flask, request, render_template, redirect, \
-        session, abort, url_for, jsonify
-from flask_login import LoginManager, login_required, current_user
+        session, url_for, jsonify
+from flask_login import LoginManager, login_required
 
 from sms_gateway.utils import get_db
 from sms_gateway.controllers.user import UserController
 from sms_gateway.controllers.oauth_session import OAuthSessionController
 from sms_gateway.controllers.domain import DomainController, CouldNotConnect
 from sms_gateway.controllers.stats import StatsController
+from sms_gateway.controllers.usage import UsageController
 from sms_gateway.models.domain import Domain
 from sms_gateway.models.user import User
+from sms_gateway.blueprints.admin import admin, admin_required
 from sms_gateway.blueprints.auth import auth
+from sms_gateway.blueprints.sms import sms
+from sms_gateway.usage import usage_meter, log_dir
 
 # The actual Flask app. This is what we will attach everything else to,
 # including the login_manager, http routes, and anything else that needs to
@@ -17,7 +21,19 @@ from sms_gateway.blueprints.auth import auth
 app = Flask(__name__)
 login_manager = LoginManager(app)
 
+app.register_blueprint(admin)
 app.register_blueprint(auth)
+app.register_blueprint(sms)
+
+
+@app.before_first_request
+def start_usage_meter():
+    """
+    SMS usage gets counted in memory while handling requests, this writes it
+    to the database in the background
+    """
+    usage_meter.open_log(log_dir())
+    usage_meter.start(lambda: UsageController(get_db()))
 
 
 @app.route('/', methods=('GET',))
@@ -39,18 +55,13 @@ def runapp():
 
 @app.route('/stats')
 @login_required
+@admin_required
 def stats():
     """
     This will have to go or be vastly improved eventually, but for now I like
     the immediate view into the db that this provides
     """
-    db = get_db()
-    user_controller = UserController(db)
-    domain = user_controller.get_domain(current_user)
-    if current_user.user is not 'balrogboogie' and \
-            domain.domain is not 'ceilidh.space':
-        return abort(403)
-    stats_controller = StatsController(db)
+    stats_controller = StatsController(get_db())
     return jsonify(stats_controller.getstats())
 
 
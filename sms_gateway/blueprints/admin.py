@@ -0,0 +1,108 @@
+import threading
+from functools import wraps
+
+from flask import request, abort, jsonify, g, Blueprint
+from flask_login import current_user
+
+from sms_gateway.utils import get_db
+from sms_gateway.controllers.user import UserController
+from sms_gateway.controllers.profile import ProfileController, ProfileNotFound
+from sms_gateway.profiler import ProfilingAgent, Sampler, folded
+
+__all__ = ['admin', 'admin_required', 'is_admin', 'agent']
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+# (user, domain) pairs that get to see the admin pages
+ADMINS = frozenset([('balrogboogie', 'ceilidh.space')])
+
+# How long a profile started from /admin/profile runs for, if nobody says
+DEFAULT_SECONDS = 10
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+# Samples this web process whenever somebody starts a profile
+agent = ProfilingAgent('web')
+
+
+def is_admin(user) -> bool:
+    if not user.is_authenticated:
+        return False
+    domain = UserController(get_db()).get_domain(user)
+    return (user.user, domain.domain) in ADMINS
+
+
+def admin_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return abort(401)
+        if not is_admin(current_user):
+            return abort(403)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def profile_controller():
+    return ProfileController(get_db())
+
+
+@admin.route('/profile', methods=('POST',))
+@admin_required
+def start_profile():
+    """
+    Starts sampling every web and queue worker process for `seconds`, or
+    until each web process has handled `requests` requests. Fetch the result
+    from /admin/profile/<id> once it's over
+    """
+    try:
+        seconds = float(request.values.get('seconds', DEFAULT_SECONDS))
+        max_requests = request.values.get('requests', None)
+        if max_requests is not None:
+            max_requests = int(max_requests)
+        profile = profile_controller().create(seconds, max_requests)
+    except ValueError as e:
+        return abort(400, str(e))
+    return jsonify(id=profile.uuid, ends_at=profile.ends_at,
+                   requests=profile.max_requests)
+
+
+@admin.route('/profile/<uuid>', methods=('GET',))
+@admin_required
+def get_profile(uuid):
+    """
+    Everything the processes that joined the profile have reported so far,
+    as a folded-stack file for flamegraph.pl or speedscope
+    """
+    controller = profile_controller()
+    try:
+        profile = controller.get(uuid)
+    except ProfileNotFound:
+        return abort(404)
+    return folded(controller.stacks(profile)), 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Disposition': 'attachment; filename=profile-{0}.folded'.format(
+            profile.uuid),
+    }
+
+
+@admin.before_app_request
+def before_request():
+    agent.poll(profile_controller)
+    # profiling a single request is for admins only, and checking that means
+    # loading the user, so don't bother unless somebody asked for it
+    if PROFILE_HEADER in request.headers and is_admin(current_user):
+        g.sampler = Sampler(thread_ids={threading.get_ident()}).start()
+
+
+@admin.after_app_request
+def after_request(response):
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        controller = profile_controller()
+        profile = controller.create(0)
+        controller.save_stacks(profile.id, 'request', sampler.stop())
+        response.headers[PROFILE_ID_HEADER] = profile.uuid
+    agent.request_finished(profile_controller)
+    return response
@@ -21,6 +21,9 @@ def oauth_masto_redirect():
     """
     db = get_db()
     code = request.args.get('code', None)
+    state = request.args.get('state', None)
+    if state is None or state != session.get('auth_uuid', None):
+        return abort(400)
 
     oauth_controller = OAuthSessionController(db)
     domain_controller = DomainController(db, oauth_controller=oauth_controller)
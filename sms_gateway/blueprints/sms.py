@@ -0,0 +1,105 @@
+import logging
+import os
+
+from flask import request, abort, Blueprint
+from twilio.request_validator import RequestValidator
+from twilio.twiml.messaging_response import MessagingResponse
+
+from sms_gateway.utils import get_db
+from sms_gateway.controllers.user import UserController
+from sms_gateway.controllers.inbound import InboundController, QuotaExceeded
+from sms_gateway.media import is_twilio_media
+
+__all__ = ['sms']
+
+log = logging.getLogger(__name__)
+
+sms = Blueprint('sms', __name__)
+
+NOT_CONNECTED = "This number isn't connected to a mastodon account"
+RECONNECT = ("Your mastodon account stopped letting us post for you. Log in "
+             "again to reconnect it")
+
+
+def twiml(message=None):
+    response = MessagingResponse()
+    if message is not None:
+        response.message(message)
+    return str(response), 200, {'Content-Type': 'text/xml'}
+
+
+def attached_media(form) -> list:
+    """
+    (url, content type) of everything attached to an MMS. Only urls that
+    point at Twilio count, the inbound worker would fetch anything else too
+    """
+    try:
+        count = int(form.get('NumMedia', 0))
+    except ValueError:
+        return []
+    media = []
+    for i in range(count):
+        url = form.get('MediaUrl{0}'.format(i), None)
+        if url is None:
+            continue
+        if not is_twilio_media(url):
+            log.warning('ignoring media at %s', url)
+            continue
+        media.append((url, form.get('MediaContentType{0}'.format(i), None)))
+    return media
+
+
+def is_valid_twilio_request():
+    """
+    Twilio signs every webhook with our auth token, and `From` is all that
+    tells us whose account to toot from, so anything that isn't signed gets
+    turned away. That includes everything, if we don't have a token to check
+    against. Running locally without a Twilio account, set
+    TWILIO_SKIP_VALIDATION to let unsigned requests through
+    """
+    if os.environ.get('TWILIO_SKIP_VALIDATION', None):
+        return True
+    auth_token = os.environ.get('TWILIO_AUTH_TOKEN', None)
+    if auth_token is None:
+        log.error('TWILIO_AUTH_TOKEN is not set, turning away an SMS')
+        return False
+    validator = RequestValidator(auth_token)
+    signature = request.headers.get('X-Twilio-Signature', '')
+    return validator.validate(request.url, request.form, signature)
+
+
+@sms.route('/sms', methods=('POST',))
+def inbound_sms():
+    """
+    Twilio posts every SMS sent to our number here. We only queue it up and
+    answer right away, since Twilio retries the webhook if we take too long.
+    That goes for MMS too, whose media stays with Twilio until the inbound
+    worker relays it
+    """
+    if not is_valid_twilio_request():
+        return abort(403)
+
+    message_sid = request.form.get('MessageSid', None)
+    from_number = request.form.get('From', None)
+    body = request.form.get('Body', '')
+    if message_sid is None or from_number is None:
+        return abort(400)
+
+    db = get_db()
+    user_controller = UserController(db)
+    user = user_controller.get_by_phone(from_number)
+    if user is None:
+        return twiml(NOT_CONNECTED)
+    if user.revoked:
+        # nothing we queue for them would get anywhere
+        return twiml(RECONNECT)
+
+    inbound_controller = InboundController(db, user_controller=user_controller)
+    try:
+        inbound_controller.receive(message_sid, user, body,
+                                   attached_media(request.form))
+    except QuotaExceeded:
+        # telling them would cost us a message every time, which is exactly
+        # what the quota is there to stop
+        pass
+    return twiml()
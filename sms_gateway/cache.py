@@ -0,0 +1,171 @@
+import time
+from collections import OrderedDict
+from threading import Lock, Event
+
+__all__ = ['AuthorizeUrlCache', 'authorize_urls', 'RecentIds',
+           'recent_message_sids', 'TTLCache', 'SingleFlight']
+
+
+class AuthorizeUrlCache(object):
+    """
+    Keeps the OAuth authorize url we send users off to, per domain and per
+    redirect uri. The url only depends on the domain's client credentials and
+    on where the instance should send the user back to, so once we've built it
+    there is no reason to look up the domain or make a new Mastodon client
+    again. Anything per-request (like the OAuth `state`) gets added on top of
+    the cached url by the caller.
+    """
+    def __init__(self):
+        self._urls = {}
+        self._lock = Lock()
+
+    def get(self, domain: str, redirect_uri: str) -> str:
+        with self._lock:
+            return self._urls.get(domain, {}).get(redirect_uri, None)
+
+    def set(self, domain: str, redirect_uri: str, url: str):
+        with self._lock:
+            self._urls.setdefault(domain, {})[redirect_uri] = url
+
+    def invalidate(self, domain: str):
+        """
+        Needs to be called whenever the client credentials for `domain` change,
+        otherwise we would keep sending users to an authorize url for a client
+        id the instance doesn't know about anymore
+        """
+        with self._lock:
+            self._urls.pop(domain, None)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+
+# Controllers get created for every request, so the cache has to live outside
+# of them for it to be of any use
+authorize_urls = AuthorizeUrlCache()
+
+
+class RecentIds(object):
+    """
+    Remembers ids we've seen in the last `window` seconds, up to `maxsize` of
+    them. This is only ever a fast path in front of something authoritative
+    (like a unique index), so forgetting an id early is fine, it just means
+    the next duplicate costs a round trip to the database
+    """
+    def __init__(self, maxsize: int = 10000, window: float = 600,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.window = window
+        self.clock = clock
+        self._seen = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, id: str) -> bool:
+        with self._lock:
+            seen_at = self._seen.get(id, None)
+            return seen_at is not None and \
+                self.clock() - seen_at < self.window
+
+    def add(self, id: str):
+        now = self.clock()
+        with self._lock:
+            self._seen.pop(id, None)
+            self._seen[id] = now
+            while self._seen:
+                oldest, seen_at = next(iter(self._seen.items()))
+                if len(self._seen) <= self.maxsize and \
+                        now - seen_at < self.window:
+                    break
+                del self._seen[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+
+# Twilio retries a webhook if we don't answer quickly enough, and the retry
+# almost always lands within a few minutes of the original
+recent_message_sids = RecentIds()
+
+
+class TTLCache(object):
+    """
+    A plain key/value cache where entries go stale after `ttl` seconds. Once
+    there are more than `maxsize` entries, the oldest ones get dropped
+    """
+    def __init__(self, ttl: float, maxsize: int = 10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into one. The first caller
+    for a key runs `fn`, everyone who asks for the same key while that's
+    still running waits for it and gets the same result (or exception)
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
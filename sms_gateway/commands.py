@@ -0,0 +1,117 @@
+import re
+from collections import namedtuple
+
+__all__ = ['Command', 'parse', 'describe_delay']
+
+# Every command we understand, mapped to a function that turns whatever
+# follows the command word into its arguments. If that function returns None
+# the text wasn't meant as a command after all and gets tooted as is
+COMMANDS = {}
+
+
+# How long LATER waits, like 2h, 45m or 1d12h
+DELAY_RE = re.compile(r'^(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?$', re.IGNORECASE)
+# Nothing gets scheduled further out than this
+MAX_DELAY = 30 * 24 * 3600
+
+
+class Command(namedtuple('Command', ['name', 'args'])):
+    pass
+
+
+def command(name: str):
+    def register(fn):
+        COMMANDS[name] = fn
+        return fn
+    return register
+
+
+def parse(body: str) -> Command:
+    """
+    Works out whether an SMS is a command, like Twitter's SMS commands: the
+    first word, in any case, names the command. Returns None for anything
+    that should just be posted
+    """
+    words = (body or '').strip().split(None, 1)
+    if not words:
+        return None
+    name = words[0].upper()
+    parse_args = COMMANDS.get(name, None)
+    if parse_args is None:
+        return None
+    args = parse_args(words[1].strip() if len(words) > 1 else '')
+    if args is None:
+        return None
+    return Command(name=name, args=args)
+
+
+def timeline_args(rest: str) -> dict:
+    if not rest:
+        return dict(older=False)
+    if rest.upper() == 'MORE':
+        return dict(older=True)
+    return None
+
+
+command('TL')(timeline_args)
+command('MENTIONS')(timeline_args)
+command('LOCAL')(timeline_args)
+
+
+def handle(word: str) -> str:
+    """
+    `word` without its leading @, as long as it has one. Without it, "d is
+    for dog" would be a DM to somebody called "is"
+    """
+    if len(word) < 2 or not word.startswith('@'):
+        return None
+    return word[1:]
+
+
+@command('D')
+def direct_args(rest: str) -> dict:
+    words = rest.split(None, 1)
+    if len(words) != 2 or handle(words[0]) is None:
+        return None
+    return dict(handle=handle(words[0]), text=words[1].strip())
+
+
+@command('FOLLOW')
+def follow_args(rest: str) -> dict:
+    words = rest.split()
+    if len(words) != 1 or handle(words[0]) is None:
+        return None
+    return dict(handle=handle(words[0]))
+
+
+def parse_delay(word: str) -> int:
+    match = DELAY_RE.match(word)
+    if match is None or not any(match.groups()):
+        return None
+    days, hours, minutes = (int(g or 0) for g in match.groups())
+    delay = ((days * 24 + hours) * 60 + minutes) * 60
+    if not 0 < delay <= MAX_DELAY:
+        return None
+    return delay
+
+
+def describe_delay(delay: int) -> str:
+    """
+    `delay` written the way LATER takes it
+    """
+    minutes = delay // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return ''.join('{0}{1}'.format(n, unit) for n, unit in
+                   ((days, 'd'), (hours, 'h'), (minutes, 'm')) if n)
+
+
+@command('LATER')
+def later_args(rest: str) -> dict:
+    words = rest.split(None, 1)
+    if len(words) != 2:
+        return None
+    delay = parse_delay(words[0])
+    if delay is None:
+        return None
+    return dict(delay=delay, text=words[1].strip())
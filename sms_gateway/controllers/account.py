@@ -0,0 +1,136 @@
+from records import Database
+
+from sms_gateway.cache import RecentIds, TTLCache, SingleFlight
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.models.user import User
+
+__all__ = ['AccountController', 'account_cache']
+
+# Account ids are an instance's own, so they get cached per instance. An
+# account keeps its id for as long as the instance knows about it, so
+# they're good for a day. Handles that don't resolve to anything get another
+# try after a few minutes, in case they were only mistyped by the instance
+# we asked or the remote instance was down
+CACHE_TTL = 24 * 3600
+NEGATIVE_TTL = 300
+CACHE_SIZE = 100000
+# The first lookup for a user in this long loads everyone they follow, a page
+# of this many at a time, up to this many pages. Whoever people DM or
+# mention is usually in there, and a page costs as much as a single search
+PREWARM_INTERVAL = 3600
+PREWARM_PAGE_SIZE = 80
+PREWARM_PAGES = 5
+
+NOT_FOUND = object()
+
+account_cache = TTLCache(CACHE_TTL, maxsize=CACHE_SIZE)
+account_flights = SingleFlight()
+prewarmed_users = RecentIds(window=PREWARM_INTERVAL)
+
+
+class AccountController(BaseController):
+    """
+    Turns `user@domain` handles into the ids the user's own instance knows
+    those accounts by, which is what following somebody takes
+    """
+    def __init__(self, db: Database, user_controller=None, cache=None,
+                 flights=None, prewarmed=None):
+        self.db = db
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        if cache is None:
+            self.cache = account_cache
+        else:
+            self.cache = cache
+
+        if flights is None:
+            self.flights = account_flights
+        else:
+            self.flights = flights
+
+        if prewarmed is None:
+            self.prewarmed = prewarmed_users
+        else:
+            self.prewarmed = prewarmed
+
+    def normalize(self, handle: str, instance: str) -> str:
+        """
+        `handle` as `user@domain`, lowercased, since that's how instances
+        compare them. A handle without a domain is somebody on `instance`.
+        Raises ValueError if it isn't a handle at all
+        """
+        handle = handle.lstrip('@')
+        if '@' not in handle:
+            handle = '{0}@{1}'.format(handle, instance)
+        user, domain = self.user_controller.extract_user_domain(handle)
+        if not user or not domain:
+            raise ValueError('incorrect user string')
+        return '{0}@{1}'.format(user, domain).lower()
+
+    def remember(self, instance: str, account: dict):
+        # instances leave their own domain off their own accounts
+        acct = self.normalize(account['acct'], instance)
+        self.cache.set((instance, acct), account['id'])
+
+    def resolve(self, user: User, mastodon, handle: str) -> str:
+        """
+        The id of the account `handle` on `user`'s instance, or None if
+        there's no such account. `mastodon` is a client for `user`
+        """
+        instance = self.user_controller.get_domain(user).domain.lower()
+        key = (instance, self.normalize(handle, instance))
+        account_id = self.cache.get(key, None)
+        if account_id is None and user.id not in self.prewarmed:
+            self.prewarm(user, mastodon, instance)
+            account_id = self.cache.get(key, None)
+        if account_id is None:
+            # everybody asking for the same handle at the same time shares
+            # a single search
+            account_id = self.flights.do(
+                key, lambda: self.search(mastodon, instance, key[1]))
+        if account_id is NOT_FOUND:
+            return None
+        return account_id
+
+    def search(self, mastodon, instance: str, acct: str):
+        """
+        Asks the instance, which goes and looks the account up on its own
+        instance if it has never heard of it
+        """
+        results = mastodon.search(acct, resolve=True, result_type='accounts')
+        found = NOT_FOUND
+        for account in results['accounts']:
+            self.remember(instance, account)
+            if self.normalize(account['acct'], instance) == acct:
+                found = account['id']
+        if found is NOT_FOUND:
+            self.cache.set((instance, acct), NOT_FOUND, ttl=NEGATIVE_TTL)
+        return found
+
+    def prewarm(self, user: User, mastodon, instance: str = None) -> int:
+        """
+        Caches everyone `user` follows and returns how many that was
+        """
+        if instance is None:
+            instance = self.user_controller.get_domain(user).domain.lower()
+
+        def load():
+            me = mastodon.account_verify_credentials()
+            page = mastodon.account_following(me['id'],
+                                              limit=PREWARM_PAGE_SIZE)
+            loaded = 0
+            for _ in range(PREWARM_PAGES):
+                if not page:
+                    break
+                for account in page:
+                    self.remember(instance, account)
+                loaded += len(page)
+                page = mastodon.fetch_next(page)
+            self.prewarmed.add(user.id)
+            return loaded
+        return self.flights.do(('following', user.id), load)
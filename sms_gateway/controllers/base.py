@@ -1,3 +1,5 @@
+import os
+
 from flask import request
 
 OAUTH_REDIRECT_URI = 'redirect'
@@ -12,5 +14,14 @@ class BaseController(object):
         else:
             return "{0}/{1}".format(host, OAUTH_REDIRECT_URI)
 
+    def get_api_base_url(self, domain: str) -> str:
+        """
+        Instances are always reached over https, except when
+        `MASTODON_SCHEME` says otherwise, which is only useful for talking to
+        the stand-in instances from the load test harness
+        """
+        scheme = os.environ.get('MASTODON_SCHEME', 'https')
+        return "{0}://{1}".format(scheme, domain)
+
     def getstats(self):
         raise NotImplementedError
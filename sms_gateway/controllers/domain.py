@@ -3,9 +3,17 @@ from records import Database
 from mastodon import Mastodon
 from mastodon.Mastodon import MastodonNetworkError
 
+from sms_gateway.cache import authorize_urls as default_authorize_urls
 from sms_gateway.controllers.base import BaseController
 from sms_gateway.controllers.oauth_session import OAuthSessionController
 from sms_gateway.models.domain import Domain
+from sms_gateway.storage import Statement, backend_for
+
+DOMAIN_BY_ID = Statement('domain_by_id', '''
+select id, domain, client_id, client_secret
+from domains
+where id = $1
+''')
 
 
 class CouldNotConnect(Exception):
@@ -17,8 +25,10 @@ class DomainDoesntExist(Exception):
 
 
 class DomainController(BaseController):
-    def __init__(self, db: Database, oauth_controller=None, mastodon=Mastodon):
+    def __init__(self, db: Database, oauth_controller=None, mastodon=Mastodon,
+                 authorize_urls=None):
         self.db = db
+        self.backend = backend_for(db)
 
         if oauth_controller is None:
             self.oauth_controller = OAuthSessionController(db)
@@ -27,6 +37,11 @@ class DomainController(BaseController):
 
         self.mastodon = mastodon
 
+        if authorize_urls is None:
+            self.authorize_urls = default_authorize_urls
+        else:
+            self.authorize_urls = authorize_urls
+
     def get_or_insert(self, domain: str, host: str) -> Domain:
         if self.domain_exists(domain):
             domain = self.get_domain(domain)
@@ -74,13 +89,16 @@ class DomainController(BaseController):
             ''', **fulldomain)
             first = result.first()
             tx.commit()
+        # new client credentials mean any authorize url we built before for
+        # this domain is no good anymore
+        self.authorize_urls.invalidate(fulldomain['domain'])
         domain = Domain.fromrecord(first)
         return domain
 
     def register_domain(self, domain: str, host: str) -> dict:
         redirect_uri = self.get_redirect_uri(host)
         try:
-            base_url = 'https://{0}'.format(domain)
+            base_url = self.get_api_base_url(domain)
             client_id, client_secret = self.mastodon.create_app('sms-gateway',
                                                                 scopes=['read', 'write'],
                                                                 redirect_uris=redirect_uri,
@@ -98,15 +116,10 @@ class DomainController(BaseController):
         return self.get_domain(domain)
 
     def get_by_id(self, id: str) -> Domain:
-        result = self.db.query('''
-        select id, domain, client_id, client_secret
-        from domains
-        where id = :id
-        ''', id=id)
-        row = result.first()
-        if not row:
+        row = self.backend.execute(self.db, DOMAIN_BY_ID, (id,)).fetchone()
+        if row is None:
             raise DomainDoesntExist
-        return Domain.fromrecord(row)
+        return Domain._make(row)
 
     def getstats(self):
         domains = self.db.query(''' select * from domains ''').all(as_dict=True)
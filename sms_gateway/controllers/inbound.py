@@ -0,0 +1,324 @@
+import logging
+
+from mastodon import MastodonUnauthorizedError
+from records import Database
+from sqlalchemy.exc import IntegrityError
+
+from sms_gateway.cache import recent_message_sids
+from sms_gateway.commands import Command, parse, describe_delay
+from sms_gateway.controllers.account import AccountController
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.controllers.outbound import OutboundController
+from sms_gateway.controllers.scheduled import ScheduledPostController, \
+        MAX_LENGTH
+from sms_gateway.controllers.timeline import TimelineController, \
+        TIMELINE_COMMANDS
+from sms_gateway.controllers.user import UserController, TokenRevoked
+from sms_gateway.media import media_relay
+from sms_gateway.models.inbound import InboundMessage
+from sms_gateway.models.media import Media
+from sms_gateway.models.user import User, REVOKED
+from sms_gateway.queue import partition_for, Skip
+from sms_gateway.sms import segment_count
+from sms_gateway.storage import backend_for
+from sms_gateway.usage import usage_meter, INBOUND
+
+__all__ = ['InboundController', 'QuotaExceeded']
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+POSTED = 'posted'
+# Messages that were done with without posting anything
+DROPPED = 'dropped'
+# Inbound workers wait on this when they run out of work
+CHANNEL = 'inbound_messages'
+
+NO_SUCH_ACCOUNT = "Couldn't find @{0}"
+FOLLOWING = 'Following @{0}'
+SCHEDULED = 'Posting that in {0}'
+TOO_LONG = "Couldn't schedule that, it's {0} characters and toots can be {1}"
+SOME_MEDIA = 'Posted that with {0} of its {1} attachments'
+NO_MEDIA = "Couldn't post your attachments"
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class InboundController(BaseController):
+    def __init__(self, db: Database, user_controller=None, recent_ids=None,
+                 outbound_controller=None, timeline_controller=None,
+                 meter=None, relay=None, account_controller=None,
+                 scheduled_controller=None):
+        self.db = db
+        self.backend = backend_for(db)
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        if outbound_controller is None:
+            self.outbound_controller = OutboundController(
+                db, user_controller=self.user_controller)
+        else:
+            self.outbound_controller = outbound_controller
+
+        if timeline_controller is None:
+            self.timeline_controller = TimelineController(
+                db, user_controller=self.user_controller)
+        else:
+            self.timeline_controller = timeline_controller
+
+        if account_controller is None:
+            self.account_controller = AccountController(
+                db, user_controller=self.user_controller)
+        else:
+            self.account_controller = account_controller
+
+        if scheduled_controller is None:
+            self.scheduled_controller = ScheduledPostController(db)
+        else:
+            self.scheduled_controller = scheduled_controller
+
+        if recent_ids is None:
+            self.recent_ids = recent_message_sids
+        else:
+            self.recent_ids = recent_ids
+
+        if meter is None:
+            self.meter = usage_meter
+        else:
+            self.meter = meter
+
+        if relay is None:
+            self.relay = media_relay
+        else:
+            self.relay = relay
+
+    def receive(self, message_sid: str, user: User, body: str,
+                media: list = ()) -> bool:
+        """
+        Queues an inbound SMS for posting, along with the (url, content type)
+        of everything attached to it if it was an MMS. Returns False if we've already seen
+        `message_sid`, which happens whenever Twilio retries a webhook it
+        thinks timed out.
+
+        Retries usually show up within a few minutes, so those get caught by
+        `recent_ids` without touching the database. Anything older than that,
+        or a retry that went to a different worker, gets caught by the unique
+        index on `message_sid`.
+
+        Raises QuotaExceeded, without queuing anything, if the user is
+        sending more than their instance allows
+        """
+        if message_sid in self.recent_ids:
+            return False
+        try:
+            # the message and its media go in together, so a worker never
+            # picks up a message whose media isn't there yet. The quota comes
+            # last, so a retry that only the unique index catches doesn't get
+            # counted twice, and being over it takes the message back out
+            with self.db.transaction():
+                self.db.query('''
+                insert into inbound_messages (message_sid, user_id, body,
+                                              partition_id)
+                values (:message_sid, :user_id, :body, :partition_id)
+                ''', message_sid=message_sid, user_id=user.id, body=body,
+                              partition_id=partition_for(user.id))
+                if media:
+                    self.db.bulk_query('''
+                    insert into inbound_media (message_sid, position, url,
+                                               content_type)
+                    values (:message_sid, :position, :url, :content_type)
+                    ''', [dict(message_sid=message_sid, position=i, url=url,
+                               content_type=content_type)
+                          for i, (url, content_type) in enumerate(media)])
+                if not self.meter.consume(user.id, user.domain_id, INBOUND,
+                                          segment_count(body)):
+                    raise QuotaExceeded
+        except IntegrityError:
+            self.recent_ids.add(message_sid)
+            return False
+        self.recent_ids.add(message_sid)
+        self.backend.notify(self.db, CHANNEL)
+        return True
+
+    def get(self, message_sid: str) -> InboundMessage:
+        result = self.db.query('''
+        select id, message_sid, user_id, body, status
+        from inbound_messages
+        where message_sid = :message_sid
+        ''', message_sid=message_sid)
+        row = result.first()
+        if not row:
+            return None
+        return InboundMessage.fromrecord(row)
+
+    def get_media(self, message_sid: str) -> list:
+        result = self.db.query('''
+        select position, url, content_type
+        from inbound_media
+        where message_sid = :message_sid
+        order by position
+        ''', message_sid=message_sid)
+        return [Media.fromrecord(row) for row in result]
+
+    def pending(self, limit: int = 100) -> list:
+        result = self.db.query('''
+        select id, message_sid, user_id, body, status
+        from inbound_messages
+        where status = :status
+        order by id
+        limit :limit
+        ''', status=PENDING, limit=limit)
+        return [InboundMessage.fromrecord(row) for row in result]
+
+    def post(self, message: InboundMessage):
+        """
+        Posts `message` to the user's instance. The MessageSid doubles as the
+        idempotency key, so if we crash between posting and marking the row as
+        posted, the instance recognizes the second attempt and hands back the
+        status it already created instead of posting it again. Attachments
+        get uploaded again on a retry, which only leaves unattached uploads
+        behind for the instance to clean up.
+
+        If the user's token turns out to be dead the message gets dropped,
+        since retrying it would only hold up everything queued behind it
+        """
+        user = self.user_controller.get_by_row_id(message.user_id)
+        try:
+            self.post_as(user, message)
+        except TokenRevoked:
+            log.info('dropping %s, token revoked', message.message_sid)
+            raise Skip(DROPPED)
+        except MastodonUnauthorizedError:
+            log.info('dropping %s, token rejected', message.message_sid)
+            self.user_controller.set_token_status(user, REVOKED)
+            raise Skip(DROPPED)
+
+    def post_as(self, user: User, message: InboundMessage):
+        command = parse(message.body)
+        if command is not None:
+            return self.run_command(user, command, message.message_sid)
+        mastodon = self.user_controller.get_masto_client(user)
+        media = self.get_media(message.message_sid)
+        if not media:
+            mastodon.status_post(message.body,
+                                 idempotency_key=message.message_sid)
+            return
+        media_ids = self.relay.relay(mastodon, media)
+        if not media_ids and not message.body.strip():
+            self.reply(user, message.message_sid, [NO_MEDIA])
+            raise Skip(DROPPED)
+        mastodon.status_post(message.body, media_ids=media_ids or None,
+                             idempotency_key=message.message_sid)
+        if len(media_ids) < len(media):
+            # mastodon takes only so many, and some may have been turned
+            # away, either way they'd want to know what's missing
+            self.reply(user, message.message_sid,
+                       [SOME_MEDIA.format(len(media_ids), len(media))])
+
+    def run_command(self, user: User, command: Command, message_sid: str):
+        """
+        Commands answer by SMS instead of posting anything. DMs are the
+        exception, they only answer if there's nobody to send them to
+        """
+        if command.name in TIMELINE_COMMANDS:
+            cursor, replies = self.timeline_controller.next_page(
+                user, TIMELINE_COMMANDS[command.name], **command.args)
+            return self.reply(user, message_sid, replies, cursor)
+        if command.name == 'D':
+            replies = self.direct(user, message_sid, **command.args)
+        elif command.name == 'FOLLOW':
+            replies = self.follow(user, **command.args)
+        elif command.name == 'LATER':
+            replies = self.later(user, message_sid, **command.args)
+        else:
+            raise ValueError('unknown command {0}'.format(command.name))
+        self.reply(user, message_sid, replies)
+
+    def reply(self, user: User, message_sid: str, replies: list,
+              cursor=None):
+        """
+        Queues the answers to `message_sid`, and moves the timeline `cursor`
+        along with them. A command can run more than once, when a worker
+        crashes or loses its lease before marking its SMS as done. The
+        second time around the answers are already queued, so nothing gets
+        sent twice and the cursor stays where the first time left it
+        """
+        with self.db.transaction():
+            queued = self.outbound_controller.enqueue_replies(
+                user.id, message_sid, replies)
+            if queued and cursor is not None:
+                self.timeline_controller.set_cursor(cursor)
+
+    def find_account(self, user: User, mastodon, handle: str) -> str:
+        try:
+            return self.account_controller.resolve(user, mastodon, handle)
+        except ValueError:
+            return None
+
+    def direct(self, user: User, message_sid: str, handle: str,
+               text: str) -> list:
+        """
+        An instance quietly drops mentions of accounts it can't find, which
+        would turn a DM into a toot nobody gets to see. So we make sure the
+        instance can find the account first
+        """
+        mastodon = self.user_controller.get_masto_client(user)
+        account_id = self.find_account(user, mastodon, handle)
+        if account_id is None:
+            return [NO_SUCH_ACCOUNT.format(handle)]
+        mastodon.status_post('@{0} {1}'.format(handle, text),
+                             visibility='direct', idempotency_key=message_sid)
+        return []
+
+    def follow(self, user: User, handle: str) -> list:
+        mastodon = self.user_controller.get_masto_client(user)
+        account_id = self.find_account(user, mastodon, handle)
+        if account_id is None:
+            return [NO_SUCH_ACCOUNT.format(handle)]
+        mastodon.account_follow(account_id)
+        return [FOLLOWING.format(handle)]
+
+    def later(self, user: User, message_sid: str, delay: int,
+              text: str) -> list:
+        if len(text) > MAX_LENGTH:
+            # better to hear it now than from nobody when it comes due
+            return [TOO_LONG.format(len(text), MAX_LENGTH)]
+        if not self.scheduled_controller.schedule(user, message_sid, text,
+                                                  delay):
+            # a retry of a message we've already scheduled. The answer
+            # might not have made it into the queue the first time around,
+            # and if it did, queuing it again doesn't send it twice
+            post = self.scheduled_controller.get(message_sid)
+            if post is None or post.user_id != user.id:
+                return []
+        return [SCHEDULED.format(describe_delay(delay))]
+
+    def process(self, message: InboundMessage):
+        status = POSTED
+        try:
+            self.post(message)
+        except Skip as skip:
+            status = skip.status
+        self.db.query('''
+        update inbound_messages set status = :status
+        where id = :id
+        ''', status=status, id=message.id)
+
+    def process_pending(self, limit: int = 100) -> int:
+        messages = self.pending(limit)
+        for message in messages:
+            self.process(message)
+        return len(messages)
+
+    def getstats(self):
+        rows = self.db.query('''
+        select status, count(*) as count
+        from inbound_messages
+        group by status
+        ''')
+        return {row.status: row.count for row in rows}
@@ -12,14 +12,14 @@ class OAuthSessionController(BaseController):
     def add(self, user, domain):
         u = str(uuid4())
         self.db.query('''
-        insert into oauth_session (uuid, user, domain)
+        insert into oauth_session (uuid, "user", domain)
         values (:uuid, :user, :domain)
         ''', uuid=u, user=user, domain=domain)
         return dict(uuid=u, user=user, domain=domain)
 
     def get(self, uuid) -> dict:
         result = self.db.query('''
-        select uuid, user, domain
+        select uuid, "user", domain
         from oauth_session
         where uuid = :uuid
         ''', uuid=uuid)
@@ -0,0 +1,128 @@
+import os
+
+from records import Database
+
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.digest import Digest
+from sms_gateway.models.outbound import OutboundMessage
+from sms_gateway.queue import partition_for, Skip
+from sms_gateway.sms import segment_count
+from sms_gateway.storage import backend_for, affected
+from sms_gateway.usage import usage_meter, OUTBOUND
+from sms_gateway.utils import get_twilio
+
+__all__ = ['OutboundController']
+
+SENT = 'sent'
+# Messages that never went out: the user was over quota, or has no number
+# to send to anymore
+THROTTLED = 'throttled'
+DROPPED = 'dropped'
+# Outbound workers wait on this when they run out of work
+CHANNEL = 'outbound_messages'
+
+
+class OutboundController(BaseController):
+    def __init__(self, db: Database, user_controller=None, twilio=None,
+                 from_number=None, meter=None):
+        self.db = db
+        self.backend = backend_for(db)
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        self._twilio = twilio
+
+        if from_number is None:
+            self.from_number = os.environ.get('TWILIO_NUMBER', None)
+        else:
+            self.from_number = from_number
+
+        if meter is None:
+            self.meter = usage_meter
+        else:
+            self.meter = meter
+
+    @property
+    def twilio(self):
+        # only build a client once we actually send something, the web app
+        # queues messages but never sends them
+        if self._twilio is None:
+            self._twilio = get_twilio()
+        return self._twilio
+
+    def enqueue(self, user_id: int, body: str) -> Digest:
+        segments = segment_count(body)
+        self.db.query('''
+        insert into outbound_messages (user_id, body, segments, partition_id)
+        values (:user_id, :body, :segments, :partition_id)
+        ''', user_id=user_id, body=body, segments=segments,
+                      partition_id=partition_for(user_id))
+        self.backend.notify(self.db, CHANNEL)
+        return Digest(user_id=user_id, body=body, segments=segments)
+
+    def enqueue_replies(self, user_id: int, message_sid: str,
+                        bodies: list) -> bool:
+        """
+        Queues `bodies` as the answer to the SMS `message_sid`. Answers are
+        keyed on the SMS they answer, so answering the same SMS again, like
+        when a worker crashes before it gets to mark the SMS as done, queues
+        nothing. Returns whether anything got queued
+        """
+        queued = 0
+        for position, body in enumerate(bodies):
+            queued += affected(self.db, '''
+            insert into outbound_messages (user_id, body, segments,
+                                           partition_id, message_sid, position)
+            values (:user_id, :body, :segments, :partition_id, :message_sid,
+                    :position)
+            on conflict (message_sid, position) do nothing
+            ''', user_id=user_id, body=body, segments=segment_count(body),
+                               partition_id=partition_for(user_id),
+                               message_sid=message_sid, position=position)
+        if queued:
+            self.backend.notify(self.db, CHANNEL)
+        return queued > 0
+
+    def enqueue_digests(self, digests: list):
+        if not digests:
+            return
+        self.backend.bulk_load(
+            self.db, 'outbound_messages',
+            ['user_id', 'body', 'segments', 'partition_id'],
+            [(d.user_id, d.body, d.segments, partition_for(d.user_id))
+             for d in digests])
+        self.backend.notify(self.db, CHANNEL)
+
+    def send(self, message: OutboundMessage):
+        """
+        Sends `message` through Twilio. Users that have since removed their
+        number just don't get it, and neither do users over their quota.
+        Either way the message is done with, and raises Skip so it gets
+        marked as what happened to it instead of as sent
+        """
+        phone, domain_id = self.user_controller.get_phone_and_domain_id(
+            message.user_id)
+        if phone is None:
+            raise Skip(DROPPED)
+        if not self.meter.consume(message.user_id, domain_id, OUTBOUND,
+                                  message.segments):
+            raise Skip(THROTTLED)
+        return self.twilio.messages.create(to=phone, from_=self.from_number,
+                                           body=message.body)
+
+    def getstats(self):
+        row = self.db.query('''
+        select count(*) as count, coalesce(sum(segments), 0) as segments
+        from outbound_messages
+        ''').first()
+        rows = self.db.query('''
+        select status, count(*) as count
+        from outbound_messages
+        group by status
+        ''')
+        return dict(count=row.count, segments=row.segments,
+                    statuses={r.status: r.count for r in rows})
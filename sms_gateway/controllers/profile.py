@@ -0,0 +1,79 @@
+import time
+from collections import Counter
+from uuid import uuid4
+
+from records import Database
+
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.models.profile import Profile
+
+__all__ = ['ProfileController', 'ProfileNotFound']
+
+# Nobody should be able to leave the profiler running by accident
+MAX_SECONDS = 300
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+class ProfileController(BaseController):
+    def __init__(self, db: Database, clock=time.time):
+        self.db = db
+        self.clock = clock
+
+    def create(self, seconds: float, max_requests: int = None) -> Profile:
+        if seconds < 0 or seconds > MAX_SECONDS:
+            raise ValueError('seconds has to be between 0 and {0}'.format(
+                MAX_SECONDS))
+        if max_requests is not None and max_requests < 1:
+            raise ValueError('requests has to be at least 1')
+        uuid = str(uuid4())
+        self.db.query('''
+        insert into profiles (uuid, ends_at, max_requests)
+        values (:uuid, :ends_at, :max_requests)
+        ''', uuid=uuid, ends_at=self.clock() + seconds, max_requests=max_requests)
+        return self.get(uuid)
+
+    def get(self, uuid: str) -> Profile:
+        result = self.db.query('''
+        select id, uuid, ends_at, max_requests
+        from profiles
+        where uuid = :uuid
+        ''', uuid=uuid)
+        row = result.first()
+        if not row:
+            raise ProfileNotFound
+        return Profile.fromrecord(row)
+
+    def active(self, now: float) -> list:
+        rows = self.db.query('''
+        select id, uuid, ends_at, max_requests
+        from profiles
+        where ends_at > :now
+        order by id
+        ''', fetchall=True, now=now)
+        return [Profile.fromrecord(row) for row in rows]
+
+    def save_stacks(self, profile_id: int, owner: str, stacks: Counter):
+        if not stacks:
+            return
+        self.db.bulk_query('''
+        insert into profile_stacks (profile_id, owner, stack, count)
+        values (:profile_id, :owner, :stack, :count)
+        ''', [dict(profile_id=profile_id, owner=owner, stack=stack, count=count)
+              for stack, count in stacks.items()])
+
+    def stacks(self, profile: Profile) -> Counter:
+        """
+        Every stack any process reported for `profile`, with the role of the
+        process that saw it as the root frame
+        """
+        rows = self.db.query('''
+        select owner, stack, sum(count) as count
+        from profile_stacks
+        where profile_id = :profile_id
+        group by owner, stack
+        ''', fetchall=True, profile_id=profile.id)
+        return Counter({'{0};{1}'.format(row.owner, row.stack): row.count
+                        for row in rows})
@@ -0,0 +1,202 @@
+import time
+
+from records import Database
+from sqlalchemy.exc import IntegrityError
+
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.models.scheduled import ScheduledPost
+from sms_gateway.models.user import User, REVOKED
+from sms_gateway.queue import partition_for
+from sms_gateway.storage import backend_for, affected
+
+__all__ = ['ScheduledPostController', 'CHANNEL', 'MAX_LENGTH']
+
+PENDING = 'pending'
+POSTED = 'posted'
+# Posts that are never going out, because the instance turned them down or
+# they kept failing
+FAILED = 'failed'
+# How long a toot can be on an instance that hasn't changed the default.
+# Anything longer gets turned down when it comes due, hours after whoever
+# scheduled it could have done anything about it
+MAX_LENGTH = 500
+# Only pending posts in partitions we still hold get updated, the same as in
+# the queues
+FENCE = '''
+and status = :pending and exists (
+    select 1 from queue_leases
+    where queue = :queue
+    and partition_id = scheduled_posts.partition_id
+    and owner = :owner
+)
+'''
+# Schedulers wait on this, so a post due before the next time they'd look at
+# the table still goes out on time
+CHANNEL = 'scheduled_posts'
+
+
+def partition_list(partitions: list) -> str:
+    # partition ids are ours and always ints, so they can go straight into
+    # the query
+    return ', '.join(str(int(p)) for p in partitions)
+
+
+class ScheduledPostController(BaseController):
+    """
+    Keeps the posts people asked us to make later. Which of them are due
+    when is the scheduler's business (see `sms_gateway.scheduler`), this
+    only reads and writes the table, a partition at a time the same way the
+    queues do
+    """
+    def __init__(self, db: Database, clock=time.time):
+        self.db = db
+        self.backend = backend_for(db)
+        self.clock = clock
+
+    def schedule(self, user: User, message_sid: str, body: str,
+                 delay: float) -> bool:
+        """
+        Posts `body` for `user` in `delay` seconds. The SMS asking for it
+        doubles as the key, so scheduling the same SMS twice only schedules
+        it once
+        """
+        try:
+            self.db.query('''
+            insert into scheduled_posts (message_sid, user_id, body, due_at,
+                                         partition_id)
+            values (:message_sid, :user_id, :body, :due_at, :partition_id)
+            ''', message_sid=message_sid, user_id=user.id, body=body,
+                          due_at=self.clock() + delay,
+                          partition_id=partition_for(user.id))
+        except IntegrityError:
+            return False
+        self.backend.notify(self.db, CHANNEL)
+        return True
+
+    def get(self, message_sid: str) -> ScheduledPost:
+        row = self.db.query('''
+        select id, message_sid, user_id, body, due_at, status
+        from scheduled_posts
+        where message_sid = :message_sid
+        ''', message_sid=message_sid).first()
+        if not row:
+            return None
+        return ScheduledPost.fromrecord(row)
+
+    def max_id(self) -> int:
+        row = self.db.query('''
+        select max(id) as max_id from scheduled_posts
+        ''', fetchall=True).first()
+        return row.max_id or 0
+
+    def due_between(self, partitions: list, after: tuple, until: tuple,
+                    limit: int) -> list:
+        """
+        (id, due_at) of the next `limit` pending posts in `partitions` that
+        come after `after` and no later than `until`, both (due_at, id)
+        pairs, in the order they're due. Pass the last one back as `after`
+        for the next page. Pages go along the index on (due_at, id), so each
+        one picks up where the last one left off instead of sorting
+        everything due all over again.
+
+        Posts of users whose token got revoked are left out, so they don't
+        keep coming due over and over while there's no way to post them.
+        They show up again once the user logs in again
+        """
+        if not partitions:
+            return []
+        rows = self.db.query('''
+        select scheduled_posts.id, scheduled_posts.due_at
+        from scheduled_posts
+        join users on users.id = scheduled_posts.user_id
+        where scheduled_posts.status = :status
+        and (scheduled_posts.due_at, scheduled_posts.id) > (:after_due_at,
+                                                            :after_id)
+        and (scheduled_posts.due_at, scheduled_posts.id) <= (:until_due_at,
+                                                             :until_id)
+        and scheduled_posts.partition_id in ({0})
+        and users.token_status != :revoked
+        order by scheduled_posts.due_at, scheduled_posts.id
+        limit :limit
+        '''.format(partition_list(partitions)), fetchall=True, status=PENDING,
+            after_due_at=after[0], after_id=after[1], until_due_at=until[0],
+            until_id=until[1], revoked=REVOKED, limit=limit)
+        return [(row.id, row.due_at) for row in rows]
+
+    def added_since(self, last_id: int, limit: int) -> list:
+        """
+        (id, partition_id, due_at) of posts newer than `last_id`, oldest
+        first. This goes along the primary key and nothing else, and leaves
+        picking out the partitions to the caller: filtering on them (or on
+        status) here would have the database go through the index on due
+        time instead, which holds every pending post. Posts that went out
+        already are left out when they come due
+        """
+        rows = self.db.query('''
+        select id, partition_id, due_at
+        from scheduled_posts
+        where id > :last_id
+        order by id
+        limit :limit
+        ''', fetchall=True, last_id=last_id, limit=limit)
+        return [(row.id, row.partition_id, row.due_at) for row in rows]
+
+    def get_batch(self, ids: list) -> list:
+        """
+        The posts in `ids` that haven't been posted yet, in the order they're
+        due
+        """
+        if not ids:
+            return []
+        rows = self.db.query('''
+        select id, message_sid, user_id, body, due_at, status
+        from scheduled_posts
+        where id in ({0}) and status = :status
+        order by due_at, id
+        '''.format(', '.join(str(int(id)) for id in ids)), fetchall=True,
+            status=PENDING)
+        return [ScheduledPost.fromrecord(row) for row in rows]
+
+    def mark_posted(self, ids: list, queue: str, owner: str):
+        """
+        Marks `ids` as posted in one go, but only the ones in partitions
+        `owner` still holds. See `QueueWorker.complete`
+        """
+        self.mark(ids, POSTED, queue, owner)
+
+    def mark_failed(self, ids: list, queue: str, owner: str):
+        self.mark(ids, FAILED, queue, owner)
+
+    def mark(self, ids: list, status: str, queue: str, owner: str):
+        if not ids:
+            return
+        self.db.query('''
+        update scheduled_posts set status = :status
+        where id in ({0})
+        '''.format(', '.join(str(int(id)) for id in ids)) + FENCE,
+            status=status, pending=PENDING, queue=queue, owner=owner)
+
+    def retry(self, id: int, queue: str, owner: str,
+              max_attempts: int) -> bool:
+        """
+        Counts a failed attempt at posting `id`. Returns True if that was
+        its last attempt, and the post got marked as failed so the user's
+        posts due after it can go on. See `QueueWorker.retry`
+        """
+        self.db.query('''
+        update scheduled_posts set attempts = attempts + 1
+        where id = :id
+        ''' + FENCE, id=id, pending=PENDING, queue=queue, owner=owner)
+        return affected(self.db, '''
+        update scheduled_posts set status = :failed
+        where id = :id and attempts >= :max_attempts
+        ''' + FENCE, id=id, max_attempts=max_attempts, failed=FAILED,
+                        pending=PENDING, queue=queue, owner=owner) == 1
+
+    def getstats(self):
+        rows = self.db.query('''
+        select status, count(*) as count
+        from scheduled_posts
+        group by status
+        ''')
+        return {row.status: row.count for row in rows}
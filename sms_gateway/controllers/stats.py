@@ -1,12 +1,14 @@
 from sms_gateway.controllers.base import BaseController
 from sms_gateway.controllers.user import UserController
 from sms_gateway.controllers.domain import DomainController
+from sms_gateway.controllers.usage import UsageController
 
 __all__ = ['StatsController']
 
 
 class StatsController(BaseController):
-    def __init__(self, db, user_controller=None, domain_controller=None):
+    def __init__(self, db, user_controller=None, domain_controller=None,
+                 usage_controller=None):
         self.db = db
 
         if user_controller is None:
@@ -19,7 +21,13 @@ class StatsController(BaseController):
         else:
             self.domain_controller = domain_controller
 
+        if usage_controller is None:
+            self.usage_controller = UsageController(db)
+        else:
+            self.usage_controller = usage_controller
+
     def getstats(self):
         user_stats = self.user_controller.getstats()
         domain_stats = self.domain_controller.getstats()
-        return dict(users=user_stats, domains=domain_stats)
+        usage_stats = self.usage_controller.getstats()
+        return dict(users=user_stats, domains=domain_stats, usage=usage_stats)
@@ -0,0 +1,156 @@
+from records import Database
+
+from sms_gateway.cache import TTLCache, SingleFlight
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.digest import pack, render_status
+from sms_gateway.models.timeline import TimelineCursor
+from sms_gateway.models.user import User
+
+__all__ = ['TimelineController', 'TIMELINE_COMMANDS']
+
+# How many toots we send back for a single command
+PAGE_SIZE = 5
+# Rendered pages are good for this long. Long enough to soak up retries,
+# short enough that nobody notices. Pages are cached per user, since home
+# and mentions are nobody else's business, except for the newest page of the
+# local timeline: that one is the same public page for everybody on the
+# instance, and is what everybody asks for at once
+CACHE_TTL = 30
+# Every kind of notification but mentions, which is all MENTIONS wants
+NOT_MENTIONS = ['follow', 'favourite', 'reblog', 'poll', 'follow_request']
+
+TIMELINE_COMMANDS = {
+    'TL': 'home',
+    'MENTIONS': 'mentions',
+    'LOCAL': 'local',
+}
+
+NOTHING_NEW = 'No new toots'
+
+timeline_cache = TTLCache(CACHE_TTL)
+timeline_flights = SingleFlight()
+
+
+class TimelineController(BaseController):
+    """
+    Sends timelines over SMS. Every user has a cursor per timeline, so asking
+    for a timeline again only returns what's new since last time, and `MORE`
+    pages back from the oldest toot we've sent so far
+    """
+    def __init__(self, db: Database, user_controller=None, cache=None,
+                 flights=None):
+        self.db = db
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        if cache is None:
+            self.cache = timeline_cache
+        else:
+            self.cache = cache
+
+        if flights is None:
+            self.flights = timeline_flights
+        else:
+            self.flights = flights
+
+    def get_cursor(self, user: User, timeline: str) -> TimelineCursor:
+        result = self.db.query('''
+        select user_id, timeline, since_id, max_id
+        from timeline_cursors
+        where user_id = :user_id and timeline = :timeline
+        ''', user_id=user.id, timeline=timeline)
+        row = result.first()
+        if not row:
+            return TimelineCursor(user_id=user.id, timeline=timeline,
+                                  since_id=None, max_id=None)
+        return TimelineCursor.fromrecord(row)
+
+    def set_cursor(self, cursor: TimelineCursor):
+        self.db.query('''
+        insert into timeline_cursors (user_id, timeline, since_id, max_id)
+        values (:user_id, :timeline, :since_id, :max_id)
+        on conflict (user_id, timeline)
+        do update set since_id = :since_id, max_id = :max_id
+        ''', **cursor._asdict())
+
+    def fetch(self, user: User, timeline: str, older: bool = False) -> list:
+        """
+        The next page of `timeline` for `user`, as SMS bodies. Moves the
+        user's cursor past whatever we return
+        """
+        cursor, replies = self.next_page(user, timeline, older)
+        if cursor is not None:
+            self.set_cursor(cursor)
+        return replies
+
+    def next_page(self, user: User, timeline: str,
+                  older: bool = False) -> (TimelineCursor, list):
+        """
+        The next page of `timeline` for `user`, as SMS bodies, along with
+        where the user's cursor goes once they have it, or None if it stays
+        where it is. `fetch` without saving the cursor, for when that has to
+        happen together with something else
+        """
+        cursor = self.get_cursor(user, timeline)
+        if older:
+            since_id, max_id = None, cursor.max_id
+        else:
+            since_id, max_id = cursor.since_id, None
+
+        items = self.load(user, timeline, since_id, max_id)
+        if not items:
+            return None, [NOTHING_NEW]
+
+        newest, oldest = items[0][0], items[-1][0]
+        if not older and (cursor.since_id is None or
+                          int(newest) > int(cursor.since_id)):
+            cursor = cursor._replace(since_id=newest)
+        if cursor.max_id is None or int(oldest) < int(cursor.max_id):
+            cursor = cursor._replace(max_id=oldest)
+        return cursor, pack([line for _, line in items])
+
+    def load(self, user: User, timeline: str, since_id: str, max_id: str) -> list:
+        """
+        Rendered toots for a page of `timeline`, newest first, as (id, line)
+        pairs. Served from the cache when we can, and while a page is being
+        fetched, everybody else who wants the same page waits for that fetch
+        instead of starting their own
+        """
+        domain = self.user_controller.get_domain(user)
+        if timeline == 'local' and since_id is None and max_id is None:
+            key = (domain.domain, None, timeline, since_id, max_id)
+        else:
+            key = (domain.domain, user.id, timeline, since_id, max_id)
+        items = self.cache.get(key)
+        if items is not None:
+            return items
+
+        def fetch():
+            items = self.request(user, timeline, since_id, max_id)
+            self.cache.set(key, items)
+            return items
+        return self.flights.do(key, fetch)
+
+    def request(self, user: User, timeline: str, since_id: str, max_id: str) -> list:
+        """
+        Newer pages are asked for with `min_id`, which gets the toots right
+        after `since_id`. `since_id` would get the newest ones instead, and
+        skip everything between those and the last toot the user saw
+        """
+        mastodon = self.user_controller.get_masto_client(user)
+        if timeline == 'mentions':
+            # the cursor for mentions moves through notification ids, since
+            # those are what the notifications endpoint pages over
+            notifications = mastodon.notifications(min_id=since_id,
+                                                   max_id=max_id,
+                                                   exclude_types=NOT_MENTIONS,
+                                                   limit=PAGE_SIZE)
+            return [(str(n['id']), render_status(n['status']))
+                    for n in notifications if n['type'] == 'mention']
+        statuses = mastodon.timeline(timeline, min_id=since_id, max_id=max_id,
+                                     limit=PAGE_SIZE)
+        return [(str(status['id']), render_status(status)) for status in statuses]
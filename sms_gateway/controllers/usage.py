@@ -0,0 +1,111 @@
+import time
+
+from records import Database
+
+from sms_gateway.controllers.base import BaseController
+from sms_gateway.storage import affected
+
+__all__ = ['UsageController']
+
+
+class UsageController(BaseController):
+    def __init__(self, db: Database, clock=time.time):
+        self.db = db
+        self.clock = clock
+
+    def save(self, name: str, counts: dict) -> bool:
+        """
+        Adds `counts`, keyed by (user_id, day), to the usage table. `name`
+        identifies the batch, so the same batch never gets added twice.
+        Returns False if it already was. Anything else that goes wrong
+        raises, so the caller holds on to the counts
+        """
+        with self.db.transaction():
+            if not affected(self.db, '''
+            insert into usage_flushes (name, flushed_at)
+            values (:name, :flushed_at)
+            on conflict (name) do nothing
+            ''', name=name, flushed_at=self.clock()):
+                return False
+            if not counts:
+                return True
+            self.db.bulk_query('''
+            insert into sms_usage (user_id, day, domain_id,
+                                   inbound_messages, inbound_segments,
+                                   outbound_messages, outbound_segments,
+                                   throttled)
+            values (:user_id, :day, :domain_id,
+                    :inbound_messages, :inbound_segments,
+                    :outbound_messages, :outbound_segments,
+                    :throttled)
+            on conflict (user_id, day) do update set
+                inbound_messages = sms_usage.inbound_messages + excluded.inbound_messages,
+                inbound_segments = sms_usage.inbound_segments + excluded.inbound_segments,
+                outbound_messages = sms_usage.outbound_messages + excluded.outbound_messages,
+                outbound_segments = sms_usage.outbound_segments + excluded.outbound_segments,
+                throttled = sms_usage.throttled + excluded.throttled
+            ''', [dict(user_id=user_id, day=day, domain_id=c.domain_id,
+                       inbound_messages=c.inbound_messages,
+                       inbound_segments=c.inbound_segments,
+                       outbound_messages=c.outbound_messages,
+                       outbound_segments=c.outbound_segments,
+                       throttled=c.throttled)
+                  for (user_id, day), c in counts.items()])
+        return True
+
+    def prune(self, older_than: float):
+        """
+        Forgets about batches saved more than `older_than` seconds ago. By
+        then, nobody is going to try saving them again
+        """
+        self.db.query('''
+        delete from usage_flushes where flushed_at < :cutoff
+        ''', cutoff=self.clock() - older_than)
+
+    def get_limits(self) -> dict:
+        """
+        (burst, per_hour) for every domain with limits of its own
+        """
+        rows = self.db.query('''
+        select id, sms_burst, sms_per_hour
+        from domains
+        where sms_burst is not null or sms_per_hour is not null
+        ''', fetchall=True)
+        return {row.id: (row.sms_burst, row.sms_per_hour) for row in rows}
+
+    def set_limits(self, domain_id: int, burst: int = None,
+                   per_hour: int = None):
+        if (burst is not None and burst < 1) or \
+                (per_hour is not None and per_hour < 0):
+            raise ValueError('limits have to be positive')
+        self.db.query('''
+        update domains set sms_burst = :burst, sms_per_hour = :per_hour
+        where id = :id
+        ''', id=domain_id, burst=burst, per_hour=per_hour)
+
+    def get_usage(self, user_id: int, day: str) -> dict:
+        row = self.db.query('''
+        select inbound_messages, inbound_segments, outbound_messages,
+               outbound_segments, throttled
+        from sms_usage
+        where user_id = :user_id and day = :day
+        ''', fetchall=True, user_id=user_id, day=day).first()
+        if row is None:
+            return None
+        return row.as_dict()
+
+    def getstats(self):
+        """
+        Usage per instance and day
+        """
+        rows = self.db.query('''
+        select domains.domain, sms_usage.day,
+               sum(inbound_segments) as inbound_segments,
+               sum(outbound_segments) as outbound_segments,
+               sum(throttled) as throttled
+        from sms_usage
+        join domains on domains.id = sms_usage.domain_id
+        group by domains.domain, sms_usage.day
+        order by domains.domain, sms_usage.day
+        ''', fetchall=True)
+        return [row.as_dict() for row in rows]
@@ -2,15 +2,30 @@ from flask import Session
 from mastodon import Mastodon
 from records import Database
 from uuid import uuid4
+from urllib.parse import urlencode
 
 from sms_gateway.controllers.base import BaseController
 from sms_gateway.controllers.domain import DomainController
 from sms_gateway.controllers.oauth_session import OAuthSessionController
-from sms_gateway.models.user import User
+from sms_gateway.models.user import User, VALID, REVOKED
 from sms_gateway.models.domain import Domain
+from sms_gateway.storage import Statement, backend_for
 
 sentinel = object()
 
+# Flask-Login loads the user by uuid on every request, and every inbound SMS
+# looks its sender up by phone, so these two skip records altogether
+USER_BY_UUID = Statement('user_by_uuid', '''
+select id, uuid, "user", auth_token, domain_id, token_status
+from users
+where uuid = $1
+''')
+USER_BY_PHONE = Statement('user_by_phone', '''
+select id, uuid, "user", auth_token, domain_id, token_status
+from users
+where phone = $1
+''')
+
 
 class UserExists(Exception):
     pass
@@ -20,10 +35,15 @@ class UserNotFound(Exception):
     pass
 
 
+class TokenRevoked(Exception):
+    pass
+
+
 class UserController(BaseController):
     def __init__(self, db: Database, oauth_controller=None,
                  domain_controller=None, mastodon=Mastodon):
         self.db = db
+        self.backend = backend_for(db)
         if domain_controller is None:
             self.domain_controller = DomainController(db)
         else:
@@ -45,7 +65,7 @@ class UserController(BaseController):
         else:
             redirect_uri = self.get_register_uri(domain, host)
             session = self.oauth_controller.add(user, domain)
-            return redirect_uri, session
+            return self.bind_state(redirect_uri, session['uuid']), session
 
     def extract_user_domain(self, user: str):
         if user is None:
@@ -54,20 +74,36 @@ class UserController(BaseController):
         return (user, domain)
 
     def get_register_uri(self, domain: str, host: str) -> str:
-        domain = self.domain_controller.get_or_insert(domain, host)
-        mastodon = self.mastodon(client_id=domain.client_id,
-                                 client_secret=domain.client_secret,
-                                 api_base_url=domain.domain)
-        return mastodon.auth_request_url(scopes=['read', 'write'],
-                                         redirect_uris=self.get_redirect_uri(host))
+        redirect_uri = self.get_redirect_uri(host)
+        authorize_urls = self.domain_controller.authorize_urls
+        url = authorize_urls.get(domain, redirect_uri)
+        if url is None:
+            domain_rec = self.domain_controller.get_or_insert(domain, host)
+            mastodon = self.mastodon(client_id=domain_rec.client_id,
+                                     client_secret=domain_rec.client_secret,
+                                     api_base_url=self.get_api_base_url(domain_rec.domain))
+            url = mastodon.auth_request_url(scopes=['read', 'write'],
+                                            redirect_uris=redirect_uri)
+            authorize_urls.set(domain, redirect_uri, url)
+        return url
+
+    def bind_state(self, url: str, state: str) -> str:
+        """
+        The instance hands `state` back to us untouched on the redirect, so
+        tying it to the oauth session uuid lets us check that the redirect
+        belongs to the session that started it
+        """
+        sep = '&' if '?' in str(url) else '?'
+        return "{0}{1}{2}".format(url, sep, urlencode(dict(state=state)))
 
     def get_by_user_and_domain(self, user: str, domain: str, default=sentinel) -> User:
         result = self.db.query('''
-        select users.id, users.uuid, users.user, users.auth_token, users.domain_id
+        select users.id, users.uuid, users."user", users.auth_token,
+               users.domain_id, users.token_status
         from users
         inner join domains
         on users.domain_id = domains.id
-        where users.user = :user and domains.domain = :domain
+        where users."user" = :user and domains.domain = :domain
         ''', user=user, domain=domain)
         user = result.first()
         if user:
@@ -85,7 +121,8 @@ class UserController(BaseController):
 
     def get_auth_token(self, grant_code: str, domain: Domain, host: str) -> str:
         mastodon = self.mastodon(client_id=domain.client_id,
-                                 client_secret=domain.client_secret, api_base_url=domain.domain)
+                                 client_secret=domain.client_secret,
+                                 api_base_url=self.get_api_base_url(domain.domain))
         auth_token = mastodon.log_in(code=grant_code,
                                      redirect_uri=self.get_redirect_uri(host),
                                      scopes=['read', 'write'])
@@ -94,16 +131,18 @@ class UserController(BaseController):
     def create(self, username: str, domain: Domain, auth_token: str) -> User:
         uuid = str(uuid4())
         self.db.query('''
-        insert into users (uuid, user, auth_token, domain_id)
+        insert into users (uuid, "user", auth_token, domain_id)
         values (:uuid, :user, :auth_token, :domain_id)
         ''', uuid=uuid, user=username, auth_token=auth_token, domain_id=domain.id)
         return self.get_by_id(uuid)
 
     def update(self, user: User, domain: Domain, auth_token: str) -> User:
+        # a new token is a working one, whatever became of the old one
         self.db.query('''
-        update users set auth_token = :auth_token
-        where user = :user and domain_id = :domain_id
-        ''', user=user.user, domain_id=domain.id, auth_token=auth_token)
+        update users set auth_token = :auth_token, token_status = :valid
+        where "user" = :user and domain_id = :domain_id
+        ''', user=user.user, domain_id=domain.id, auth_token=auth_token,
+                      valid=VALID)
         return self.get_by_id(user.uuid)  # get a user objects with the new values
 
     def create_or_update(self, username: str, domain: Domain, auth_token: str) -> User:
@@ -124,16 +163,61 @@ class UserController(BaseController):
             self.oauth_controller.delete(uuid)
 
     def get_by_id(self, user_id: str) -> User:
+        row = self.backend.execute(self.db, USER_BY_UUID, (user_id,)).fetchone()
+        if row is None:
+            return None
+        return User._make(row)
+
+    def get_by_row_id(self, id: int) -> User:
         result = self.db.query('''
-        select id, uuid, user, auth_token, domain_id
+        select id, uuid, "user", auth_token, domain_id, token_status
         from users
-        where uuid = :uuid
-        ''', uuid=user_id)
+        where id = :id
+        ''', id=id)
         row = result.first()
         if not row:
-            return None
+            raise UserNotFound
         return User.fromrecord(row)
 
+    def get_by_phone(self, phone: str) -> User:
+        row = self.backend.execute(self.db, USER_BY_PHONE, (phone,)).fetchone()
+        if row is None:
+            return None
+        return User._make(row)
+
+    def get_phone(self, user_id: int) -> str:
+        return self.get_phone_and_domain_id(user_id)[0]
+
+    def get_phone_and_domain_id(self, user_id: int) -> (str, int):
+        result = self.db.query('''
+        select phone, domain_id
+        from users
+        where id = :id
+        ''', id=user_id)
+        row = result.first()
+        if not row:
+            raise UserNotFound
+        return row.phone, row.domain_id
+
+    def get_sms_users(self) -> list:
+        """
+        Every user with a phone number and a token that still works, along
+        with their digest interval
+        """
+        rows = self.db.query('''
+        select id, uuid, "user", auth_token, domain_id, token_status,
+               digest_interval
+        from users
+        where phone is not null and token_status != :revoked
+        ''', fetchall=True, revoked=REVOKED)
+        return [(User.fromrecord(row), row.digest_interval) for row in rows]
+
+    def set_phone(self, user: User, phone: str):
+        self.db.query('''
+        update users set phone = :phone
+        where id = :id
+        ''', id=user.id, phone=phone)
+
     def validate_and_login(self, user: str) -> User:
         user, domain = self.extract_user_domain(user)
         user_rec = self.get_by_user_and_domain(user, domain)
@@ -143,12 +227,96 @@ class UserController(BaseController):
         return self.domain_controller.get_by_id(user.domain_id)
 
     def get_masto_client(self, user: User) -> Mastodon:
+        """
+        Raises TokenRevoked, without going anywhere near the instance, if
+        we already know it would turn the user's token down
+        """
+        if user.revoked:
+            raise TokenRevoked
         domain = self.get_domain(user)
         mastodon = self.mastodon(client_id=domain.client_id,
                                  client_secret=domain.client_secret,
-                                 access_token=user.auth_token, api_base_url=domain.domain)
+                                 access_token=user.auth_token,
+                                 api_base_url=self.get_api_base_url(domain.domain))
         return mastodon
 
+    def get_digest_interval(self, user: User) -> int:
+        result = self.db.query('''
+        select digest_interval
+        from users
+        where id = :id
+        ''', id=user.id)
+        row = result.first()
+        if not row:
+            raise UserNotFound
+        return row.digest_interval
+
+    def set_digest_interval(self, user: User, interval: int) -> int:
+        if interval < 0:
+            raise ValueError('digest interval can not be negative')
+        self.db.query('''
+        update users set digest_interval = :interval
+        where id = :id
+        ''', id=user.id, interval=interval)
+        return interval
+
+    def set_token_status(self, user: User, status: str):
+        self.db.query('''
+        update users set token_status = :status
+        where id = :id and auth_token = :auth_token
+        ''', id=user.id, auth_token=user.auth_token, status=status)
+
+    def tokens_to_check(self, checked_before: float, limit: int,
+                        per_domain: int) -> list:
+        """
+        (user id, token, domain) of the `limit` users whose tokens we checked
+        the longest ago, as long as that was at `checked_before` or earlier,
+        and no more than `per_domain` of them from any one instance. The
+        ones a big instance has over its share are left out here rather than
+        by the caller, so they can't crowd the other instances out of the
+        batch. Tokens we know are revoked stay that way, so they don't get
+        checked again
+        """
+        rows = self.db.query('''
+        select id, auth_token, domain
+        from (
+            select users.id, users.auth_token, domains.domain,
+                   users.token_checked_at,
+                   row_number() over (
+                       partition by users.domain_id
+                       order by users.token_checked_at, users.id
+                   ) as position
+            from users
+            inner join domains
+            on users.domain_id = domains.id
+            where users.token_checked_at <= :checked_before
+            and users.token_status != :revoked
+        ) as due
+        where position <= :per_domain
+        order by token_checked_at, id
+        limit :limit
+        ''', fetchall=True, checked_before=checked_before, revoked=REVOKED,
+                             per_domain=per_domain, limit=limit)
+        return [(row.id, row.auth_token, row.domain) for row in rows]
+
+    def save_token_checks(self, checks: list):
+        """
+        Saves a batch of (user id, token, status, checked at) in one go.
+        Status is None if the check didn't tell us either way. A token that
+        got replaced while it was being checked keeps the status it has
+        """
+        if not checks:
+            return
+        with self.db.transaction():
+            self.db.bulk_query('''
+            update users
+            set token_status = coalesce(:status, token_status),
+                token_checked_at = :checked_at
+            where id = :id and auth_token = :auth_token
+            ''', [dict(id=id, auth_token=auth_token, status=status,
+                       checked_at=checked_at)
+                  for id, auth_token, status, checked_at in checks])
+
     def getstats(self):
         users = self.db.query(''' select * from users ''').all(as_dict=True)
         return dict(count=len(users), users=users)
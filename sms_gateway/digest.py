@@ -0,0 +1,211 @@
+import heapq
+import html
+import re
+import time
+from collections import namedtuple
+from threading import Lock
+
+from sms_gateway.sms import is_gsm7, segment_count
+
+__all__ = ['Coalescer', 'Digest', 'pack', 'render_notification',
+           'render_status']
+
+# How long we hold on to notifications for a user before sending them out, if
+# the user hasn't picked something else
+DEFAULT_INTERVAL = 300
+# Once this many notifications are pending for a user we send them right away
+# instead of waiting for the interval to run out
+MAX_PENDING = 50
+# Twilio recommends not going over 10 segments for a single message, some
+# carriers start dropping parts after that
+MAX_SEGMENTS = 10
+# Single mentions get cut down to this many characters so one long toot can't
+# eat up the whole digest
+MAX_MENTION_LENGTH = 280
+
+TAG_RE = re.compile(r'<[^>]+>')
+BREAK_RE = re.compile(r'<br\s*/?>|</p>\s*<p>', re.IGNORECASE)
+
+
+class Digest(namedtuple('Digest', ['user_id', 'body', 'segments'])):
+    pass
+
+
+class PendingDigest(object):
+    __slots__ = ('deadline', 'favourites', 'reblogs', 'follows', 'mentions',
+                 'size')
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.favourites = 0
+        self.reblogs = 0
+        self.follows = 0
+        self.mentions = []
+        self.size = 0
+
+
+def html_to_text(content: str) -> str:
+    text = BREAK_RE.sub(' ', content or '')
+    text = TAG_RE.sub('', text)
+    return ' '.join(html.unescape(text).split())
+
+
+def render_status(status: dict, acct: str = None) -> str:
+    """
+    A single toot as one line of SMS text
+    """
+    if acct is None:
+        acct = status['account']['acct']
+    text = html_to_text(status['content'])
+    if len(text) > MAX_MENTION_LENGTH:
+        text = text[:MAX_MENTION_LENGTH - 3] + '...'
+    return '@{0}: {1}'.format(acct, text)
+
+
+def render_notification(notification: dict) -> str:
+    """
+    The text for a single notification, which is what we'd send if we weren't
+    coalescing anything
+    """
+    acct = notification['account']['acct']
+    kind = notification['type']
+    if kind == 'mention':
+        return render_status(notification['status'], acct)
+    elif kind == 'favourite':
+        return '@{0} favourited your toot'.format(acct)
+    elif kind == 'reblog':
+        return '@{0} boosted your toot'.format(acct)
+    elif kind == 'follow':
+        return '@{0} followed you'.format(acct)
+    return '@{0}: {1}'.format(acct, kind)
+
+
+def plural(count: int, word: str) -> str:
+    return '{0} {1}{2}'.format(count, word, '' if count == 1 else 's')
+
+
+def pack(lines: list, max_segments: int = MAX_SEGMENTS) -> list:
+    """
+    Packs `lines` into as few messages as we can without any single message
+    going over `max_segments`. Lines that force UCS-2 get packed separately
+    from the rest, since a single one of them would otherwise make every line
+    it shares a message with cost more than twice as much
+    """
+    messages = []
+    for group in ([line for line in lines if is_gsm7(line)],
+                  [line for line in lines if not is_gsm7(line)]):
+        current = None
+        for line in group:
+            if current is None:
+                current = line
+                continue
+            candidate = '{0}\n{1}'.format(current, line)
+            if segment_count(candidate) <= max_segments:
+                current = candidate
+            else:
+                messages.append(current)
+                current = line
+        if current is not None:
+            messages.append(current)
+    return messages
+
+
+class Coalescer(object):
+    """
+    Sits between the notifications we get from a user's instance and the SMS
+    we send them. Notifications for a user are held for that user's digest
+    interval (or until `max_pending` of them pile up), favourites, boosts and
+    follows get turned into counts, and mentions get packed into as few
+    segments as possible.
+
+    Nothing in here touches the database or Twilio; callers feed it with
+    `add` and collect whatever is ready with `due`
+    """
+    def __init__(self, default_interval: int = DEFAULT_INTERVAL,
+                 max_pending: int = MAX_PENDING,
+                 max_segments: int = MAX_SEGMENTS, clock=time.monotonic):
+        self.default_interval = default_interval
+        self.max_pending = max_pending
+        self.max_segments = max_segments
+        self.clock = clock
+        self._pending = {}
+        self._deadlines = []
+        self._lock = Lock()
+
+    def add(self, user_id: int, notification: dict, interval: int = None) -> list:
+        """
+        Queues up `notification` for `user_id`. Returns the digests that have
+        to go out right away, which only happens if the user doesn't want
+        their notifications held at all or the size window filled up
+        """
+        if interval is None:
+            interval = self.default_interval
+        with self._lock:
+            pending = self._pending.get(user_id, None)
+            if pending is None:
+                pending = PendingDigest(self.clock() + interval)
+                self._pending[user_id] = pending
+                heapq.heappush(self._deadlines, (pending.deadline, user_id))
+            self.merge(pending, notification)
+            if interval <= 0 or pending.size >= self.max_pending:
+                del self._pending[user_id]
+                return self.render(user_id, pending)
+        return []
+
+    def merge(self, pending: PendingDigest, notification: dict):
+        kind = notification['type']
+        if kind == 'favourite':
+            pending.favourites += 1
+        elif kind == 'reblog':
+            pending.reblogs += 1
+        elif kind == 'follow':
+            pending.follows += 1
+        else:
+            pending.mentions.append(render_notification(notification))
+        pending.size += 1
+
+    def due(self) -> list:
+        """
+        Every digest whose time window has run out
+        """
+        now = self.clock()
+        digests = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, user_id = heapq.heappop(self._deadlines)
+                pending = self._pending.get(user_id, None)
+                # the window may have been flushed early and a new one opened
+                # since this deadline was pushed
+                if pending is None or pending.deadline != deadline:
+                    continue
+                del self._pending[user_id]
+                digests.extend(self.render(user_id, pending))
+        return digests
+
+    def flush(self) -> list:
+        """
+        Everything that is pending, regardless of time windows. Used on
+        shutdown so we don't lose notifications we've been holding on to
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._deadlines = []
+        digests = []
+        for user_id, p in pending.items():
+            digests.extend(self.render(user_id, p))
+        return digests
+
+    def render(self, user_id: int, pending: PendingDigest) -> list:
+        counts = []
+        if pending.favourites:
+            counts.append(plural(pending.favourites, 'fav'))
+        if pending.reblogs:
+            counts.append(plural(pending.reblogs, 'boost'))
+        if pending.follows:
+            counts.append(plural(pending.follows, 'new follower'))
+        lines = []
+        if counts:
+            lines.append(', '.join(counts))
+        lines.extend(pending.mentions)
+        return [Digest(user_id=user_id, body=body, segments=segment_count(body))
+                for body in pack(lines, self.max_segments)]
@@ -0,0 +1,306 @@
+"""
+Relays what people attach to an MMS, which Twilio hosts for us, to their
+mastodon instance.
+
+Attachments never sit in memory whole. Each one is read from Twilio a chunk
+at a time and every chunk goes straight into the upload to mastodon before
+the next one gets read, so relaying a message takes the same memory whether
+it has a thumbnail attached or a couple of videos. All the attachments of a
+message get relayed at the same time.
+
+Images too big for mastodon get downsized first if Pillow is installed. That
+happens in a pool of processes of its own, so decoding a big photo doesn't
+hold up everything else, and the image gets spooled to disk on the way since
+decoding it needs the whole file.
+
+Only urls on Twilio's own media host get fetched, whatever the webhook says.
+Attachments that Twilio or the instance turn down for good get left out
+instead of holding up the message they came with
+"""
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import closing
+from functools import partial
+from importlib.util import find_spec
+from urllib.parse import urlparse
+from uuid import uuid4
+
+import requests
+from mastodon import MastodonUnauthorizedError
+
+__all__ = ['MediaRelay', 'MultipartBody', 'Transcoder', 'MediaRejected',
+           'downsize', 'is_twilio_media', 'media_relay']
+
+log = logging.getLogger(__name__)
+
+# How much of an attachment gets read from Twilio and written to mastodon at
+# a time, which is as much of it as is ever in memory
+CHUNK_SIZE = 64 * 1024
+# Mastodon attaches at most this many things to a toot, an MMS can carry 10
+MAX_ATTACHMENTS = 4
+# Attachments being relayed at the same time, across all messages
+MAX_CONCURRENT = 8
+TIMEOUT = 30
+# Where Twilio keeps MMS media. The urls redirect elsewhere, but Twilio is
+# the one that sends us there
+TWILIO_MEDIA_HOSTS = frozenset(['api.twilio.com'])
+# Errors that mean trying again later might work. Any other 4xx means it
+# never will
+RETRYABLE = frozenset([401, 408, 429])
+# Images bigger than this get downsized before they go to mastodon, which
+# turns away anything over 8MB
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+# Downsized images fit in a square this big, and get saved as JPEGs of this
+# quality
+MAX_DIMENSION = 2048
+JPEG_QUALITY = 85
+# What Pillow can downsize without losing anything people would miss.
+# Animated GIFs would lose their animation
+DOWNSIZABLE = frozenset(['image/jpeg', 'image/png', 'image/webp', 'image/bmp',
+                         'image/tiff'])
+
+
+class MediaRejected(Exception):
+    """
+    An attachment that's never going to make it to mastodon
+    """
+
+
+def is_twilio_media(url: str) -> bool:
+    """
+    Whether `url` is somewhere Twilio keeps MMS media. Anything else in a
+    webhook could send us fetching whatever's reachable from our network
+    """
+    parts = urlparse(url)
+    return parts.scheme == 'https' and parts.hostname in TWILIO_MEDIA_HOSTS
+
+
+def check(response):
+    """
+    `raise_for_status`, except that errors no retry is going to fix raise
+    MediaRejected
+    """
+    status = response.status_code
+    if 400 <= status < 500 and status not in RETRYABLE:
+        raise MediaRejected('{0} from {1}'.format(status, response.url))
+    response.raise_for_status()
+
+
+def content_length(response) -> int:
+    """
+    How many bytes `response` will hand us, if we know. The Content-Length of
+    a compressed response is how much it is before decompressing it
+    """
+    length = response.headers.get('Content-Length', None)
+    if length is None or response.headers.get('Content-Encoding', None):
+        return None
+    return int(length)
+
+
+def downsize(source: str, destination: str, max_dimension: int,
+             quality: int) -> str:
+    """
+    Shrinks the image at `source` to fit in `max_dimension` by
+    `max_dimension`, saves it to `destination` and returns its content type.
+    Runs in the transcoding pool
+    """
+    from PIL import Image
+    with Image.open(source) as image:
+        # JPEGs can be decoded at a fraction of their size, which saves
+        # decoding pixels only to throw them away
+        image.draft('RGB', (max_dimension, max_dimension))
+        image.thumbnail((max_dimension, max_dimension))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(destination, 'JPEG', quality=quality, optimize=True)
+    return 'image/jpeg'
+
+
+class Transcoder(object):
+    """
+    Downsizes images in a pool of processes. The pool only starts once
+    there's an image to downsize
+    """
+    def __init__(self, max_image_bytes: int = MAX_IMAGE_BYTES,
+                 max_dimension: int = MAX_DIMENSION,
+                 quality: int = JPEG_QUALITY, processes: int = None):
+        self.max_image_bytes = max_image_bytes
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.processes = processes
+        self.pool = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def available() -> bool:
+        return find_spec('PIL') is not None
+
+    def wants(self, content_type: str, length: int) -> bool:
+        """
+        Whether an attachment might need downsizing. Anything we don't know
+        the size of has to be spooled to find out
+        """
+        return content_type in DOWNSIZABLE and (length is None or
+                                                length > self.max_image_bytes)
+
+    def downsize(self, source: str, destination: str) -> str:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.processes)
+        return self.pool.submit(downsize, source, destination,
+                                self.max_dimension, self.quality).result()
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data body holding a single file, which gets read from
+    `chunks` while the body is being sent. If we know how long the file is
+    we know how long the body is, and it can go out with a Content-Length;
+    otherwise send `iter(body)` and it goes out chunked
+    """
+    def __init__(self, chunks, content_type: str, length: int = None,
+                 field: str = 'file'):
+        self.boundary = uuid4().hex
+        self.chunks = chunks
+        self.length = length
+        filename = 'media' + (mimetypes.guess_extension(content_type) or '')
+        self.head = (
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+            'Content-Type: {3}\r\n\r\n'
+        ).format(self.boundary, field, filename, content_type).encode('utf-8')
+        self.tail = '\r\n--{0}--\r\n'.format(self.boundary).encode('utf-8')
+
+    @property
+    def content_type(self) -> str:
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    def __len__(self) -> int:
+        return len(self.head) + self.length + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        for chunk in self.chunks:
+            if chunk:
+                yield chunk
+        yield self.tail
+
+
+class MediaRelay(object):
+    """
+    Takes attachments from Twilio to mastodon. `relay` is the only thing
+    anyone needs to call
+    """
+    def __init__(self, session: requests.Session = None, transcoder=None,
+                 max_concurrent: int = MAX_CONCURRENT,
+                 chunk_size: int = CHUNK_SIZE, timeout: float = TIMEOUT,
+                 allowed=is_twilio_media):
+        if session is None:
+            self.session = requests.Session()
+        else:
+            self.session = session
+
+        if transcoder is None and Transcoder.available():
+            self.transcoder = Transcoder()
+        else:
+            self.transcoder = transcoder
+
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.allowed = allowed
+        self.pool = ThreadPoolExecutor(max_concurrent)
+
+    def twilio_auth(self) -> tuple:
+        """
+        Twilio only asks for credentials if the account has HTTP auth on
+        media turned on, but it doesn't hurt to send them either way
+        """
+        sid = os.environ.get('TWILIO_ACCOUNT_SID', None)
+        token = os.environ.get('TWILIO_AUTH_TOKEN', None)
+        if sid is None or token is None:
+            return None
+        return sid, token
+
+    def relay(self, mastodon, media: list) -> list:
+        """
+        Uploads the first MAX_ATTACHMENTS of `media` to the instance
+        `mastodon` talks to, all at once, and returns the ids of the uploads
+        in the same order. Attachments that get rejected are left out, so
+        there can be fewer ids than attachments. If any other upload fails
+        the whole message gets retried, and mastodon throws away whatever
+        uploads never got attached to anything
+        """
+        futures = [(m, self.pool.submit(self.relay_one, mastodon, m))
+                   for m in media[:MAX_ATTACHMENTS]]
+        ids = []
+        for m, future in futures:
+            try:
+                ids.append(future.result())
+            except MediaRejected as e:
+                log.warning('leaving out attachment %s: %s', m.position, e)
+        return ids
+
+    def relay_one(self, mastodon, media) -> str:
+        if not self.allowed(media.url):
+            raise MediaRejected('{0} is not a Twilio media url'.format(
+                media.url))
+        # the media urls redirect to wherever Twilio keeps the file, and
+        # requests leaves the credentials behind when it follows them
+        response = self.session.get(media.url, stream=True,
+                                    auth=self.twilio_auth(),
+                                    timeout=self.timeout)
+        with closing(response):
+            check(response)
+            content_type = (media.content_type or
+                            response.headers.get('Content-Type',
+                                                 'application/octet-stream'))
+            length = content_length(response)
+            chunks = response.iter_content(self.chunk_size)
+            if self.transcoder is not None and \
+                    self.transcoder.wants(content_type, length):
+                return self.relay_spooled(mastodon, chunks, content_type)
+            return self.upload(mastodon, chunks, content_type, length)
+
+    def relay_spooled(self, mastodon, chunks, content_type: str) -> str:
+        with tempfile.TemporaryDirectory(prefix='mastotwilio-media-') as tmp:
+            path = os.path.join(tmp, 'original')
+            with open(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            if os.path.getsize(path) > self.transcoder.max_image_bytes:
+                source, path = path, os.path.join(tmp, 'downsized')
+                content_type = self.transcoder.downsize(source, path)
+            with open(path, 'rb') as f:
+                return self.upload(mastodon,
+                                   iter(partial(f.read, self.chunk_size), b''),
+                                   content_type, os.path.getsize(path))
+
+    def upload(self, mastodon, chunks, content_type: str,
+               length: int = None) -> str:
+        """
+        Streams `chunks` into a media upload and returns the upload's id.
+        Mastodon.py's media_post would read the whole file into memory to
+        build the request, so this goes around it
+        """
+        body = MultipartBody(chunks, content_type, length)
+        response = self.session.post(
+            mastodon.api_base_url + '/api/v1/media',
+            data=body if length is not None else iter(body),
+            headers={
+                'Authorization': 'Bearer ' + mastodon.access_token,
+                'Content-Type': body.content_type,
+            }, timeout=self.timeout)
+        if response.status_code == 401:
+            # the same as Mastodon.py would say, so the token gets marked
+            # as revoked
+            raise MastodonUnauthorizedError('media upload', 401,
+                                            'Unauthorized', None)
+        check(response)
+        return response.json()['id']
+
+
+media_relay = MediaRelay()
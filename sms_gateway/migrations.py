@@ -1,25 +1,29 @@
-def ensure_migrations_table_exists(db):
-    rows = db.query("select name from sqlite_master where type = 'table' and name = 'migrations'")
-    if not rows.first():
-        db.query('''
+from sms_gateway.storage import backend_for
+
+
+def ensure_migrations_table_exists(db, backend):
+    if not backend.table_exists(db, 'migrations'):
+        db.query(backend.translate('''
         create table migrations (
             id INTEGER PRIMARY KEY,
             num INTEGER NOT NULL,
             migration TEXT NOT NULL
         )
-        ''')
+        '''))
 
 
 def migrate(db):  # pragma: no cover
-    ensure_migrations_table_exists(db)
+    backend = backend_for(db)
+    ensure_migrations_table_exists(db, backend)
     rows = db.query('select max(num) as max_num from migrations')
     result = rows.first()
     max_num = result['max_num']
-    if not max_num:
+    if max_num is None:
         num = 0
     else:
         num = max_num + 1
     for i, migration in enumerate(UP[num:]):
+        migration = backend.translate(migration)
         db.query(migration)
         db.query('''
         insert into migrations (num, migration)
@@ -28,15 +32,16 @@ def migrate(db):  # pragma: no cover
 
 
 def unmigrate(db):  # pragma: no cover
+    backend = backend_for(db)
     rows = db.query('select max(num) as max_num from migrations')
     result = rows.first()
     max_num = result['max_num']
-    if not max_num:
+    if max_num is None:
         num = 0
     else:
         num = max_num + 1
     for i, migration in enumerate(reversed(DOWN[:num])):
-        db.query(migration)
+        db.query(backend.translate(migration))
         db.query('''
         delete from migrations
         where num = :num
@@ -56,7 +61,7 @@ UP = [
     CREATE TABLE oauth_session (
         id INTEGER PRIMARY KEY,
         uuid TEXT NOT NULL,
-        user TEXT NOT NULL,
+        "user" TEXT NOT NULL,
         domain TEXT NOT NULL
     )
     ''',
@@ -64,12 +69,262 @@ UP = [
     CREATE TABLE users (
         id INTEGER PRIMARY KEY,
         uuid TEXT NOT NULL,
-        user TEXT NOT NULL,
+        "user" TEXT NOT NULL,
         auth_token TEXT NOT NULL,
         domain_id INTEGER NOT NULL,
         FOREIGN KEY (domain_id) REFERENCES domains(id)
     )
     ''',
+    '''
+    ALTER TABLE users ADD COLUMN digest_interval INTEGER NOT NULL DEFAULT 300
+    ''',
+    '''
+    CREATE TABLE outbound_messages (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        body TEXT NOT NULL,
+        segments INTEGER NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    ALTER TABLE users ADD COLUMN phone TEXT
+    ''',
+    '''
+    CREATE UNIQUE INDEX users_phone ON users (phone)
+    ''',
+    '''
+    CREATE TABLE inbound_messages (
+        id INTEGER PRIMARY KEY,
+        message_sid TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        body TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE UNIQUE INDEX inbound_messages_message_sid
+    ON inbound_messages (message_sid)
+    ''',
+    '''
+    ALTER TABLE inbound_messages ADD COLUMN partition_id INTEGER NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN partition_id INTEGER NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'
+    ''',
+    '''
+    CREATE INDEX inbound_messages_partition
+    ON inbound_messages (partition_id, status, id)
+    ''',
+    '''
+    CREATE INDEX outbound_messages_partition
+    ON outbound_messages (partition_id, status, id)
+    ''',
+    '''
+    CREATE TABLE queue_leases (
+        queue TEXT NOT NULL,
+        partition_id INTEGER NOT NULL,
+        owner TEXT,
+        expires_at REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (queue, partition_id)
+    )
+    ''',
+    '''
+    CREATE TABLE queue_workers (
+        queue TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (queue, owner)
+    )
+    ''',
+    '''
+    CREATE TABLE timeline_cursors (
+        user_id INTEGER NOT NULL,
+        timeline TEXT NOT NULL,
+        since_id TEXT,
+        max_id TEXT,
+        PRIMARY KEY (user_id, timeline),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE profiles (
+        id INTEGER PRIMARY KEY,
+        uuid TEXT NOT NULL,
+        ends_at REAL NOT NULL,
+        max_requests INTEGER,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE profile_stacks (
+        profile_id INTEGER NOT NULL,
+        owner TEXT NOT NULL,
+        stack TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        FOREIGN KEY (profile_id) REFERENCES profiles(id)
+    )
+    ''',
+    '''
+    CREATE INDEX profile_stacks_profile_id ON profile_stacks (profile_id)
+    ''',
+    '''
+    CREATE UNIQUE INDEX users_uuid ON users (uuid)
+    ''',
+    '''
+    ALTER TABLE domains ADD COLUMN sms_burst INTEGER
+    ''',
+    '''
+    ALTER TABLE domains ADD COLUMN sms_per_hour INTEGER
+    ''',
+    '''
+    CREATE TABLE sms_usage (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        domain_id INTEGER NOT NULL,
+        inbound_messages INTEGER NOT NULL DEFAULT 0,
+        inbound_segments INTEGER NOT NULL DEFAULT 0,
+        outbound_messages INTEGER NOT NULL DEFAULT 0,
+        outbound_segments INTEGER NOT NULL DEFAULT 0,
+        throttled INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day),
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (domain_id) REFERENCES domains(id)
+    )
+    ''',
+    '''
+    CREATE TABLE usage_flushes (
+        name TEXT PRIMARY KEY,
+        flushed_at REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE inbound_media (
+        message_sid TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        content_type TEXT,
+        PRIMARY KEY (message_sid, position)
+    )
+    ''',
+    '''
+    CREATE TABLE scheduled_posts (
+        id INTEGER PRIMARY KEY,
+        message_sid TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        body TEXT NOT NULL,
+        due_at REAL NOT NULL,
+        partition_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE UNIQUE INDEX scheduled_posts_message_sid
+    ON scheduled_posts (message_sid)
+    ''',
+    '''
+    CREATE INDEX scheduled_posts_due
+    ON scheduled_posts (partition_id, due_at) WHERE status = 'pending'
+    ''',
+    '''
+    ALTER TABLE users ADD COLUMN token_status TEXT NOT NULL DEFAULT 'valid'
+    ''',
+    '''
+    ALTER TABLE users ADD COLUMN token_checked_at REAL NOT NULL DEFAULT 0
+    ''',
+    '''
+    CREATE INDEX users_token_checked ON users (token_checked_at)
+    ''',
+    '''
+    ALTER TABLE inbound_messages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE inbound_messages ADD COLUMN retry_at REAL NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN retry_at REAL NOT NULL DEFAULT 0
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN message_sid TEXT
+    ''',
+    '''
+    ALTER TABLE outbound_messages ADD COLUMN position INTEGER
+    ''',
+    '''
+    CREATE UNIQUE INDEX outbound_messages_reply
+    ON outbound_messages (message_sid, position)
+    ''',
+    '''
+    ALTER TABLE scheduled_posts ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+    ''',
+    # timestamp columns created as REAL, which PostgreSQL keeps in 4 bytes.
+    # The backend makes them DOUBLE PRECISION now, and SQLite's REAL was 8
+    # bytes all along
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE queue_leases ALTER COLUMN expires_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE queue_workers ALTER COLUMN expires_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE profiles ALTER COLUMN ends_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE usage_flushes ALTER COLUMN flushed_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE scheduled_posts ALTER COLUMN due_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE users ALTER COLUMN token_checked_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE inbound_messages ALTER COLUMN retry_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    {
+        'sqlite': 'SELECT 1',
+        'postgresql': '''
+        ALTER TABLE outbound_messages ALTER COLUMN retry_at TYPE DOUBLE PRECISION
+        ''',
+    },
+    '''
+    DROP INDEX IF EXISTS scheduled_posts_due
+    ''',
+    '''
+    CREATE INDEX scheduled_posts_due_at
+    ON scheduled_posts (due_at, id) WHERE status = 'pending'
+    ''',
 ]
 
 DOWN = [
@@ -82,4 +337,131 @@ DOWN = [
     '''
     DROP TABLE IF EXISTS users
     ''',
+    '''
+    ALTER TABLE users DROP COLUMN digest_interval
+    ''',
+    '''
+    DROP TABLE IF EXISTS outbound_messages
+    ''',
+    '''
+    ALTER TABLE users DROP COLUMN phone
+    ''',
+    '''
+    DROP INDEX IF EXISTS users_phone
+    ''',
+    '''
+    DROP TABLE IF EXISTS inbound_messages
+    ''',
+    '''
+    DROP INDEX IF EXISTS inbound_messages_message_sid
+    ''',
+    '''
+    ALTER TABLE inbound_messages DROP COLUMN partition_id
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN partition_id
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN status
+    ''',
+    '''
+    DROP INDEX IF EXISTS inbound_messages_partition
+    ''',
+    '''
+    DROP INDEX IF EXISTS outbound_messages_partition
+    ''',
+    '''
+    DROP TABLE IF EXISTS queue_leases
+    ''',
+    '''
+    DROP TABLE IF EXISTS queue_workers
+    ''',
+    '''
+    DROP TABLE IF EXISTS timeline_cursors
+    ''',
+    '''
+    DROP TABLE IF EXISTS profiles
+    ''',
+    '''
+    DROP TABLE IF EXISTS profile_stacks
+    ''',
+    '''
+    DROP INDEX IF EXISTS profile_stacks_profile_id
+    ''',
+    '''
+    DROP INDEX IF EXISTS users_uuid
+    ''',
+    '''
+    ALTER TABLE domains DROP COLUMN sms_burst
+    ''',
+    '''
+    ALTER TABLE domains DROP COLUMN sms_per_hour
+    ''',
+    '''
+    DROP TABLE IF EXISTS sms_usage
+    ''',
+    '''
+    DROP TABLE IF EXISTS usage_flushes
+    ''',
+    '''
+    DROP TABLE IF EXISTS inbound_media
+    ''',
+    '''
+    DROP TABLE IF EXISTS scheduled_posts
+    ''',
+    '''
+    DROP INDEX IF EXISTS scheduled_posts_message_sid
+    ''',
+    '''
+    DROP INDEX IF EXISTS scheduled_posts_due
+    ''',
+    '''
+    ALTER TABLE users DROP COLUMN token_status
+    ''',
+    '''
+    ALTER TABLE users DROP COLUMN token_checked_at
+    ''',
+    '''
+    DROP INDEX IF EXISTS users_token_checked
+    ''',
+    '''
+    ALTER TABLE inbound_messages DROP COLUMN attempts
+    ''',
+    '''
+    ALTER TABLE inbound_messages DROP COLUMN retry_at
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN attempts
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN retry_at
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN message_sid
+    ''',
+    '''
+    ALTER TABLE outbound_messages DROP COLUMN position
+    ''',
+    '''
+    DROP INDEX IF EXISTS outbound_messages_reply
+    ''',
+    '''
+    ALTER TABLE scheduled_posts DROP COLUMN attempts
+    ''',
+    # timestamps stay DOUBLE PRECISION, 4 bytes was never enough for them
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    'SELECT 1',
+    '''
+    CREATE INDEX scheduled_posts_due
+    ON scheduled_posts (partition_id, due_at) WHERE status = 'pending'
+    ''',
+    '''
+    DROP INDEX IF EXISTS scheduled_posts_due_at
+    ''',
 ]
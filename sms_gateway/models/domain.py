@@ -5,6 +5,8 @@ __all__ = ['Domain']
 
 
 class Domain(namedtuple('Domain', ['id', 'domain', 'client_id', 'client_secret'])):
+    __slots__ = ()
+
     @staticmethod
     def fromrecord(record: Record):
         return Domain(id=record.id, domain=record.domain,
@@ -0,0 +1,13 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['InboundMessage']
+
+
+class InboundMessage(namedtuple('InboundMessage', ['id', 'message_sid', 'user_id',
+                                                   'body', 'status'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return InboundMessage(id=record.id, message_sid=record.message_sid,
+                              user_id=record.user_id, body=record.body,
+                              status=record.status)
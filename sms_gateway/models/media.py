@@ -0,0 +1,11 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['Media']
+
+
+class Media(namedtuple('Media', ['position', 'url', 'content_type'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return Media(position=record.position, url=record.url,
+                     content_type=record.content_type)
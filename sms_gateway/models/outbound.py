@@ -0,0 +1,13 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['OutboundMessage']
+
+
+class OutboundMessage(namedtuple('OutboundMessage', ['id', 'user_id', 'body',
+                                                     'segments', 'status'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return OutboundMessage(id=record.id, user_id=record.user_id,
+                               body=record.body, segments=record.segments,
+                               status=record.status)
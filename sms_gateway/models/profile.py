@@ -0,0 +1,11 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['Profile']
+
+
+class Profile(namedtuple('Profile', ['id', 'uuid', 'ends_at', 'max_requests'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return Profile(id=record.id, uuid=record.uuid, ends_at=record.ends_at,
+                       max_requests=record.max_requests)
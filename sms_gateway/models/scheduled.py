@@ -0,0 +1,14 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['ScheduledPost']
+
+
+class ScheduledPost(namedtuple('ScheduledPost', ['id', 'message_sid',
+                                                 'user_id', 'body', 'due_at',
+                                                 'status'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return ScheduledPost(id=record.id, message_sid=record.message_sid,
+                             user_id=record.user_id, body=record.body,
+                             due_at=record.due_at, status=record.status)
@@ -0,0 +1,12 @@
+from records import Record
+from collections import namedtuple
+
+__all__ = ['TimelineCursor']
+
+
+class TimelineCursor(namedtuple('TimelineCursor', ['user_id', 'timeline',
+                                                   'since_id', 'max_id'])):
+    @staticmethod
+    def fromrecord(record: Record):
+        return TimelineCursor(user_id=record.user_id, timeline=record.timeline,
+                              since_id=record.since_id, max_id=record.max_id)
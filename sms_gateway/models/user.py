@@ -1,15 +1,34 @@
-from flask_login import UserMixin
 from records import Record
 from collections import namedtuple
 
-__all__ = ['User']
+__all__ = ['User', 'VALID', 'REVOKED']
 
+# Whether the user's token still works, as far as we know. Tokens start out
+# valid, and only stop being so when the instance turns one down
+VALID = 'valid'
+REVOKED = 'revoked'
+
+
+class User(namedtuple('User', ['id', 'uuid', 'user', 'auth_token', 'domain_id',
+                               'token_status'])):
+    # Every request loads a User, so they don't get a __dict__. That means
+    # not inheriting from flask_login's UserMixin (which would bring one
+    # along), so these are the parts of it flask_login needs
+    __slots__ = ()
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
 
-class User(namedtuple('User', ['id', 'uuid', 'user', 'auth_token', 'domain_id']), UserMixin):
     def get_id(self):
         return self.uuid
 
     @staticmethod
     def fromrecord(record: Record):
         return User(id=record.id, uuid=record.uuid, user=record.user,
-                    auth_token=record.auth_token, domain_id=record.domain_id)
+                    auth_token=record.auth_token, domain_id=record.domain_id,
+                    token_status=record.token_status)
+
+    @property
+    def revoked(self) -> bool:
+        return self.token_status == REVOKED
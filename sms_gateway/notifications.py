@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from queue import Queue, Empty
+
+from mastodon import Mastodon, StreamListener
+from records import Database
+
+from sms_gateway.controllers.outbound import OutboundController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.digest import Coalescer
+from sms_gateway.models.user import User
+
+__all__ = ['NotificationListener', 'NotificationSource']
+
+log = logging.getLogger(__name__)
+
+# How long we wait before reconnecting a stream that dropped
+RECONNECT_WAIT = 5
+# How often we look for users who added a phone number, or got rid of theirs
+REFRESH_INTERVAL = 60
+
+
+class StopStreaming(Exception):
+    """
+    Raised inside a stream nobody wants anymore, which is the only way to
+    get Mastodon.py to close it
+    """
+
+
+class NotificationListener(StreamListener):
+    def __init__(self, source, user: User, interval: int):
+        self.source = source
+        self.user = user
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def on_notification(self, notification):
+        self.check()
+        self.source.add(self.user, notification, self.interval)
+
+    def handle_heartbeat(self):
+        # instances send these every few seconds, so a stream we stopped
+        # gets closed soon even if nothing happens on it
+        self.check()
+
+    def check(self):
+        if self.stopped.is_set():
+            raise StopStreaming
+
+
+class NotificationSource(object):
+    """
+    Where notifications come from. Keeps a notification stream open to the
+    instance of every user we `watch`, and feeds what comes in through the
+    Coalescer.
+
+    The streams each get their own thread, but none of them touch the
+    database; digests are collected here and queued from `run` in batches.
+    Every `refresh_interval` seconds `run` also looks up who should be
+    watched, so users who add a phone number start getting notifications
+    without a restart, and users who drop theirs stop. Pass None to only
+    ever watch whoever gets passed to `watch`
+    """
+    def __init__(self, db: Database, coalescer=None, outbound_controller=None,
+                 user_controller=None, flush_interval: float = 1.0,
+                 refresh_interval: float = REFRESH_INTERVAL):
+        self.db = db
+
+        if coalescer is None:
+            self.coalescer = Coalescer()
+        else:
+            self.coalescer = coalescer
+
+        if outbound_controller is None:
+            self.outbound_controller = OutboundController(db)
+        else:
+            self.outbound_controller = outbound_controller
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.last_refresh = None
+        self.ready = Queue()
+        self.stopped = threading.Event()
+        self.threads = {}
+        self.listeners = {}
+
+    def add(self, user: User, notification: dict, interval: int):
+        for digest in self.coalescer.add(user.id, notification, interval):
+            self.ready.put(digest)
+
+    def watch(self, user: User, mastodon: Mastodon, interval: int):
+        if user.id in self.threads:
+            return
+        listener = NotificationListener(self, user, interval)
+        thread = threading.Thread(target=self.stream, args=(mastodon, listener),
+                                  daemon=True)
+        self.threads[user.id] = thread
+        self.listeners[user.id] = listener
+        thread.start()
+
+    def unwatch(self, user_id: int):
+        """
+        Closes the user's stream. That happens in its own thread, the next
+        time anything comes in on it
+        """
+        self.threads.pop(user_id, None)
+        listener = self.listeners.pop(user_id, None)
+        if listener is not None:
+            listener.stopped.set()
+
+    def refresh(self):
+        """
+        Watches every user with a phone number and a token that still
+        works, and stops watching everybody else. Users whose token or
+        digest interval changed get a new stream
+        """
+        wanted = {user.id: (user, interval)
+                  for user, interval in self.user_controller.get_sms_users()}
+        for user_id, listener in list(self.listeners.items()):
+            user, interval = wanted.get(user_id, (None, None))
+            if user is None or user.auth_token != listener.user.auth_token or \
+                    interval != listener.interval:
+                self.unwatch(user_id)
+        for user, interval in wanted.values():
+            if user.id in self.threads:
+                continue
+            try:
+                self.watch(user, self.user_controller.get_masto_client(user),
+                           interval)
+            except Exception:
+                log.exception('could not watch user %s', user.id)
+        self.last_refresh = time.time()
+
+    def stream(self, mastodon: Mastodon, listener: NotificationListener):
+        while not self.stopped.is_set() and not listener.stopped.is_set():
+            try:
+                mastodon.stream_user(listener)
+            except StopStreaming:
+                break
+            except Exception:
+                log.exception('notification stream for user %s dropped',
+                              listener.user.id)
+            self.stopped.wait(RECONNECT_WAIT)
+
+    def flush(self) -> int:
+        """
+        Queues everything that's ready to go out. Returns how many messages
+        that was
+        """
+        digests = self.coalescer.due()
+        while True:
+            try:
+                digests.append(self.ready.get_nowait())
+            except Empty:
+                break
+        self.outbound_controller.enqueue_digests(digests)
+        return len(digests)
+
+    def run(self, should_stop=lambda: False):
+        try:
+            while not should_stop() and not self.stopped.is_set():
+                if self.refresh_interval is not None and (
+                        self.last_refresh is None or
+                        time.time() - self.last_refresh >= self.refresh_interval):
+                    try:
+                        self.refresh()
+                    except Exception:
+                        log.exception('looking up who to watch failed')
+                        self.last_refresh = time.time()
+                self.flush()
+                time.sleep(self.flush_interval)
+        finally:
+            self.stopped.set()
+            # hold on to nothing we've been coalescing when shutting down
+            for digest in self.coalescer.flush():
+                self.ready.put(digest)
+            self.flush()
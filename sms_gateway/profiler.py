@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+__all__ = ['Sampler', 'ProfilingAgent', 'folded']
+
+# 200 samples a second is plenty to see where the time goes, and walking the
+# stacks that often costs next to nothing
+SAMPLE_INTERVAL = 0.005
+# How often a process checks the database for profiling sessions it should
+# join
+POLL_INTERVAL = 1.0
+
+
+def frame_name(frame, prefixes: tuple) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):].lstrip(os.sep)
+            break
+    return '{0} ({1})'.format(code.co_name, filename)
+
+
+def folded(stacks: Counter) -> str:
+    """
+    `stacks` in the "folded" format flamegraph.pl, speedscope and friends
+    read: one stack per line, frames separated by semicolons, followed by how
+    many times it was seen
+    """
+    return ''.join('{0} {1}\n'.format(stack, count)
+                   for stack, count in sorted(stacks.items()))
+
+
+class Sampler(object):
+    """
+    Looks at what every thread in the process is doing every `interval`
+    seconds, and counts how often it sees each stack. If `thread_ids` is
+    given, only those threads are looked at
+    """
+    def __init__(self, interval: float = SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        # longest first, so the most specific prefix wins
+        self.prefixes = tuple(sorted((p for p in sys.path if p), key=len,
+                                     reverse=True))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if self.thread_ids is not None and ident not in self.thread_ids:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame, self.prefixes))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{0}'.format(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        return self.stacks
+
+
+class ProfilingAgent(object):
+    """
+    One of these runs in every process we want to be able to profile. Every
+    so often it checks for a profiling session to join, samples the process
+    until that session runs out of time (or this process has handled the
+    number of requests the session asked for), and saves the stacks it saw
+    under `role`, so they can be put together with everyone else's.
+
+    `poll` and `request_finished` take a function that returns a
+    ProfileController, so no database connection gets made unless there is
+    something to do
+    """
+    def __init__(self, role: str, poll_interval: float = POLL_INTERVAL,
+                 sample_interval: float = SAMPLE_INTERVAL, clock=time.time):
+        self.role = role
+        self.poll_interval = poll_interval
+        self.sample_interval = sample_interval
+        self.clock = clock
+        self.last_poll = 0
+        self.seen = set()
+        self.profile = None
+        self.sampler = None
+        self.requests_left = None
+        self.lock = threading.Lock()
+
+    def poll(self, get_controller):
+        now = self.clock()
+        with self.lock:
+            if self.profile is not None and now >= self.profile.ends_at:
+                self.finish(get_controller())
+            if now - self.last_poll < self.poll_interval:
+                return
+            self.last_poll = now
+            if self.profile is not None:
+                return
+            for profile in get_controller().active(now):
+                if profile.id not in self.seen:
+                    self.begin(profile)
+                    break
+
+    def begin(self, profile):
+        self.seen.add(profile.id)
+        self.profile = profile
+        self.requests_left = profile.max_requests
+        self.sampler = Sampler(self.sample_interval).start()
+
+    def request_finished(self, get_controller):
+        with self.lock:
+            if self.profile is None or self.requests_left is None:
+                return
+            self.requests_left -= 1
+            if self.requests_left <= 0:
+                self.finish(get_controller())
+
+    def finish(self, controller):
+        stacks = self.sampler.stop()
+        controller.save_stacks(self.profile.id, self.role, stacks)
+        self.profile = None
+        self.sampler = None
+        self.requests_left = None
@@ -0,0 +1,331 @@
+import logging
+import math
+import os
+import random
+import socket
+import time
+import zlib
+from uuid import uuid4
+
+from records import Database
+
+from sms_gateway.storage import affected
+
+__all__ = ['partition_for', 'LeaseManager', 'QueueWorker', 'Skip']
+
+log = logging.getLogger(__name__)
+
+# Rows get assigned to one of this many partitions when they are queued. Every
+# partition is processed by at most one worker at a time, so this is also the
+# most workers that can usefully work on a queue at once. Changing it means
+# draining the queues first, since rows keep the partition they were queued
+# with
+NUM_PARTITIONS = 64
+# How long a worker holds on to a partition without checking in. A worker
+# that dies keeps its partitions for at most this long before someone else
+# picks them up
+LEASE_SECONDS = 30
+# A row whose handler fails gets another go after RETRY_DELAY seconds, twice
+# as long after each failure after that, up to MAX_RETRY_DELAY. Once it has
+# failed MAX_ATTEMPTS times it gets marked as failed, so one row that will
+# never go through doesn't hold up the rest of its partition forever
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+MAX_ATTEMPTS = 5
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+class Skip(Exception):
+    """
+    Raised by a handler for a row that it's done with, but that didn't get
+    done: nothing went wrong, and trying again wouldn't change anything. The
+    row gets `status` instead of the worker's done status, and the partition
+    carries on with the next one
+    """
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+def partition_for(user_id: int, partitions: int = NUM_PARTITIONS) -> int:
+    """
+    All messages for a user land in the same partition, which is what keeps
+    them in order. crc32 instead of `hash` so every process and node agrees
+    on where a user goes
+    """
+    return zlib.crc32(str(user_id).encode('utf-8')) % partitions
+
+
+def default_owner() -> str:
+    return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(),
+                                uuid4().hex[:8])
+
+
+class LeaseManager(object):
+    """
+    Hands out partitions of a queue to workers, through the `queue_leases`
+    table. Workers check in with `heartbeat`, which renews the leases they
+    have, and grabs or gives back partitions so that every live worker ends
+    up with about the same number of them.
+
+    A lease is only ever taken over by a conditional update on its row, so
+    two workers can't both think they hold a partition unless one of them
+    has gone longer than `lease_seconds` without a heartbeat. Anything a
+    worker writes on behalf of a partition should be fenced on it still
+    holding the lease (see `QueueWorker.complete`)
+    """
+    def __init__(self, db: Database, queue: str, owner: str = None,
+                 partitions: int = NUM_PARTITIONS,
+                 lease_seconds: float = LEASE_SECONDS, clock=time.time):
+        self.db = db
+        self.queue = queue
+        self.owner = owner or default_owner()
+        self.partitions = partitions
+        self.lease_seconds = lease_seconds
+        # wall clock, since leases are compared across nodes
+        self.clock = clock
+
+    def setup(self):
+        self.db.bulk_query('''
+        insert into queue_leases (queue, partition_id, owner, expires_at)
+        values (:queue, :partition_id, null, 0)
+        on conflict (queue, partition_id) do nothing
+        ''', [dict(queue=self.queue, partition_id=p)
+              for p in range(self.partitions)])
+
+    def heartbeat(self) -> list:
+        """
+        Renews everything we hold and rebalances. Returns the partitions we
+        hold afterwards
+        """
+        now = self.clock()
+        expires_at = now + self.lease_seconds
+        self.db.query('''
+        insert into queue_workers (queue, owner, expires_at)
+        values (:queue, :owner, :expires_at)
+        on conflict (queue, owner) do update set expires_at = :expires_at
+        ''', queue=self.queue, owner=self.owner, expires_at=expires_at)
+        self.db.query('''
+        delete from queue_workers
+        where queue = :queue and expires_at < :now
+        ''', queue=self.queue, now=now)
+        self.db.query('''
+        update queue_leases set expires_at = :expires_at
+        where queue = :queue and owner = :owner
+        ''', queue=self.queue, owner=self.owner, expires_at=expires_at)
+
+        owned = self.owned()
+        share = self.fair_share()
+        if len(owned) > share:
+            for partition in owned[share:]:
+                self.release(partition)
+            owned = owned[:share]
+        elif len(owned) < share:
+            free = self.free(now)
+            random.shuffle(free)
+            for partition in free:
+                if len(owned) >= share:
+                    break
+                if self.claim(partition):
+                    owned.append(partition)
+        return sorted(owned)
+
+    def fair_share(self) -> int:
+        row = self.db.query('''
+        select count(*) as workers
+        from queue_workers
+        where queue = :queue
+        ''', fetchall=True, queue=self.queue).first()
+        return int(math.ceil(self.partitions / max(row.workers, 1)))
+
+    def owned(self) -> list:
+        rows = self.db.query('''
+        select partition_id
+        from queue_leases
+        where queue = :queue and owner = :owner
+        order by partition_id
+        ''', fetchall=True, queue=self.queue, owner=self.owner)
+        return [row.partition_id for row in rows]
+
+    def free(self, now: float) -> list:
+        rows = self.db.query('''
+        select partition_id
+        from queue_leases
+        where queue = :queue and (owner is null or expires_at < :now)
+        ''', fetchall=True, queue=self.queue, now=now)
+        return [row.partition_id for row in rows]
+
+    def claim(self, partition: int) -> bool:
+        now = self.clock()
+        self.db.query('''
+        update queue_leases set owner = :owner, expires_at = :expires_at
+        where queue = :queue and partition_id = :partition_id
+        and (owner is null or owner = :owner or expires_at < :now)
+        ''', queue=self.queue, partition_id=partition, owner=self.owner,
+                      expires_at=now + self.lease_seconds, now=now)
+        return self.holds(partition)
+
+    def holds(self, partition: int) -> bool:
+        row = self.db.query('''
+        select owner, expires_at
+        from queue_leases
+        where queue = :queue and partition_id = :partition_id
+        ''', fetchall=True, queue=self.queue, partition_id=partition).first()
+        return row is not None and row.owner == self.owner and \
+            row.expires_at >= self.clock()
+
+    def release(self, partition: int):
+        self.db.query('''
+        update queue_leases set owner = null, expires_at = 0
+        where queue = :queue and partition_id = :partition_id
+        and owner = :owner
+        ''', queue=self.queue, partition_id=partition, owner=self.owner)
+
+    def release_all(self):
+        self.db.query('''
+        update queue_leases set owner = null, expires_at = 0
+        where queue = :queue and owner = :owner
+        ''', queue=self.queue, owner=self.owner)
+        self.db.query('''
+        delete from queue_workers
+        where queue = :queue and owner = :owner
+        ''', queue=self.queue, owner=self.owner)
+
+
+class QueueWorker(object):
+    """
+    Processes the pending rows of `table` for whatever partitions `leases`
+    hands us, strictly in id order within a partition. `handler` gets called
+    with each row; if it raises, we stop working on that partition until the
+    row is due to be tried again, so nothing behind the failed row gets
+    ahead of it. A row that keeps failing gets marked as failed after
+    `max_attempts` tries, and the partition moves on without it.
+
+    Every function in `hooks` gets called once per round, for things that
+    have to happen now and then in every worker but aren't queue work.
+
+    When there is nothing to do, the worker waits on `wakeup` (a listener
+    from the storage backend) so new rows get picked up as soon as they are
+    queued, instead of on the next poll
+    """
+    def __init__(self, db: Database, table: str, handler, leases: LeaseManager,
+                 done_status: str = 'done', batch_size: int = 50, hooks=None,
+                 wakeup=None, max_attempts: int = MAX_ATTEMPTS,
+                 retry_delay: float = RETRY_DELAY,
+                 max_retry_delay: float = MAX_RETRY_DELAY):
+        self.db = db
+        self.table = table
+        self.handler = handler
+        self.leases = leases
+        self.done_status = done_status
+        self.batch_size = batch_size
+        self.hooks = list(hooks or [])
+        self.wakeup = wakeup
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def run_once(self) -> int:
+        processed = 0
+        for partition in self.leases.heartbeat():
+            processed += self.drain(partition)
+        return processed
+
+    def run(self, should_stop=lambda: False, idle_sleep: float = 1.0):
+        self.leases.setup()
+        try:
+            while not should_stop():
+                for hook in self.hooks:
+                    try:
+                        hook()
+                    except Exception:
+                        log.exception('hook %r failed', hook)
+                if not self.run_once():
+                    self.idle(idle_sleep)
+        finally:
+            self.leases.release_all()
+
+    def idle(self, timeout: float):
+        if self.wakeup is None:
+            time.sleep(timeout)
+        else:
+            self.wakeup.wait(timeout)
+
+    def drain(self, partition: int) -> int:
+        rows = self.db.query('''
+        select *
+        from {0}
+        where partition_id = :partition_id and status = :pending
+        order by id
+        limit :limit
+        '''.format(self.table), fetchall=True, partition_id=partition,
+            pending=PENDING, limit=self.batch_size)
+        # the same clock as the leases, since other nodes may be the ones
+        # retrying a row
+        now = self.leases.clock()
+        processed = 0
+        for row in rows:
+            if row.retry_at > now:
+                break
+            status = None
+            try:
+                self.handler(row)
+            except Skip as skip:
+                status = skip.status
+            except Exception:
+                log.exception('failed processing %s row %s', self.table, row.id)
+                if self.retry(row, partition):
+                    continue
+                break
+            if not self.complete(row.id, partition, status):
+                log.warning('lost lease on %s partition %s', self.table,
+                            partition)
+                break
+            processed += 1
+        return processed
+
+    def retry(self, row, partition: int) -> bool:
+        """
+        Counts a failed attempt at `row` and puts off the next one. Returns
+        True if that was its last attempt, and the row got marked as failed
+        so the rest of the partition can go on
+        """
+        attempts = row.attempts + 1
+        if attempts >= self.max_attempts:
+            log.error('giving up on %s row %s after %d attempts', self.table,
+                      row.id, attempts)
+            return self.update(row.id, partition, status=FAILED,
+                               attempts=attempts)
+        delay = min(self.retry_delay * 2 ** (attempts - 1),
+                    self.max_retry_delay)
+        self.update(row.id, partition, attempts=attempts,
+                    retry_at=self.leases.clock() + delay)
+        return False
+
+    def complete(self, id: int, partition: int, status: str = None) -> bool:
+        """
+        Marks a row as done (or as `status`), but only if it's still pending
+        and we still hold its partition. If we don't, whoever took the
+        partition over will process the row again, which is why the handlers
+        have to be idempotent
+        """
+        return self.update(id, partition, status=status or self.done_status)
+
+    def update(self, id: int, partition: int, **values) -> bool:
+        """
+        Sets `values` on a pending row, fenced on our lease. Returns whether
+        it did
+        """
+        assignments = ', '.join('{0} = :{0}'.format(k) for k in values)
+        return affected(self.db, '''
+        update {0} set {1}
+        where id = :id and status = :pending and exists (
+            select 1 from queue_leases
+            where queue = :queue and partition_id = :partition_id
+            and owner = :owner
+        )
+        '''.format(self.table, assignments), id=id, pending=PENDING,
+            queue=self.leases.queue, partition_id=partition,
+            owner=self.leases.owner, **values) == 1
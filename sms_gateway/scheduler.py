@@ -0,0 +1,421 @@
+"""
+Posts scheduled toots (`LATER 2h ...`) when they're due.
+
+Looking through the whole table every second for what's due doesn't scale,
+so a scheduler only reads it a window at a time: everything pending in its
+partitions that's due in the next few minutes gets loaded, in order, along
+the index on due time, into a timer wheel in memory. Every tick the wheel
+hands back what's due, and those get posted in batches, one mastodon client
+per user. The window gets extended before it runs out, so however many
+posts are pending, only the ones due soon are ever in memory. The wheel
+never holds more than MAX_ARMED of those either: after an outage, the
+backlog that came due in the meantime gets read in and posted a part at a
+time instead of all at once.
+
+Posts scheduled after their part of the window was loaded get picked up as
+soon as whoever scheduled them notifies the scheduler, and every so often
+the loaded window gets read again to catch anything that slipped through.
+Nothing about the wheel is saved anywhere: a scheduler that starts up, or
+takes over somebody else's partitions, loads the window from the table again,
+starting with everything that came due while nobody was looking.
+
+A post the instance turns down for good gets marked as failed straight
+away, and one that keeps failing gets marked as failed after a few goes, so
+neither holds up the user's posts due after it for long
+"""
+import logging
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from mastodon import MastodonAPIError, MastodonUnauthorizedError
+from records import Database
+
+from sms_gateway.controllers.scheduled import ScheduledPostController
+from sms_gateway.controllers.user import UserController, TokenRevoked
+from sms_gateway.media import RETRYABLE
+from sms_gateway.models.user import REVOKED
+from sms_gateway.queue import LeaseManager, MAX_ATTEMPTS
+
+__all__ = ['TimerWheel', 'Scheduler', 'Outcome']
+
+log = logging.getLogger(__name__)
+
+# The wheel ticks once a second, which is as precise as "in 2h" needs to be.
+# Three levels of 64 slots reach 64 ** 3 seconds (about three days) ahead,
+# which is well past anything that gets loaded
+RESOLUTION = 1.0
+SLOTS = 64
+LEVELS = 3
+# How far ahead the window reaches, and how many posts get read per query
+# while filling it
+LOAD_AHEAD = 15 * 60
+LOAD_BATCH = 1000
+# The most posts the wheel holds at once. The rest of the window waits in
+# the table until there's room
+MAX_ARMED = 10 * LOAD_BATCH
+# How often the loaded window gets read again, and how often we check in
+# with the lease manager (which is also when we look for new posts if no
+# notification told us to)
+RESCAN_INTERVAL = 60
+HEARTBEAT_INTERVAL = 5
+# Due posts get posted this many at a time, for this many users at once
+DISPATCH_BATCH = 200
+DISPATCH_CONCURRENCY = 8
+# A post that fails gets another go after this long
+RETRY_DELAY = 60
+
+
+def rejected(e: Exception) -> bool:
+    """
+    Whether the instance turned a post down in a way no retry is going to
+    change, like a 422 for a toot that's too long
+    """
+    if not isinstance(e, MastodonAPIError) or len(e.args) < 2:
+        return False
+    status = e.args[1]
+    return isinstance(status, int) and 400 <= status < 500 and \
+        status not in RETRYABLE
+
+
+class Outcome(namedtuple('Outcome', ['posted', 'failed', 'failing',
+                                     'revoked'])):
+    """
+    What came of posting a user's due posts: the ids that went out, the ids
+    the instance turned down for good, the id of the one that failed in a
+    way that might work next time, if any, and whether that was because the
+    instance doesn't take the user's token anymore
+    """
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timer wheel. Level 0 has a slot per tick, every level
+    above it has slots as wide as the whole level below. Timers go in the
+    lowest level that reaches as far as they're due, and move down a level
+    each time the level below comes back around to them, so adding a timer
+    and finding the ones that are due never depends on how many there are
+    """
+    def __init__(self, now: float, resolution: float = RESOLUTION,
+                 slots: int = SLOTS, levels: int = LEVELS):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.horizon = slots ** levels
+        self.tick = self.ticks(now)
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.count = 0
+
+    def ticks(self, when: float) -> int:
+        return int(when // self.resolution)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, key, due: float):
+        """
+        Arms a timer for `key`. Anything already due goes off on the next
+        `advance`
+        """
+        self.place(key, max(self.ticks(due), self.tick))
+        self.count += 1
+
+    def place(self, key, tick: int):
+        delta = tick - self.tick
+        if delta >= self.horizon:
+            raise ValueError('{0} is too far ahead'.format(key))
+        level = 0
+        while delta >= self.slots ** (level + 1):
+            level += 1
+        slot = (tick // self.slots ** level) % self.slots
+        self.wheels[level][slot].append((key, tick))
+
+    def advance(self, now: float) -> list:
+        """
+        Moves the wheel up to `now` and returns the keys of every timer that
+        went off on the way, in the order they were due
+        """
+        expired = []
+        target = self.ticks(now)
+        while self.tick <= target:
+            # a level's slot comes around when every level below it has gone
+            # around once. Its timers get spread over the levels below,
+            # top down, since they can land in a slot that's coming around
+            # right now too
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self.tick % span:
+                    continue
+                slot = (self.tick // span) % self.slots
+                timers, self.wheels[level][slot] = self.wheels[level][slot], []
+                for key, tick in timers:
+                    self.place(key, tick)
+            slot = self.tick % self.slots
+            expired.extend(key for key, _ in self.wheels[0][slot])
+            self.count -= len(self.wheels[0][slot])
+            self.wheels[0][slot] = []
+            self.tick += 1
+        return expired
+
+
+class Scheduler(object):
+    """
+    Posts what's due in whatever partitions `leases` hands us. Run as many
+    of these as you like, they split the partitions between them like the
+    queue workers do
+    """
+    def __init__(self, db: Database, leases: LeaseManager, controller=None,
+                 user_controller=None, wakeup=None, clock=time.time,
+                 load_ahead: float = LOAD_AHEAD, load_batch: int = LOAD_BATCH,
+                 rescan_interval: float = RESCAN_INTERVAL,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 dispatch_batch: int = DISPATCH_BATCH,
+                 concurrency: int = DISPATCH_CONCURRENCY,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 max_armed: int = MAX_ARMED):
+        self.db = db
+        self.leases = leases
+
+        if controller is None:
+            self.controller = ScheduledPostController(db, clock=clock)
+        else:
+            self.controller = controller
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        self.wakeup = wakeup
+        self.clock = clock
+        self.load_ahead = load_ahead
+        self.load_batch = load_batch
+        self.rescan_interval = rescan_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.dispatch_batch = dispatch_batch
+        self.max_attempts = max_attempts
+        self.max_armed = max_armed
+        self.pool = ThreadPoolExecutor(concurrency)
+        self.partitions = None
+        self.last_heartbeat = None
+        self.notified = False
+        self.reset([])
+
+    def reset(self, partitions: list):
+        """
+        Forgets the wheel and starts over for `partitions`. The first window
+        starts at the beginning of time, so whatever came due while nobody
+        held these partitions goes out right away
+        """
+        now = self.clock()
+        self.partitions = partitions
+        self.wheel = TimerWheel(now)
+        self.armed = set()
+        # posts added while we're loading get picked up by `catch_up`
+        self.last_id = self.controller.max_id()
+        # every pending post up to this (due_at, id) has been read
+        self.loaded = (0.0, 0)
+        self.last_rescan = now
+
+    def arm(self, id: int, due_at: float):
+        if id in self.armed or (due_at, id) > self.loaded:
+            return
+        self.armed.add(id)
+        self.wheel.add(id, due_at)
+
+    def heartbeat(self):
+        partitions = self.leases.heartbeat()
+        if partitions != self.partitions:
+            self.reset(partitions)
+        self.last_heartbeat = self.clock()
+
+    def load(self):
+        """
+        Reads the next part of the window from the index once what's left
+        of the loaded window gets short
+        """
+        now = self.clock()
+        if self.loaded[0] - now >= self.load_ahead / 2:
+            return
+        self.fill(now + self.load_ahead)
+
+    def fill(self, until: float):
+        """
+        Reads pending posts due before `until`, from where the last read
+        left off, for as long as the wheel has room for them
+        """
+        end = (until, 0)
+        while len(self.wheel) < self.max_armed:
+            limit = min(self.load_batch, self.max_armed - len(self.wheel))
+            rows = self.controller.due_between(self.partitions, self.loaded,
+                                               end, limit)
+            # the window moves first, so `arm` takes everything it's handed
+            if len(rows) < limit:
+                self.loaded = end
+            else:
+                self.loaded = (rows[-1][1], rows[-1][0])
+            for id, due_at in rows:
+                self.arm(id, due_at)
+            if len(rows) < limit:
+                break
+
+    def catch_up(self):
+        """
+        Arms whatever got scheduled into the loaded window since we last
+        looked. Posts due later than that get loaded with the rest of the
+        window when we get there
+        """
+        partitions = set(self.partitions)
+        while True:
+            rows = self.controller.added_since(self.last_id, self.load_batch)
+            for id, partition, due_at in rows:
+                if partition in partitions:
+                    self.arm(id, due_at)
+            if rows:
+                self.last_id = max(self.last_id, rows[-1][0])
+            if len(rows) < self.load_batch:
+                break
+
+    def rescan(self):
+        """
+        Ids don't always get committed in the order they're handed out, so
+        `catch_up` can miss a post. Reading the loaded window again finds
+        it. What's pending in there is what's in the wheel already, apart
+        from whatever got missed, so this reads about as many posts as the
+        wheel holds
+        """
+        after = (0.0, 0)
+        while True:
+            rows = self.controller.due_between(self.partitions, after,
+                                               self.loaded, self.load_batch)
+            for id, due_at in rows:
+                self.arm(id, due_at)
+            if len(rows) < self.load_batch:
+                break
+            after = (rows[-1][1], rows[-1][0])
+        self.last_rescan = self.clock()
+
+    def dispatch(self) -> int:
+        due = self.wheel.advance(self.clock())
+        posted = 0
+        for i in range(0, len(due), self.dispatch_batch):
+            posted += self.post_batch(due[i:i + self.dispatch_batch])
+        return posted
+
+    def post_batch(self, ids: list) -> int:
+        """
+        Posts a batch of due posts, every user's in order on a client of
+        their own, and marks the ones that went out as posted in one go.
+        The rest get another go after RETRY_DELAY, except for those of users
+        whose token got revoked, which stay out of the wheel until they log
+        in again (see `ScheduledPostController.due_between`)
+        """
+        by_user = defaultdict(list)
+        for post in self.controller.get_batch(ids):
+            by_user[post.user_id].append(post)
+        pending = set()
+        # the first post of each user we couldn't even get a client for,
+        # which counts as a failed attempt at it
+        failing = []
+        futures = []
+        for user_id, posts in by_user.items():
+            try:
+                user = self.user_controller.get_by_row_id(user_id)
+                mastodon = self.user_controller.get_masto_client(user)
+            except TokenRevoked:
+                continue
+            except Exception:
+                log.exception('no client for user %s', user_id)
+                pending.update(post.id for post in posts)
+                failing.append(posts[0].id)
+                continue
+            pending.update(post.id for post in posts)
+            futures.append((user, self.pool.submit(self.post_all, mastodon,
+                                                   posts)))
+        results = [(user, future.result()) for user, future in futures]
+        queue, owner = self.leases.queue, self.leases.owner
+        posted = [id for _, outcome in results for id in outcome.posted]
+        failed = [id for _, outcome in results for id in outcome.failed]
+        self.controller.mark_posted(posted, queue, owner)
+        self.controller.mark_failed(failed, queue, owner)
+        for user, outcome in results:
+            if outcome.revoked:
+                # their posts stay out of the wheel from now on
+                self.user_controller.set_token_status(user, REVOKED)
+                pending.difference_update(post.id for post in by_user[user.id])
+            elif outcome.failing is not None:
+                failing.append(outcome.failing)
+        for id in failing:
+            if self.controller.retry(id, queue, owner, self.max_attempts):
+                log.error('giving up on scheduled post %s after %d attempts',
+                          id, self.max_attempts)
+                failed.append(id)
+
+        done = set(posted) | set(failed)
+        retry_at = self.clock() + RETRY_DELAY
+        for id in ids:
+            self.armed.discard(id)
+            if id in pending and id not in done:
+                self.armed.add(id)
+                self.wheel.add(id, retry_at)
+        return len(posted)
+
+    def post_all(self, mastodon, posts: list) -> Outcome:
+        """
+        Posts `posts` for one user, in order. Stops at the first post that
+        fails in a way that might work next time, so nothing gets posted
+        ahead of a post that was due before it. The SMS that scheduled a post
+        is its idempotency key, so posting it again after a crash is harmless
+        """
+        posted, failed = [], []
+        for post in posts:
+            try:
+                mastodon.status_post(post.body,
+                                     idempotency_key=post.message_sid)
+            except MastodonUnauthorizedError:
+                log.info('token rejected posting scheduled post %s', post.id)
+                return Outcome(posted, failed, post.id, True)
+            except Exception as e:
+                if rejected(e):
+                    log.warning('scheduled post %s turned down: %s', post.id,
+                                e)
+                    failed.append(post.id)
+                    continue
+                log.exception('failed posting scheduled post %s', post.id)
+                return Outcome(posted, failed, post.id, False)
+            posted.append(post.id)
+        return Outcome(posted, failed, None, False)
+
+    def run_once(self) -> int:
+        now = self.clock()
+        notified, self.notified = self.notified, False
+        if self.last_heartbeat is None or \
+                now - self.last_heartbeat >= self.heartbeat_interval:
+            self.heartbeat()
+            notified = True
+        if notified:
+            self.catch_up()
+        if now - self.last_rescan >= self.rescan_interval:
+            self.rescan()
+        self.load()
+        return self.dispatch()
+
+    def run(self, should_stop=lambda: False, idle_sleep: float = RESOLUTION):
+        self.leases.setup()
+        try:
+            while not should_stop():
+                try:
+                    self.run_once()
+                except Exception:
+                    log.exception('scheduler round failed')
+                self.idle(idle_sleep)
+        finally:
+            self.leases.release_all()
+
+    def idle(self, timeout: float):
+        if self.wakeup is None:
+            time.sleep(timeout)
+        elif self.wakeup.wait(timeout):
+            # somebody scheduled something, which might be due before the
+            # next heartbeat
+            self.notified = True
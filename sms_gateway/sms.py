@@ -0,0 +1,48 @@
+import math
+
+__all__ = ['is_gsm7', 'segment_count', 'segment_capacity']
+
+# Messages that only use characters from the GSM 03.38 alphabet get sent
+# 7 bits per character. Anything else means the whole message gets sent as
+# UCS-2, which fits less than half as many characters in a segment
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# These take an escape character plus the character itself, so they count
+# twice
+GSM7_EXTENDED = frozenset("^{}\\[~]|€\f")
+
+GSM7_SINGLE = 160
+GSM7_MULTI = 153
+UCS2_SINGLE = 70
+UCS2_MULTI = 67
+
+
+def is_gsm7(text: str) -> bool:
+    return all(c in GSM7_BASIC or c in GSM7_EXTENDED for c in text)
+
+
+def encoded_length(text: str) -> int:
+    """
+    Length of `text` in whatever units the carrier will count it in: septets
+    for GSM-7 messages, UTF-16 code units for everything else
+    """
+    if is_gsm7(text):
+        return sum(2 if c in GSM7_EXTENDED else 1 for c in text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def segment_capacity(text: str, multipart: bool = True) -> int:
+    if is_gsm7(text):
+        return GSM7_MULTI if multipart else GSM7_SINGLE
+    return UCS2_MULTI if multipart else UCS2_SINGLE
+
+
+def segment_count(text: str) -> int:
+    """
+    Number of segments Twilio will bill us for when sending `text`
+    """
+    length = encoded_length(text)
+    if length <= segment_capacity(text, multipart=False):
+        return 1
+    return int(math.ceil(length / segment_capacity(text)))
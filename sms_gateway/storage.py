@@ -0,0 +1,292 @@
+"""
+Everything that depends on which database we are talking to lives in here,
+so the rest of the app can stick to SQL that SQLite and PostgreSQL both
+understand.
+
+A backend knows how to connect, how to tell whether a table exists, how to
+turn a migration into its own dialect, how to load a lot of rows at once,
+and how to wake up whoever is waiting on a channel when there is new work
+for them
+"""
+import io
+import re
+import select
+import threading
+from weakref import WeakKeyDictionary, WeakSet
+
+import records
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+
+__all__ = ['Backend', 'SQLiteBackend', 'PostgresBackend', 'Statement',
+           'get_backend', 'backend_for', 'affected']
+
+# Column definitions SQLite reads as "auto-incrementing id"
+SQLITE_ROWID_RE = re.compile(r'\bINTEGER PRIMARY KEY\b', re.IGNORECASE)
+# SQLite's REAL is 8 bytes, PostgreSQL's is 4, which only keeps timestamps to
+# within a couple of minutes
+REAL_RE = re.compile(r'\bREAL\b')
+# Numbered parameters, which both dialects understand as long as SQLite gets
+# them as ?1 instead of $1
+PARAM_RE = re.compile(r'\$(\d+)')
+
+
+class Statement(object):
+    """
+    A query we run often enough that it's worth preparing once and then
+    running straight through the DB-API connection. Parameters are numbered,
+    `$1`, `$2` and so on, and get passed as a tuple
+    """
+    __slots__ = ('name', 'sql', 'params', 'sqlite_sql')
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.params = len(set(PARAM_RE.findall(sql)))
+        self.sqlite_sql = PARAM_RE.sub(r'?\1', sql)
+
+
+class Backend(object):
+    dialect = None
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def connect(self, **kwargs) -> records.Database:
+        return records.Database(self.url, **kwargs)
+
+    def table_exists(self, db: records.Database, table: str) -> bool:
+        raise NotImplementedError
+
+    def translate(self, migration) -> str:
+        """
+        `migration` in this backend's dialect. Migrations are either a
+        single statement both dialects understand, or a dict of statements
+        keyed by dialect for the few things they disagree on
+        """
+        if isinstance(migration, dict):
+            return migration[self.dialect]
+        return migration
+
+    def bulk_load(self, db: records.Database, table: str, columns: list,
+                  rows: list):
+        """
+        Inserts `rows`, each a tuple of values in `columns` order, into
+        `table`
+        """
+        # columns can be quoted, so the parameters get names of their own
+        names = ['p{0}'.format(i) for i in range(len(columns))]
+        db.bulk_query('insert into {0} ({1}) values ({2})'.format(
+            table, ', '.join(columns), ', '.join(':' + n for n in names)),
+            [dict(zip(names, row)) for row in rows])
+
+    def execute(self, db: records.Database, statement: Statement,
+                params: tuple):
+        """
+        Runs `statement` on `db`'s DB-API connection, skipping everything
+        records and SQLAlchemy do per query, and returns the cursor
+        """
+        raise NotImplementedError
+
+    def notify(self, db: records.Database, channel: str):
+        raise NotImplementedError
+
+    def listen(self, channel: str):
+        raise NotImplementedError
+
+
+class InProcessListener(object):
+    """
+    SQLite has no way of telling another connection something happened, so
+    wakeups only reach listeners in the same process. Anyone else finds out
+    the next time their wait times out
+    """
+    channels = {}
+    lock = threading.Lock()
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.event = threading.Event()
+        with self.lock:
+            self.channels.setdefault(channel, WeakSet()).add(self)
+
+    @classmethod
+    def notify(cls, channel: str):
+        with cls.lock:
+            listeners = list(cls.channels.get(channel, ()))
+        for listener in listeners:
+            listener.event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits up to `timeout` seconds for a notification. Anything that
+        arrived since the last wait counts, so nothing sent between checking
+        for work and going to sleep gets lost
+        """
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+    def close(self):
+        with self.lock:
+            self.channels.get(self.channel, set()).discard(self)
+
+
+class SQLiteBackend(Backend):
+    dialect = 'sqlite'
+
+    def table_exists(self, db: records.Database, table: str) -> bool:
+        rows = db.query('''
+        select name from sqlite_master where type = 'table' and name = :table
+        ''', table=table)
+        return rows.first() is not None
+
+    def execute(self, db: records.Database, statement: Statement,
+                params: tuple):
+        # the sqlite3 module keeps compiled statements around per connection,
+        # keyed on the SQL, so running the same text again skips the parsing
+        return db.db.connection.connection.execute(statement.sqlite_sql, params)
+
+    def notify(self, db: records.Database, channel: str):
+        InProcessListener.notify(channel)
+
+    def listen(self, channel: str) -> InProcessListener:
+        return InProcessListener(channel)
+
+
+class PostgresListener(object):
+    """
+    LISTENs on a connection of its own, since the notifications only show up
+    on a connection that isn't in the middle of a transaction
+    """
+    def __init__(self, connect_args: dict, channel: str):
+        import psycopg2
+        from psycopg2.extensions import quote_ident
+        self.conn = psycopg2.connect(**connect_args)
+        self.conn.autocommit = True
+        with self.conn.cursor() as cursor:
+            cursor.execute('LISTEN {0}'.format(quote_ident(channel, self.conn)))
+
+    def drain(self) -> bool:
+        self.conn.poll()
+        notified = bool(self.conn.notifies)
+        del self.conn.notifies[:]
+        return notified
+
+    def wait(self, timeout: float) -> bool:
+        if self.drain():
+            return True
+        if select.select([self.conn], [], [], timeout) == ([], [], []):
+            return False
+        return self.drain()
+
+    def close(self):
+        self.conn.close()
+
+
+def copy_value(value) -> str:
+    # COPY reads an unquoted empty field as NULL and a quoted one as an empty
+    # string, so every string gets quoted
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"{0}"'.format(value.replace('"', '""'))
+    return str(value)
+
+
+class PostgresBackend(Backend):
+    dialect = 'postgresql'
+    # names of the statements prepared on each connection. Prepared
+    # statements last as long as the connection does
+    prepared = WeakKeyDictionary()
+
+    def table_exists(self, db: records.Database, table: str) -> bool:
+        rows = db.query('''
+        select tablename from pg_tables
+        where schemaname = current_schema() and tablename = :table
+        ''', table=table)
+        return rows.first() is not None
+
+    def translate(self, migration) -> str:
+        migration = super().translate(migration)
+        migration = SQLITE_ROWID_RE.sub('SERIAL PRIMARY KEY', migration)
+        return REAL_RE.sub('DOUBLE PRECISION', migration)
+
+    def bulk_load(self, db: records.Database, table: str, columns: list,
+                  rows: list):
+        """
+        COPY is a single round trip no matter how many rows there are, where
+        inserting them goes back and forth once per row
+        """
+        buf = io.BytesIO()
+        for row in rows:
+            buf.write(','.join(copy_value(v) for v in row).encode('utf-8'))
+            buf.write(b'\n')
+        buf.seek(0)
+        with db.transaction():
+            cursor = db.db.connection.cursor()
+            cursor.copy_expert('''
+            COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')
+            '''.format(table, ', '.join(columns)), buf)
+
+    def execute(self, db: records.Database, statement: Statement,
+                params: tuple):
+        conn = db.db.connection.connection
+        cursor = conn.cursor()
+        prepared = self.prepared.setdefault(conn, set())
+        if statement.name not in prepared:
+            cursor.execute('PREPARE {0} AS {1}'.format(statement.name,
+                                                       statement.sql))
+            prepared.add(statement.name)
+        if statement.params:
+            cursor.execute('EXECUTE {0} ({1})'.format(
+                statement.name, ', '.join(['%s'] * statement.params)), params)
+        else:
+            cursor.execute('EXECUTE {0}'.format(statement.name))
+        if not db.db.in_transaction():
+            # psycopg2 began a transaction for this, which would otherwise
+            # sit open holding on to its snapshot (and holding up vacuum)
+            # until whatever runs next on the connection. The cursor has all
+            # the rows already, and the prepared statement outlives the
+            # transaction
+            conn.commit()
+        return cursor
+
+    def notify(self, db: records.Database, channel: str):
+        # notifications go out on commit, and records only commits on its
+        # own after inserts, updates and the like
+        with db.transaction():
+            db.query('select pg_notify(:channel, :payload)', channel=channel,
+                     payload='')
+
+    def listen(self, channel: str) -> PostgresListener:
+        url = make_url(self.url)
+        return PostgresListener(url.translate_connect_args(username='user',
+                                                           database='dbname'),
+                                channel)
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgres': PostgresBackend,
+    'postgresql': PostgresBackend,
+}
+
+
+def get_backend(url: str) -> Backend:
+    scheme = make_url(url).drivername.split('+')[0]
+    if scheme not in BACKENDS:
+        raise ValueError('no storage backend for {0}'.format(scheme))
+    return BACKENDS[scheme](url)
+
+
+def backend_for(db: records.Database) -> Backend:
+    return get_backend(db.db_url)
+
+
+def affected(db: records.Database, query: str, **params) -> int:
+    """
+    Runs `query` the way `db.query` would and returns how many rows it
+    changed, which records doesn't tell us
+    """
+    return db.db.execute(text(query), **params).rowcount
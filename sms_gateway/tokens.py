@@ -0,0 +1,121 @@
+"""
+Finds out which users have revoked our access on their instance before an
+SMS of theirs does.
+
+A sweep goes through every stored token, a batch at a time, oldest check
+first, and asks each token's instance whether it still takes it. Only a few
+tokens per instance get checked at once and per batch, so a big instance
+sees a trickle of checks spread over the whole sweep instead of all of them
+at once. What the instances say gets saved a batch at a time, and from then
+on `UserController.get_masto_client` and the SMS webhook skip the users
+whose tokens are dead
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from records import Database
+
+from sms_gateway.controllers.user import UserController
+from sms_gateway.models.user import VALID, REVOKED
+
+__all__ = ['TokenSweeper']
+
+log = logging.getLogger(__name__)
+
+# Every token gets checked about once in this long
+SWEEP_INTERVAL = 24 * 3600
+# A batch is at most this many tokens, at most this many of them from the
+# same instance, with at most this many checks in flight per instance and
+# this many altogether. Batches are this many seconds apart, which comes to
+# at most 2.5 checks a second for any one instance
+BATCH_SIZE = 200
+PER_INSTANCE_BATCH = 25
+PER_INSTANCE_CONCURRENCY = 2
+MAX_CONCURRENT = 16
+BATCH_INTERVAL = 10
+TIMEOUT = 10
+
+
+class TokenSweeper(object):
+    def __init__(self, db: Database, user_controller=None, session=None,
+                 clock=time.time, sweep_interval: float = SWEEP_INTERVAL,
+                 batch_size: int = BATCH_SIZE,
+                 per_instance_batch: int = PER_INSTANCE_BATCH,
+                 per_instance_concurrency: int = PER_INSTANCE_CONCURRENCY,
+                 max_concurrent: int = MAX_CONCURRENT,
+                 timeout: float = TIMEOUT):
+        self.db = db
+
+        if user_controller is None:
+            self.user_controller = UserController(db)
+        else:
+            self.user_controller = user_controller
+
+        if session is None:
+            self.session = requests.Session()
+        else:
+            self.session = session
+
+        self.clock = clock
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self.per_instance_batch = per_instance_batch
+        self.per_instance_concurrency = per_instance_concurrency
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_concurrent)
+        self.limits = defaultdict(
+            lambda: threading.BoundedSemaphore(self.per_instance_concurrency))
+
+    def check(self, domain: str, auth_token: str) -> str:
+        """
+        VALID or REVOKED, or None if the instance didn't give us a straight
+        answer. Instances answer 401 to tokens they don't know (anymore)
+        """
+        url = self.user_controller.get_api_base_url(domain) + \
+            '/api/v1/accounts/verify_credentials'
+        with self.limits[domain]:
+            try:
+                response = self.session.get(
+                    url, headers={'Authorization': 'Bearer ' + auth_token},
+                    timeout=self.timeout)
+            except requests.RequestException:
+                log.warning('could not check a token on %s', domain)
+                return None
+        if response.status_code == 401:
+            return REVOKED
+        if response.ok:
+            return VALID
+        return None
+
+    def sweep_batch(self) -> int:
+        """
+        Checks the next batch of tokens and saves what the instances said.
+        Returns how many were checked
+        """
+        now = self.clock()
+        batch = self.user_controller.tokens_to_check(
+            now - self.sweep_interval, self.batch_size,
+            self.per_instance_batch)
+        futures = [(id, auth_token,
+                    self.pool.submit(self.check, domain, auth_token))
+                   for id, auth_token, domain in batch]
+        checks = [(id, auth_token, future.result(), now)
+                  for id, auth_token, future in futures]
+        self.user_controller.save_token_checks(checks)
+        revoked = sum(1 for check in checks if check[2] == REVOKED)
+        if revoked:
+            log.info('%d of %d tokens revoked', revoked, len(checks))
+        return len(checks)
+
+    def run(self, should_stop=lambda: False,
+            batch_interval: float = BATCH_INTERVAL):
+        while not should_stop():
+            try:
+                self.sweep_batch()
+            except Exception:
+                log.exception('token sweep failed')
+            time.sleep(batch_interval)
@@ -0,0 +1,341 @@
+"""
+Keeps track of how much SMS every user sends and receives, and stops anyone
+from going over their instance's quota.
+
+Nothing in here talks to the database while a message is being handled:
+quotas are token buckets in memory, usage is counted in memory, and both get
+squared up with the database in the background every so often. To not lose
+counts when a process dies between flushes, everything counted also gets
+appended to a log on local disk, which is replayed the next time the meter
+starts up
+"""
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+from uuid import uuid4
+
+__all__ = ['UsageMeter', 'UsageLog', 'TokenBucket', 'Counts', 'usage_meter',
+           'log_dir', 'INBOUND', 'OUTBOUND']
+
+log = logging.getLogger(__name__)
+
+INBOUND = 'inbound'
+OUTBOUND = 'outbound'
+
+# Quotas are in segments, since that's what we pay for. A domain without
+# limits of its own gets these: a burst of 30 segments, refilling at 120 an
+# hour
+DEFAULT_BURST = 30
+DEFAULT_PER_HOUR = 120
+# How often counts get written to the database and limits get reloaded
+FLUSH_INTERVAL = 10
+# How long we remember which batches were saved, and how often we forget
+# the ones older than that. Logs left behind by a dead process get replayed
+# when the next process starts, which had better be sooner than this
+FLUSH_RETENTION = 7 * 24 * 3600
+PRUNE_INTERVAL = 3600
+# Where every process keeps its log of what it counted since its last flush
+DEFAULT_LOG_DIR = '/tmp/mastotwilio-usage'
+
+
+def log_dir() -> str:
+    return os.environ.get('USAGE_LOG_DIR', DEFAULT_LOG_DIR)
+
+
+def day(when: float) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(when))
+
+
+class TokenBucket(object):
+    __slots__ = ('domain_id', 'tokens', 'updated')
+
+    def __init__(self, domain_id: int, tokens: float, updated: float):
+        self.domain_id = domain_id
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, now: float, burst: int, per_hour: int):
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(burst, self.tokens + elapsed * per_hour / 3600.0)
+        self.updated = now
+
+    def take(self, amount: int) -> bool:
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class Counts(object):
+    __slots__ = ('domain_id', 'inbound_messages', 'inbound_segments',
+                 'outbound_messages', 'outbound_segments', 'throttled')
+
+    def __init__(self, domain_id: int):
+        self.domain_id = domain_id
+        self.inbound_messages = 0
+        self.inbound_segments = 0
+        self.outbound_messages = 0
+        self.outbound_segments = 0
+        self.throttled = 0
+
+    def add(self, direction: str, segments: int, allowed: bool):
+        if not allowed:
+            self.throttled += 1
+        elif direction == INBOUND:
+            self.inbound_messages += 1
+            self.inbound_segments += segments
+        else:
+            self.outbound_messages += 1
+            self.outbound_segments += segments
+
+
+def count(counts: dict, when: str, user_id: int, domain_id: int,
+          direction: str, segments: int, allowed: bool):
+    key = (user_id, when)
+    c = counts.get(key, None)
+    if c is None:
+        c = counts[key] = Counts(domain_id)
+    c.add(direction, segments, allowed)
+
+
+class UsageLog(object):
+    """
+    An append-only log of everything counted, split into segments. Every
+    flush closes the current segment and starts a new one, and a segment
+    only gets deleted once its counts are in the database.
+
+    The segment a process is writing to is locked, so whatever is left
+    unlocked in the directory belongs to a process that is gone
+    """
+    def __init__(self, directory: str = DEFAULT_LOG_DIR):
+        self.directory = directory
+        self.file = None
+        self.name = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, 'usage-{0}.log'.format(name))
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.name = uuid4().hex
+        path = self.path(self.name)
+        # line buffered, so every count is with the OS as soon as it's made.
+        # The segment only gets its real name once it's locked, so nobody
+        # looking for orphans can mistake it for one
+        self.file = open(path + '.new', 'a', buffering=1)
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(path + '.new', path)
+
+    def append(self, *fields):
+        if self.file is None:
+            self.open()
+        self.file.write('\t'.join(str(f) for f in fields) + '\n')
+
+    def rotate(self) -> str:
+        """
+        Closes the current segment and returns its name, or None if nothing
+        was written to it
+        """
+        if self.file is None:
+            return None
+        name = self.name
+        self.file.close()
+        self.file = None
+        self.name = None
+        return name
+
+    def orphans(self) -> list:
+        """
+        Names of the segments nobody is writing to anymore
+        """
+        names = []
+        for path in glob.glob(self.path('*')):
+            with open(path) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            names.append(os.path.basename(path)[len('usage-'):-len('.log')])
+        return names
+
+    def read(self, name: str) -> dict:
+        counts = {}
+        with open(self.path(name)) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # a process dying halfway through a write leaves a partial
+                # last line
+                if len(fields) != 6:
+                    continue
+                when, user_id, domain_id, direction, segments, allowed = fields
+                count(counts, when, int(user_id), int(domain_id), direction,
+                      int(segments), allowed == '1')
+        return counts
+
+    def remove(self, name: str):
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            # nothing was logged to it, or another process recovering
+            # orphans got to it first
+            pass
+
+
+class UsageMeter(object):
+    """
+    Token buckets and usage counters for every user we've seen lately. One
+    of these lives in every process that handles SMS, so quotas are enforced
+    per process.
+
+    `consume` is the only thing the SMS paths call. `flush` takes a
+    UsageController and gets called in the background, see `poll` and
+    `start`
+    """
+    def __init__(self, usage_log: UsageLog = None,
+                 default_burst: int = DEFAULT_BURST,
+                 default_per_hour: int = DEFAULT_PER_HOUR,
+                 flush_interval: float = FLUSH_INTERVAL, clock=time.time):
+        self.log = usage_log
+        self.default_burst = default_burst
+        self.default_per_hour = default_per_hour
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.limits = {}
+        self.buckets = {}
+        self.counts = {}
+        self.last_flush = clock()
+        self.last_prune = 0
+        self.recovered = False
+        self.unsaved = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def open_log(self, directory: str):
+        """
+        Starts logging counts to `directory`. Only the first call does
+        anything, swapping logs would leave what was logged to the old one to
+        be counted again
+        """
+        with self.lock:
+            if self.log is None:
+                self.log = UsageLog(directory)
+
+    def limit(self, domain_id: int) -> (int, int):
+        burst, per_hour = self.limits.get(domain_id, (None, None))
+        if burst is None:
+            burst = self.default_burst
+        if per_hour is None:
+            per_hour = self.default_per_hour
+        return burst, per_hour
+
+    def consume(self, user_id: int, domain_id: int, direction: str,
+                segments: int) -> bool:
+        """
+        Takes `segments` out of the user's bucket and counts them. Returns
+        False, and takes nothing, if that would put the user over quota
+        """
+        now = self.clock()
+        burst, per_hour = self.limit(domain_id)
+        with self.lock:
+            bucket = self.buckets.get(user_id, None)
+            if bucket is None:
+                bucket = self.buckets[user_id] = TokenBucket(domain_id, burst,
+                                                             now)
+            bucket.refill(now, burst, per_hour)
+            # a message longer than the whole burst still goes out, it just
+            # has to wait for a full bucket
+            allowed = bucket.take(min(segments, burst))
+            when = day(now)
+            count(self.counts, when, user_id, domain_id, direction, segments,
+                  allowed)
+            if self.log is not None:
+                self.log.append(when, user_id, domain_id, direction, segments,
+                                int(allowed))
+        return allowed
+
+    def take(self) -> (str, dict):
+        """
+        Everything counted since the last flush, along with the name of the
+        log segment it was logged in
+        """
+        now = self.clock()
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            name = self.log.rotate() if self.log is not None else None
+            # a full bucket is the same as no bucket, so only keep the ones
+            # that still remember something
+            for user_id, bucket in list(self.buckets.items()):
+                burst, per_hour = self.limit(bucket.domain_id)
+                bucket.refill(now, burst, per_hour)
+                if bucket.tokens >= burst:
+                    del self.buckets[user_id]
+        return name or uuid4().hex, counts
+
+    def flush(self, controller):
+        """
+        Saves everything counted since the last flush and reloads the
+        limits. If saving fails, what didn't make it gets another go next
+        time
+        """
+        with self.flush_lock:
+            if not self.recovered:
+                self.recover(controller)
+            self.unsaved.append(self.take())
+            while self.unsaved:
+                name, counts = self.unsaved[0]
+                if counts:
+                    controller.save(name, counts)
+                if self.log is not None:
+                    self.log.remove(name)
+                self.unsaved.pop(0)
+            self.limits = controller.get_limits()
+            self.last_flush = self.clock()
+            if self.last_flush - self.last_prune >= PRUNE_INTERVAL:
+                controller.prune(FLUSH_RETENTION)
+                self.last_prune = self.last_flush
+
+    def recover(self, controller):
+        """
+        Saves whatever processes that died before flushing left behind.
+        Segments that made it into the database before the process died only
+        get saved once
+        """
+        if self.log is not None:
+            for name in self.log.orphans():
+                controller.save(name, self.log.read(name))
+                self.log.remove(name)
+        self.recovered = True
+
+    def poll(self, get_controller):
+        if self.clock() - self.last_flush >= self.flush_interval:
+            self.flush(get_controller())
+
+    def start(self, get_controller):
+        """
+        Flushes every `flush_interval` seconds on a thread of its own, with
+        its own database connection
+        """
+        def run():
+            controller = get_controller()
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush(controller)
+                except Exception:
+                    log.exception('failed flushing usage')
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self.lock:
+            self.limits = {}
+            self.buckets = {}
+            self.counts = {}
+            self.unsaved = []
+
+
+usage_meter = UsageMeter()
@@ -1,23 +1,34 @@
-import records
 from urllib.parse import urlparse, urljoin
 
-__all__ = ['get_db', 'is_safe_url']
+from sms_gateway.storage import get_backend
 
-# For now we are using SQLite for development, but we should be able to switch
-# to postgres or something else fairly easily since we aren't doing any crazy
-# SQL stuff (not that sqlite can DO much crazy SQL stuff)
+__all__ = ['get_db', 'get_twilio', 'is_safe_url']
+
+# SQLite for development. Point DATABASE_URL at a postgresql:// database for
+# anything real; see sms_gateway.storage for what differs between the two
 DEFAULT_DATABASE_URL = "sqlite:////tmp/mastotwilio.db"
 
 
 def get_db():
     """
     Since we've defined all our routes in this module, this provides us with an
-    easy way to get a database connection. This will have to be refactored when
-    we move to postgres, most likely
+    easy way to get a database connection, for whichever database
+    DATABASE_URL points at
     """
     import os
     connstr = os.environ.get("DATABASE_URL", DEFAULT_DATABASE_URL)
-    return records.Database(connstr)
+    return get_backend(connstr).connect()
+
+
+def get_twilio():
+    """
+    A Twilio client for sending messages, using the account credentials from
+    the environment
+    """
+    import os
+    from twilio.rest import Client
+    return Client(os.environ.get('TWILIO_ACCOUNT_SID', None),
+                  os.environ.get('TWILIO_AUTH_TOKEN', None))
 
 
 def is_safe_url(target, host_url):
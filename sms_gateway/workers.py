@@ -0,0 +1,94 @@
+from records import Database
+
+from sms_gateway.controllers.inbound import InboundController, POSTED, \
+        CHANNEL as INBOUND_CHANNEL
+from sms_gateway.controllers.outbound import OutboundController, SENT, \
+        CHANNEL as OUTBOUND_CHANNEL
+from sms_gateway.controllers.profile import ProfileController
+from sms_gateway.controllers.scheduled import CHANNEL as SCHEDULED_CHANNEL
+from sms_gateway.controllers.usage import UsageController
+from sms_gateway.models.inbound import InboundMessage
+from sms_gateway.models.outbound import OutboundMessage
+from sms_gateway.notifications import NotificationSource
+from sms_gateway.profiler import ProfilingAgent
+from sms_gateway.queue import LeaseManager, QueueWorker
+from sms_gateway.scheduler import Scheduler
+from sms_gateway.tokens import TokenSweeper
+from sms_gateway.storage import backend_for
+from sms_gateway.usage import usage_meter, log_dir
+
+__all__ = ['inbound_worker', 'outbound_worker', 'notification_source',
+           'scheduler', 'token_sweeper', 'WORKERS']
+
+
+def profiling_hook(db: Database, role: str):
+    """
+    Lets the worker join profiling sessions started from /admin/profile
+    """
+    agent = ProfilingAgent(role)
+    return lambda: agent.poll(lambda: ProfileController(db))
+
+
+def usage_hook(db: Database):
+    """
+    Writes the usage this worker counted to the database every so often
+    """
+    usage_meter.open_log(log_dir())
+    return lambda: usage_meter.poll(lambda: UsageController(db))
+
+
+def inbound_worker(db: Database, **kwargs) -> QueueWorker:
+    """
+    Posts queued inbound SMS to mastodon
+    """
+    controller = InboundController(db)
+    return QueueWorker(db, 'inbound_messages',
+                       lambda row: controller.post(InboundMessage.fromrecord(row)),
+                       LeaseManager(db, 'inbound', **kwargs), done_status=POSTED,
+                       hooks=[profiling_hook(db, 'inbound')],
+                       wakeup=backend_for(db).listen(INBOUND_CHANNEL))
+
+
+def outbound_worker(db: Database, **kwargs) -> QueueWorker:
+    """
+    Sends queued outbound SMS through Twilio
+    """
+    controller = OutboundController(db)
+    return QueueWorker(db, 'outbound_messages',
+                       lambda row: controller.send(OutboundMessage.fromrecord(row)),
+                       LeaseManager(db, 'outbound', **kwargs), done_status=SENT,
+                       hooks=[profiling_hook(db, 'outbound'), usage_hook(db)],
+                       wakeup=backend_for(db).listen(OUTBOUND_CHANNEL))
+
+
+def scheduler(db: Database, **kwargs) -> Scheduler:
+    """
+    Posts scheduled toots when they're due
+    """
+    return Scheduler(db, LeaseManager(db, 'scheduled', **kwargs),
+                     wakeup=backend_for(db).listen(SCHEDULED_CHANNEL))
+
+
+def token_sweeper(db: Database) -> TokenSweeper:
+    """
+    Checks every user's token every so often. One of these is plenty
+    """
+    return TokenSweeper(db)
+
+
+def notification_source(db: Database) -> NotificationSource:
+    """
+    Streams notifications for every user with a phone number and queues the
+    digests for the outbound worker. Who that is gets looked up again every
+    so often, see `NotificationSource.refresh`
+    """
+    return NotificationSource(db)
+
+
+WORKERS = {
+    'inbound': inbound_worker,
+    'outbound': outbound_worker,
+    'notifications': notification_source,
+    'scheduler': scheduler,
+    'tokens': token_sweeper,
+}
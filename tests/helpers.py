@@ -1,17 +1,24 @@
+import os
+
 import records
 import pytest
 from uuid import uuid4
 
+from sms_gateway.cache import authorize_urls, recent_message_sids
+from sms_gateway.controllers.account import account_cache, prewarmed_users
 from sms_gateway.controllers.domain import DomainController, CouldNotConnect, \
         DomainDoesntExist
 from sms_gateway.controllers.user import UserController, UserNotFound, \
         UserExists
 from sms_gateway.controllers.oauth_session import OAuthSessionController
 from sms_gateway.migrations import migrate, unmigrate
+from sms_gateway.usage import usage_meter
 from sms_gateway.models.user import User
 from sms_gateway.models.domain import Domain
 
-db = records.Database('sqlite:///:memory:')
+# Set TEST_DATABASE_URL to run the tests against something other than an
+# in-memory SQLite database, like a local PostgreSQL
+db = records.Database(os.environ.get('TEST_DATABASE_URL', 'sqlite:///:memory:'))
 
 @pytest.fixture
 def domain_controller():
@@ -26,6 +33,11 @@ def db_setup(request):
     migrate(db)
     def db_teardown():
         unmigrate(db)
+        authorize_urls.clear()
+        recent_message_sids.clear()
+        account_cache.clear()
+        prewarmed_users.clear()
+        usage_meter.clear()
     request.addfinalizer(db_teardown)
     return db
 
@@ -37,7 +49,7 @@ def single_user(db_setup):
         VALUES (:domain, :client_id, :client_secret)
     ''', domain='my.domain', client_id='01234', client_secret='5678')
     db.query('''
-        INSERT INTO users (uuid, user, auth_token, domain_id)
+        INSERT INTO users (uuid, "user", auth_token, domain_id)
         VALUES (:uuid, :user, :auth_token, :domain_id)
     ''', uuid=uuid, user='foo', auth_token='efgh', domain_id='1')
     return uuid
@@ -48,7 +60,7 @@ def single_oauth_session(db_setup):
     user = 'foo'
     domain = 'my.domain'
     db.query('''
-        INSERT INTO oauth_session (uuid, user, domain)
+        INSERT INTO oauth_session (uuid, "user", domain)
         VALUES (:uuid, :user, :domain)
     ''', uuid=uuid, user=user, domain=domain)
     return uuid
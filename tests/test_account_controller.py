@@ -0,0 +1,126 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from sms_gateway.cache import RecentIds, TTLCache, SingleFlight
+from sms_gateway.controllers.account import AccountController, NEGATIVE_TTL
+from sms_gateway.controllers.user import UserController
+
+from tests.helpers import db, db_setup, single_user
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def account(id, acct):
+    return {'id': id, 'acct': acct}
+
+def client(following=(), found=()):
+    mastodon = Mock(name='mastodon')
+    mastodon.account_verify_credentials = Mock(return_value={'id': '1'})
+    mastodon.account_following = Mock(return_value=list(following))
+    mastodon.fetch_next = Mock(return_value=None)
+    mastodon.search = Mock(return_value={'accounts': list(found)})
+    return mastodon
+
+def controller(clock=None):
+    clock = clock or Clock()
+    return AccountController(db, cache=TTLCache(3600, clock=clock),
+                             flights=SingleFlight(),
+                             prewarmed=RecentIds(window=3600, clock=clock))
+
+def get_user(single_user):
+    return UserController(db).get_by_id(single_user)
+
+def test_normalize():
+    c = controller()
+    assert c.normalize('@Alice@Example.Social', 'my.domain') == 'alice@example.social'
+    assert c.normalize('bob', 'my.domain') == 'bob@my.domain'
+    with pytest.raises(ValueError):
+        c.normalize('a@b@c', 'my.domain')
+
+def test_resolve_caches_hits(single_user):
+    c = controller()
+    user = get_user(single_user)
+    mastodon = client(found=[account('7', 'Alice@example.social'),
+                             account('8', 'alice')])
+    assert c.resolve(user, mastodon, 'alice@example.social') == '7'
+    assert c.resolve(user, mastodon, '@ALICE@example.social') == '7'
+    # the other search result is somebody on the user's own instance
+    assert c.resolve(user, mastodon, 'alice') == '8'
+    assert mastodon.search.call_count == 1
+    mastodon.search.assert_called_once_with('alice@example.social',
+                                            resolve=True,
+                                            result_type='accounts')
+
+def test_resolve_caches_misses_for_a_while(single_user):
+    clock = Clock()
+    c = controller(clock)
+    user = get_user(single_user)
+    mastodon = client()
+    assert c.resolve(user, mastodon, 'nobody@example.social') is None
+    assert c.resolve(user, mastodon, 'nobody@example.social') is None
+    assert mastodon.search.call_count == 1
+    clock.now = NEGATIVE_TTL
+    mastodon.search = Mock(return_value={'accounts': [
+        account('9', 'nobody@example.social')]})
+    assert c.resolve(user, mastodon, 'nobody@example.social') == '9'
+
+def test_resolve_prewarms_from_follows(single_user):
+    c = controller()
+    user = get_user(single_user)
+    mastodon = client(following=[account('3', 'bob@other.instance'),
+                                 account('4', 'carol')])
+    assert c.resolve(user, mastodon, 'bob@other.instance') == '3'
+    assert c.resolve(user, mastodon, 'carol@my.domain') == '4'
+    assert not mastodon.search.called
+    # following is only loaded once, no matter how many misses
+    assert c.resolve(user, mastodon, 'dave@other.instance') is None
+    assert c.resolve(user, mastodon, 'erin@other.instance') is None
+    assert mastodon.account_following.call_count == 1
+    assert mastodon.search.call_count == 2
+
+def test_prewarm_follows_pages():
+    c = controller()
+    user = Mock(id=1)
+    mastodon = client(following=[account('3', 'bob@other.instance')])
+    mastodon.fetch_next = Mock(side_effect=[[account('4', 'carol')], []])
+    assert c.prewarm(user, mastodon, 'my.domain') == 2
+    assert c.cache.get(('my.domain', 'carol@my.domain')) == '4'
+
+def test_resolve_coalesces_concurrent_lookups(single_user):
+    c = controller()
+    user = get_user(single_user)
+    c.prewarmed.add(user.id)
+    started = threading.Event()
+    release = threading.Event()
+
+    def search(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return {'accounts': [account('7', 'alice@example.social')]}
+    mastodon = client()
+    mastodon.search = Mock(side_effect=search)
+    # lookups on other threads can't use the sqlite connection, so the domain
+    # comes from a stand-in
+    c.user_controller = Mock(extract_user_domain=c.user_controller.extract_user_domain)
+    c.user_controller.get_domain = Mock(return_value=Mock(domain='my.domain'))
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        c.resolve(user, mastodon, 'alice@example.social'))) for _ in range(5)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # give the followers a moment to get in line behind the first lookup
+    threading.Event().wait(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['7'] * 5
+    assert mastodon.search.call_count == 1
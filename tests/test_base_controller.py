@@ -13,3 +13,9 @@ def test_getstats():
     controller = BaseController()
     with pytest.raises(NotImplementedError):
         controller.getstats()
+
+def test_get_api_base_url(monkeypatch):
+    controller = BaseController()
+    assert controller.get_api_base_url('my.domain') == 'https://my.domain'
+    monkeypatch.setenv('MASTODON_SCHEME', 'http')
+    assert controller.get_api_base_url('my.domain') == 'http://my.domain'
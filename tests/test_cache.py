@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from sms_gateway.cache import TTLCache, SingleFlight
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_ttl_cache_expires():
+    clock = Clock()
+    cache = TTLCache(10, clock=clock)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    cache.set('b', 2, ttl=20)
+    clock.now = 29
+    assert cache.get('b') == 2
+
+def test_ttl_cache_maxsize():
+    cache = TTLCache(10, maxsize=2, clock=Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2 and cache.get('c') == 3
+
+def test_single_flight_collapses_concurrent_calls():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('k', fn)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flights.do('k', fn)))
+                 for _ in range(3)]
+    for t in followers:
+        t.start()
+    release.set()
+    for t in [leader] + followers:
+        t.join(5)
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    # once the flight is over the next call goes through again
+    release.set()
+    flights.do('k', fn)
+    assert len(calls) == 2
+
+def test_single_flight_propagates_errors():
+    flights = SingleFlight()
+    def fn():
+        raise RuntimeError
+    with pytest.raises(RuntimeError):
+        flights.do('k', fn)
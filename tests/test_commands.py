@@ -0,0 +1,40 @@
+from sms_gateway.commands import Command, parse, describe_delay
+
+def test_parse_timeline_commands():
+    assert parse('TL') == Command(name='TL', args=dict(older=False))
+    assert parse('  mentions ') == Command(name='MENTIONS', args=dict(older=False))
+    assert parse('tl more') == Command(name='TL', args=dict(older=True))
+
+def test_parse_plain_toots():
+    assert parse('hello there') is None
+    assert parse('TL;DR it was good') is None
+    assert parse('tl the rest of this is a toot') is None
+    assert parse('') is None
+    assert parse(None) is None
+
+def test_parse_direct_and_follow():
+    assert parse('d @alice@example.social see you at 8') == Command(
+        name='D', args=dict(handle='alice@example.social', text='see you at 8'))
+    assert parse('FOLLOW @bob@other.instance') == Command(
+        name='FOLLOW', args=dict(handle='bob@other.instance'))
+    assert parse('follow @bob') == Command(name='FOLLOW', args=dict(handle='bob'))
+
+def test_parse_direct_and_follow_need_a_handle():
+    assert parse('D is for dog') is None
+    assert parse('d @alice') is None
+    assert parse('follow the money') is None
+    assert parse('follow @bob and @carol') is None
+    assert parse('follow @') is None
+
+def test_parse_later():
+    assert parse('LATER 2h see you all there') == Command(
+        name='LATER', args=dict(delay=7200, text='see you all there'))
+    assert parse('later 1d12h x').args['delay'] == 36 * 3600
+    assert parse('later 90M x').args['delay'] == 5400
+    assert describe_delay(5400) == '1h30m'
+
+def test_parse_later_needs_a_delay_and_text():
+    assert parse('later tonight at the pub') is None
+    assert parse('later 2h') is None
+    assert parse('later 0m hi') is None
+    assert parse('later 31d hi') is None
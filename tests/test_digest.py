@@ -0,0 +1,77 @@
+from sms_gateway.digest import Coalescer, pack, render_notification
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def notification(kind, acct='bar@other.domain', content=None):
+    n = {'type': kind, 'account': {'acct': acct}}
+    if content is not None:
+        n['status'] = {'content': content}
+    return n
+
+def test_render_mention_strips_html():
+    n = notification('mention', content='<p>hi <a href="#">@foo</a> &amp; you</p>')
+    assert render_notification(n) == '@bar@other.domain: hi @foo & you'
+
+def test_counts_are_merged():
+    clock = Clock()
+    c = Coalescer(default_interval=60, clock=clock)
+    for _ in range(3):
+        assert c.add(1, notification('favourite')) == []
+    c.add(1, notification('reblog'))
+    c.add(1, notification('follow'))
+    assert c.due() == []
+    clock.now = 60
+    digests = c.due()
+    assert len(digests) == 1
+    assert digests[0].user_id == 1
+    assert digests[0].body == '3 favs, 1 boost, 1 new follower'
+    assert digests[0].segments == 1
+    assert c.due() == []
+
+def test_per_user_interval():
+    clock = Clock()
+    c = Coalescer(default_interval=60, clock=clock)
+    c.add(1, notification('favourite'), interval=10)
+    c.add(2, notification('favourite'))
+    clock.now = 10
+    assert [d.user_id for d in c.due()] == [1]
+    clock.now = 60
+    assert [d.user_id for d in c.due()] == [2]
+
+def test_zero_interval_sends_immediately():
+    c = Coalescer(clock=Clock())
+    digests = c.add(1, notification('favourite'), interval=0)
+    assert [d.body for d in digests] == ['1 fav']
+
+def test_size_window():
+    clock = Clock()
+    c = Coalescer(default_interval=60, max_pending=2, clock=clock)
+    assert c.add(1, notification('favourite')) == []
+    digests = c.add(1, notification('favourite'))
+    assert [d.body for d in digests] == ['2 favs']
+    # the stale deadline from the flushed window doesn't send anything
+    clock.now = 60
+    assert c.due() == []
+
+def test_flush():
+    c = Coalescer(clock=Clock())
+    c.add(1, notification('mention', content='hi'))
+    c.add(2, notification('follow'))
+    bodies = sorted(d.body for d in c.flush())
+    assert bodies == ['1 new follower', '@bar@other.domain: hi']
+    assert c.flush() == []
+
+def test_pack_respects_max_segments():
+    lines = ['a' * 150] * 4
+    messages = pack(lines, max_segments=2)
+    assert len(messages) == 2
+    assert messages[0] == '\n'.join(['a' * 150] * 2)
+
+def test_pack_keeps_ucs2_apart():
+    messages = pack(['hello', '🐘', 'there'])
+    assert messages == ['hello\nthere', '🐘']
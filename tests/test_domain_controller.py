@@ -45,3 +45,12 @@ def test_getstats(domain_controller, single_domain):
     stats = domain_controller.getstats()
     assert stats['count'] == 1
     assert stats['domains'][0] is not None
+
+def test_insert_new_domain_invalidates_authorize_urls(domain_controller, db_setup):
+    domain_controller.authorize_urls.set('my.domain',
+            'http://example.com/redirect', 'https://my.domain/oauth/authorize')
+    domain_controller.mastodon.create_app = Mock(name='create_app',
+            return_value=('abcd', 'efgh'))
+    domain_controller.insert_new_domain('my.domain', 'http://example.com')
+    assert domain_controller.authorize_urls.get('my.domain',
+            'http://example.com/redirect') is None
@@ -0,0 +1,173 @@
+from unittest.mock import Mock
+
+from sms_gateway.cache import RecentIds, TTLCache, SingleFlight
+from sms_gateway.commands import parse
+from sms_gateway.controllers.inbound import InboundController, TOO_LONG
+from sms_gateway.controllers.timeline import TimelineController
+from sms_gateway.controllers.user import UserController
+
+from tests.helpers import db, db_setup, single_user
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def get_user(single_user):
+    return UserController(db).get_by_id(single_user)
+
+def test_receive(single_user):
+    controller = InboundController(db, recent_ids=RecentIds())
+    assert controller.receive('SM1', get_user(single_user), 'hello')
+    message = controller.get('SM1')
+    assert message.body == 'hello'
+    assert message.status == 'pending'
+
+def test_receive_duplicate_fast_path(single_user):
+    controller = InboundController(db, recent_ids=RecentIds())
+    user = get_user(single_user)
+    assert controller.receive('SM1', user, 'hello')
+    controller.db = Mock(name='db')
+    assert not controller.receive('SM1', user, 'hello')
+    assert not controller.db.query.called
+
+def test_receive_duplicate_unique_index(single_user):
+    user = get_user(single_user)
+    assert InboundController(db, recent_ids=RecentIds()).receive('SM1', user, 'hello')
+    # a different worker that hasn't seen the sid yet
+    controller = InboundController(db, recent_ids=RecentIds())
+    assert not controller.receive('SM1', user, 'hello')
+    assert 'SM1' in controller.recent_ids
+    assert controller.getstats() == {'pending': 1}
+
+def test_recent_ids_window_and_size():
+    clock = Clock()
+    ids = RecentIds(maxsize=2, window=10, clock=clock)
+    ids.add('a')
+    ids.add('b')
+    ids.add('c')
+    assert 'a' not in ids
+    assert 'b' in ids and 'c' in ids
+    clock.now = 10
+    assert 'c' not in ids
+
+def test_process_pending_uses_idempotency_key(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    user_controller.get_masto_client = Mock(return_value=client)
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds())
+    controller.receive('SM1', get_user(single_user), 'hello')
+    assert controller.process_pending() == 1
+    client.status_post.assert_called_once_with('hello', idempotency_key='SM1')
+    assert controller.get('SM1').status == 'posted'
+    assert controller.process_pending() == 0
+
+def test_process_command_replies_by_sms(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    user_controller.get_masto_client = Mock(return_value=client)
+    timeline_controller = Mock(name='timeline_controller')
+    timeline_controller.next_page = Mock(return_value=(None, ['@bar: hi']))
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds(),
+                                   timeline_controller=timeline_controller)
+    controller.receive('SM1', get_user(single_user), 'tl')
+    controller.process_pending()
+    assert not client.status_post.called
+    timeline_controller.next_page.assert_called_once_with(
+        get_user(single_user), 'home', older=False)
+    assert controller.outbound_controller.getstats()['count'] == 1
+
+def test_command_runs_only_once(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    client.timeline = Mock(side_effect=[
+        [{'id': 12, 'content': '<p>hi</p>', 'account': {'acct': 'bar'}}],
+        [{'id': 13, 'content': '<p>later</p>', 'account': {'acct': 'bar'}}]])
+    user_controller.get_masto_client = Mock(return_value=client)
+    timeline_controller = TimelineController(
+        db, user_controller=user_controller, cache=TTLCache(0),
+        flights=SingleFlight())
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds(),
+                                   timeline_controller=timeline_controller)
+    controller.receive('SM1', get_user(single_user), 'tl')
+    message = controller.get('SM1')
+    controller.post(message)
+    # a worker that crashed before marking it as posted runs it again
+    controller.post(message)
+    assert controller.outbound_controller.getstats()['count'] == 1
+    cursor = controller.timeline_controller.get_cursor(
+        get_user(single_user), 'home')
+    assert cursor.since_id == '12'
+
+def command_controller(client, account_id):
+    user_controller = UserController(db)
+    user_controller.get_masto_client = Mock(return_value=client)
+    account_controller = Mock(name='account_controller')
+    account_controller.resolve = Mock(return_value=account_id)
+    return InboundController(db, user_controller=user_controller,
+                             recent_ids=RecentIds(),
+                             account_controller=account_controller)
+
+def test_process_direct_message(single_user):
+    client = Mock(name='mastodon')
+    controller = command_controller(client, '7')
+    controller.receive('SM1', get_user(single_user), 'D @alice@example.social hi')
+    controller.process_pending()
+    controller.account_controller.resolve.assert_called_once_with(
+        get_user(single_user), client, 'alice@example.social')
+    client.status_post.assert_called_once_with(
+        '@alice@example.social hi', visibility='direct', idempotency_key='SM1')
+    assert controller.outbound_controller.getstats()['count'] == 0
+
+def test_process_direct_message_to_nobody(single_user):
+    client = Mock(name='mastodon')
+    controller = command_controller(client, None)
+    controller.receive('SM1', get_user(single_user), 'D @alice@example.social hi')
+    controller.process_pending()
+    assert not client.status_post.called
+    assert controller.outbound_controller.getstats()['count'] == 1
+
+def test_process_follow(single_user):
+    client = Mock(name='mastodon')
+    controller = command_controller(client, '7')
+    controller.receive('SM1', get_user(single_user), 'follow @bob@other.instance')
+    controller.process_pending()
+    client.account_follow.assert_called_once_with('7')
+    assert controller.outbound_controller.getstats()['count'] == 1
+
+def test_process_later(single_user):
+    controller = InboundController(db, recent_ids=RecentIds())
+    user = get_user(single_user)
+    controller.receive('SM1', user, 'LATER 2h hello from the past')
+    controller.process_pending()
+    post = controller.scheduled_controller.get('SM1')
+    assert post.body == 'hello from the past'
+    assert post.status == 'pending'
+    assert controller.outbound_controller.getstats()['count'] == 1
+    # scheduling the same SMS again neither schedules nor answers twice
+    controller.run_command(user, parse('LATER 2h hello from the past'), 'SM1')
+    assert controller.scheduled_controller.getstats() == {'pending': 1}
+    assert controller.outbound_controller.getstats()['count'] == 1
+
+def test_process_later_answers_after_a_crash(single_user):
+    controller = InboundController(db, recent_ids=RecentIds())
+    user = get_user(single_user)
+    # the worker died after scheduling, before answering
+    controller.scheduled_controller.schedule(user, 'SM1', 'hello', 7200)
+    controller.run_command(user, parse('LATER 2h hello'), 'SM1')
+    reply = db.query('select body from outbound_messages').first()
+    assert reply.body == 'Posting that in 2h'
+
+def test_process_later_too_long(single_user):
+    controller = InboundController(db, recent_ids=RecentIds())
+    user = get_user(single_user)
+    controller.receive('SM1', user, 'LATER 2h ' + 'a' * 501)
+    controller.process_pending()
+    assert controller.scheduled_controller.get('SM1') is None
+    reply = db.query('select body from outbound_messages').first()
+    assert reply.body == TOO_LONG.format(501, 500)
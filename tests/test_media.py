@@ -0,0 +1,321 @@
+import json
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import Mock
+
+import pytest
+
+from sms_gateway.cache import RecentIds
+from sms_gateway.controllers.inbound import InboundController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.blueprints.sms import attached_media
+from sms_gateway.media import MediaRelay, MultipartBody, Transcoder, \
+        is_twilio_media
+from sms_gateway.models.media import Media
+
+from tests.helpers import db, db_setup, single_user
+
+CHUNK = 64 * 1024
+
+
+class FakeResponse(object):
+    def __init__(self, chunks=(), headers=None, body=None, status_code=200):
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.body = body
+        self.status_code = status_code
+        self.url = 'https://fake'
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        return iter(self.chunks)
+
+    def json(self):
+        return self.body
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Hands out `size` bytes for every media url, and reads uploads the way
+    requests would, one chunk at a time
+    """
+    def __init__(self, size, barrier=None):
+        self.size = size
+        self.barrier = barrier
+        self.uploads = {}
+        self.largest_chunk = 0
+
+    def get(self, url, **kwargs):
+        if self.barrier is not None:
+            self.barrier.wait()
+
+        def chunks():
+            for i in range(0, self.size, CHUNK):
+                yield b'x' * min(CHUNK, self.size - i)
+        return FakeResponse(chunks(), {'Content-Length': str(self.size)})
+
+    def post(self, url, data, headers, timeout):
+        sent = 0
+        for chunk in data:
+            sent += len(chunk)
+            self.largest_chunk = max(self.largest_chunk, len(chunk))
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = (sent, len(data))
+        return FakeResponse(body={'id': upload_id})
+
+
+def mastodon():
+    return Mock(api_base_url='https://mastodon.test', access_token='token')
+
+
+def test_multipart_body_length_matches_what_gets_sent():
+    body = MultipartBody(iter([b'abc', b'', b'def']), 'image/png', 6)
+    sent = b''.join(body)
+    assert len(sent) == len(body)
+    assert b'filename="media.png"' in sent
+    assert b'Content-Type: image/png\r\n\r\nabcdef\r\n--' in sent
+    assert sent.endswith('--{0}--\r\n'.format(body.boundary).encode())
+
+
+def test_relay_streams_in_constant_memory():
+    session = FakeSession(32 * 1024 * 1024)
+    relay = MediaRelay(session=session, chunk_size=CHUNK)
+    tracemalloc.start()
+    try:
+        ids = relay.relay(mastodon(), [Media(0, 'https://api.twilio.com/1', 'video/mp4')])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert ids == ['1']
+    sent, length = session.uploads['1']
+    assert sent == length
+    assert session.largest_chunk <= CHUNK
+    assert peak < 1024 * 1024
+
+
+def test_relay_uploads_attachments_concurrently():
+    # every download waits until all three have started
+    session = FakeSession(10, barrier=threading.Barrier(3, timeout=5))
+    relay = MediaRelay(session=session)
+    ids = relay.relay(mastodon(), [Media(i, 'https://api.twilio.com/{0}'.format(i),
+                                         'image/gif') for i in range(3)])
+    assert sorted(ids) == ['1', '2', '3']
+
+
+def test_relay_takes_at_most_four():
+    relay = MediaRelay(session=FakeSession(10))
+    ids = relay.relay(mastodon(), [Media(i, 'https://api.twilio.com/{0}'.format(i),
+                                         'image/gif') for i in range(6)])
+    assert len(ids) == 4
+
+
+def test_only_twilio_media_gets_fetched():
+    assert is_twilio_media('https://api.twilio.com/2010-04-01/Accounts/AC1/Media/ME1')
+    assert not is_twilio_media('http://api.twilio.com/media/1')
+    assert not is_twilio_media('https://169.254.169.254/latest/meta-data')
+    assert not is_twilio_media('https://api.twilio.com.evil.test/media/1')
+    form = {'NumMedia': '2', 'MediaUrl0': 'https://api.twilio.com/media/0',
+            'MediaContentType0': 'image/png',
+            'MediaUrl1': 'http://localhost:5432/'}
+    assert attached_media(form) == [('https://api.twilio.com/media/0',
+                                     'image/png')]
+
+    session = FakeSession(10)
+    session.get = Mock()
+    relay = MediaRelay(session=session)
+    assert relay.relay(mastodon(), [Media(0, 'http://localhost/', None)]) == []
+    assert not session.get.called
+
+def test_relay_leaves_out_rejected_uploads():
+    session = FakeSession(10)
+    post = session.post
+    calls = []
+
+    def reject_second(url, data, headers, timeout):
+        calls.append(url)
+        if len(calls) == 2:
+            return FakeResponse(status_code=422)
+        return post(url, data, headers, timeout)
+    session.post = reject_second
+    relay = MediaRelay(session=session, max_concurrent=1)
+    ids = relay.relay(mastodon(), [Media(i, 'https://api.twilio.com/{0}'.format(i),
+                                         'image/gif') for i in range(3)])
+    assert ids == ['1', '2']
+
+def test_transcoder_wants_big_or_unknown_images():
+    transcoder = Transcoder(max_image_bytes=100)
+    assert transcoder.wants('image/jpeg', 101)
+    assert transcoder.wants('image/png', None)
+    assert not transcoder.wants('image/jpeg', 100)
+    assert not transcoder.wants('image/gif', 101)
+    assert not transcoder.wants('video/mp4', None)
+
+
+def test_relay_spools_small_unknown_sized_images_as_they_are():
+    transcoder = Transcoder(max_image_bytes=100)
+    transcoder.downsize = Mock()
+    session = FakeSession(10)
+    session.get = Mock(return_value=FakeResponse([b'x' * 10]))
+    relay = MediaRelay(session=session, transcoder=transcoder)
+    assert relay.relay(mastodon(), [Media(0, 'https://api.twilio.com/0', 'image/png')]) == ['1']
+    sent, length = session.uploads['1']
+    assert sent == length == len(MultipartBody([], 'image/png', 10))
+    assert not transcoder.downsize.called
+
+
+def test_downsize_oversized_image():
+    Image = pytest.importorskip('PIL.Image')
+    import io
+    buf = io.BytesIO()
+    Image.new('RGB', (4000, 3000), (200, 10, 10)).save(buf, 'PNG')
+    transcoder = Transcoder(max_image_bytes=1000, max_dimension=400,
+                            processes=1)
+    uploaded = []
+    relay = MediaRelay(session=FakeSession(0), transcoder=transcoder)
+    relay.session.get = Mock(return_value=FakeResponse([buf.getvalue()]))
+
+    def upload(mastodon, chunks, content_type, length=None):
+        data = b''.join(chunks)
+        uploaded.append((content_type, Image.open(io.BytesIO(data)).size))
+        return '1'
+    relay.upload = upload
+    assert relay.relay(mastodon(), [Media(0, 'https://api.twilio.com/0', 'image/png')]) == ['1']
+    assert uploaded == [('image/jpeg', (400, 300))]
+
+
+class Handler(BaseHTTPRequestHandler):
+    media = b'\x89PNG' + bytes(range(256)) * 1000
+    received = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.media)))
+        self.end_headers()
+        self.wfile.write(self.media)
+
+    def do_POST(self):
+        if 'Content-Length' in self.headers:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        else:
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                body += chunk
+        self.received.append((dict(self.headers), body))
+        reply = json.dumps({'id': str(len(self.received))}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+@pytest.fixture
+def server():
+    Handler.received = []
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_relay_over_http(server):
+    client = Mock(api_base_url=server, access_token='token')
+    relay = MediaRelay(chunk_size=4096, allowed=lambda url: True)
+    assert relay.relay(client, [Media(0, server + '/media/1', None)]) == ['1']
+    headers, body = Handler.received[0]
+    assert headers['Authorization'] == 'Bearer token'
+    assert 'Transfer-Encoding' not in headers
+    assert body.startswith(b'--')
+    assert b'Content-Type: image/png\r\n\r\n' + Handler.media + b'\r\n--' in body
+
+    # without a length, the upload goes out chunked
+    assert relay.upload(client, iter([b'abc', b'def']), 'video/mp4') == '2'
+    headers, body = Handler.received[1]
+    assert headers['Transfer-Encoding'] == 'chunked'
+    assert b'\r\n\r\nabcdef\r\n--' in body
+
+
+def test_receive_and_post_with_media(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    user_controller.get_masto_client = Mock(return_value=client)
+    relay = Mock(name='relay')
+    relay.relay = Mock(return_value=['11', '12'])
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds(), relay=relay)
+    user = user_controller.get_by_id(single_user)
+    assert controller.receive('MM1', user, 'look', [
+        ('https://api.twilio.com/media/a', 'image/jpeg'),
+        ('https://api.twilio.com/media/b', 'video/mp4'),
+    ])
+    assert controller.get_media('MM1') == [
+        Media(0, 'https://api.twilio.com/media/a', 'image/jpeg'),
+        Media(1, 'https://api.twilio.com/media/b', 'video/mp4'),
+    ]
+    assert controller.process_pending() == 1
+    relay.relay.assert_called_once_with(client, controller.get_media('MM1'))
+    client.status_post.assert_called_once_with(
+        'look', media_ids=['11', '12'], idempotency_key='MM1')
+
+
+def test_receive_duplicate_with_media_stores_media_once(single_user):
+    user = UserController(db).get_by_id(single_user)
+    media = [('https://api.twilio.com/media/a', 'image/jpeg')]
+    assert InboundController(db, recent_ids=RecentIds()).receive(
+        'MM1', user, '', media)
+    controller = InboundController(db, recent_ids=RecentIds())
+    assert not controller.receive('MM1', user, '', media)
+    assert len(controller.get_media('MM1')) == 1
+
+
+def test_post_tells_user_about_attachments_left_out(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    user_controller.get_masto_client = Mock(return_value=client)
+    relay = Mock(name='relay')
+    relay.relay = Mock(return_value=['11'])
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds(), relay=relay)
+    user = user_controller.get_by_id(single_user)
+    controller.receive('MM1', user, 'look', [
+        ('https://api.twilio.com/media/{0}'.format(i), 'image/jpeg')
+        for i in range(6)])
+    controller.process_pending()
+    client.status_post.assert_called_once_with(
+        'look', media_ids=['11'], idempotency_key='MM1')
+    body = db.query('select body from outbound_messages').first().body
+    assert body == 'Posted that with 1 of its 6 attachments'
+
+
+def test_post_drops_message_with_nothing_left_to_post(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    user_controller.get_masto_client = Mock(return_value=client)
+    relay = Mock(name='relay')
+    relay.relay = Mock(return_value=[])
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds(), relay=relay)
+    user = user_controller.get_by_id(single_user)
+    controller.receive('MM1', user, '', [
+        ('https://api.twilio.com/media/0', 'image/jpeg')])
+    controller.process_pending()
+    assert not client.status_post.called
+    assert controller.get('MM1').status == 'dropped'
+    body = db.query('select body from outbound_messages').first().body
+    assert body == "Couldn't post your attachments"
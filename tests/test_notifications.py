@@ -0,0 +1,79 @@
+import threading
+import time
+from unittest.mock import Mock
+
+from sms_gateway.controllers.outbound import OutboundController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.digest import Coalescer
+from sms_gateway.models.user import User, VALID
+from sms_gateway.notifications import NotificationSource
+
+from tests.helpers import db, db_setup, single_user
+
+user = User(id=1, uuid='abcd', user='foo', auth_token='efgh', domain_id=1,
+            token_status=VALID)
+
+def mention(text):
+    return {'type': 'mention', 'account': {'acct': 'bar@other.domain'},
+            'status': {'content': '<p>{0}</p>'.format(text)}}
+
+def test_flush_queues_ready_digests(single_user):
+    source = NotificationSource(db)
+    source.add(user, mention('hi'), 0)
+    source.add(user, mention('there'), 300)
+    assert source.flush() == 1
+    stats = OutboundController(db).getstats()
+    assert stats['count'] == 1
+    assert source.flush() == 0
+
+def test_run_flushes_pending_on_stop(single_user):
+    source = NotificationSource(db, flush_interval=0)
+    source.add(user, mention('hi'), 300)
+    source.run(should_stop=lambda: True)
+    assert OutboundController(db).getstats()['count'] == 1
+
+def test_watch_streams_once_per_user(db_setup):
+    source = NotificationSource(db, coalescer=Coalescer())
+    streamed = threading.Event()
+    mastodon = Mock(name='mastodon')
+    def stream_user(listener):
+        listener.on_notification(mention('hi'))
+        source.stopped.set()
+        streamed.set()
+    mastodon.stream_user = Mock(side_effect=stream_user)
+    source.watch(user, mastodon, 0)
+    source.watch(user, mastodon, 0)
+    assert streamed.wait(5)
+    source.threads[user.id].join(5)
+    assert mastodon.stream_user.call_count == 1
+    assert source.ready.qsize() == 1
+
+def test_refresh_follows_users_as_they_come_and_go(single_user):
+    streaming = threading.Event()
+    def stream_user(listener):
+        streaming.set()
+        while True:
+            listener.handle_heartbeat()
+            time.sleep(0.01)
+    mastodon = Mock(name='mastodon')
+    mastodon.stream_user = Mock(side_effect=stream_user)
+    user_controller = UserController(db, mastodon=Mock(return_value=mastodon))
+    source = NotificationSource(db, coalescer=Coalescer(),
+                                user_controller=user_controller)
+    source.refresh()
+    assert source.threads == {}
+
+    user = user_controller.get_by_id(single_user)
+    user_controller.set_phone(user, '+15555555555')
+    source.refresh()
+    thread = source.threads[user.id]
+    assert streaming.wait(5)
+    source.refresh()
+    assert source.threads[user.id] is thread
+
+    user_controller.set_phone(user, None)
+    source.refresh()
+    assert source.threads == {}
+    thread.join(5)
+    assert not thread.is_alive()
+    assert mastodon.stream_user.call_count == 1
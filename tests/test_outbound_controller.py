@@ -0,0 +1,47 @@
+from unittest.mock import Mock
+
+import pytest
+
+from sms_gateway.controllers.outbound import OutboundController, DROPPED
+from sms_gateway.digest import Digest
+from sms_gateway.models.outbound import OutboundMessage
+from sms_gateway.queue import Skip
+
+from tests.helpers import db, db_setup, single_user
+
+def test_enqueue(single_user):
+    controller = OutboundController(db)
+    digest = controller.enqueue(1, 'a' * 200)
+    assert digest.segments == 2
+    stats = controller.getstats()
+    assert stats['count'] == 1
+    assert stats['segments'] == 2
+
+def test_enqueue_digests(single_user):
+    controller = OutboundController(db)
+    controller.enqueue_digests([Digest(user_id=1, body='1 fav', segments=1),
+                                Digest(user_id=1, body='2 boosts', segments=1)])
+    controller.enqueue_digests([])
+    assert controller.getstats()['count'] == 2
+
+def test_send(single_user):
+    db.query("update users set phone = '+15555550100'")
+    twilio = Mock(name='twilio')
+    controller = OutboundController(db, twilio=twilio, from_number='+15555550199')
+    controller.enqueue(1, 'hello')
+    message = OutboundMessage.fromrecord(
+        db.query('select * from outbound_messages').first())
+    controller.send(message)
+    twilio.messages.create.assert_called_once_with(to='+15555550100',
+            from_='+15555550199', body='hello')
+
+def test_send_without_phone(single_user):
+    twilio = Mock(name='twilio')
+    controller = OutboundController(db, twilio=twilio)
+    controller.enqueue(1, 'hello')
+    message = OutboundMessage.fromrecord(
+        db.query('select * from outbound_messages').first())
+    with pytest.raises(Skip) as skip:
+        controller.send(message)
+    assert skip.value.status == DROPPED
+    assert not twilio.messages.create.called
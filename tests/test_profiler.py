@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from sms_gateway.controllers.profile import ProfileController, ProfileNotFound
+from sms_gateway.profiler import ProfilingAgent, Sampler, folded
+from tests.helpers import db_setup, db
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def spin_in_a_recognisable_function(stop):
+    while not stop.is_set():
+        pass
+
+
+def test_sampler_sees_busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=spin_in_a_recognisable_function,
+                              args=(stop,), name='spinner')
+    thread.start()
+    sampler = Sampler(interval=0.001, thread_ids={thread.ident}).start()
+    time.sleep(0.05)
+    stacks = sampler.stop()
+    stop.set()
+    thread.join()
+    assert stacks
+    for stack in stacks:
+        frames = stack.split(';')
+        assert frames[0] == 'spinner'
+        assert any(frame.startswith('spin_in_a_recognisable_function (')
+                   for frame in frames)
+
+def test_folded():
+    assert folded(Counter({'a;b': 2, 'a': 1})) == 'a 1\na;b 2\n'
+
+def test_profile_controller(db_setup):
+    clock = Clock()
+    controller = ProfileController(db_setup, clock=clock)
+    profile = controller.create(10, 5)
+    assert profile.max_requests == 5
+    assert controller.get(profile.uuid) == profile
+    assert controller.active(clock.now) == [profile]
+    assert controller.active(clock.now + 10) == []
+
+    controller.save_stacks(profile.id, 'web', Counter({'main;a': 2}))
+    controller.save_stacks(profile.id, 'web', Counter({'main;a': 1}))
+    controller.save_stacks(profile.id, 'inbound', Counter({'main;b': 4}))
+    assert controller.stacks(profile) == Counter({'web;main;a': 3,
+                                                  'inbound;main;b': 4})
+
+def test_profile_controller_limits(db_setup):
+    controller = ProfileController(db_setup)
+    with pytest.raises(ValueError):
+        controller.create(3600)
+    with pytest.raises(ValueError):
+        controller.create(10, 0)
+    with pytest.raises(ProfileNotFound):
+        controller.get('nope')
+
+def test_agent_samples_until_deadline(db_setup):
+    clock = Clock()
+    controller = ProfileController(db_setup, clock=clock)
+    agent = ProfilingAgent('inbound', sample_interval=0.001, clock=clock)
+    agent.poll(lambda: controller)
+    assert agent.profile is None
+
+    profile = controller.create(5)
+    clock.now += 1
+    agent.poll(lambda: controller)
+    assert agent.profile == profile
+    time.sleep(0.02)
+
+    clock.now += 5
+    agent.poll(lambda: controller)
+    assert agent.profile is None
+    assert all(stack.startswith('inbound;')
+               for stack in controller.stacks(profile))
+
+    # a profile only gets joined once
+    clock.now += 1
+    agent.poll(lambda: controller)
+    assert agent.profile is None
+
+def test_agent_stops_after_requests(db_setup):
+    clock = Clock()
+    controller = ProfileController(db_setup, clock=clock)
+    profile = controller.create(60, 2)
+    agent = ProfilingAgent('web', sample_interval=0.001, clock=clock)
+    agent.poll(lambda: controller)
+    assert agent.profile == profile
+    agent.request_finished(lambda: controller)
+    assert agent.profile == profile
+    agent.request_finished(lambda: controller)
+    assert agent.profile is None
+
+def test_agent_does_not_touch_db_between_polls():
+    clock = Clock()
+    agent = ProfilingAgent('web', poll_interval=1.0, clock=clock)
+    calls = []
+    def get_controller():
+        calls.append(1)
+        return type('C', (), {'active': lambda self, now: []})()
+    agent.poll(get_controller)
+    agent.poll(get_controller)
+    agent.request_finished(get_controller)
+    assert len(calls) == 1
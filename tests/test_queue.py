@@ -0,0 +1,141 @@
+from unittest.mock import Mock
+
+from sms_gateway.controllers.outbound import OutboundController
+from sms_gateway.queue import partition_for, LeaseManager, QueueWorker, \
+        NUM_PARTITIONS
+
+from tests.helpers import db, db_setup, single_user
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def manager(owner, clock, partitions=4):
+    leases = LeaseManager(db, 'outbound', owner=owner, partitions=partitions,
+                          lease_seconds=30, clock=clock)
+    leases.setup()
+    return leases
+
+def test_partition_for_is_stable():
+    assert partition_for(1) == partition_for(1)
+    assert 0 <= partition_for(12345, 8) < 8
+    assert len(set(partition_for(u, 8) for u in range(100))) == 8
+
+def test_claim_is_exclusive(db_setup):
+    clock = Clock()
+    a = manager('a', clock)
+    b = manager('b', clock)
+    assert a.claim(0)
+    assert not b.claim(0)
+    assert a.holds(0) and not b.holds(0)
+
+def test_expired_lease_is_reassigned(db_setup):
+    clock = Clock()
+    a = manager('a', clock)
+    b = manager('b', clock)
+    assert a.heartbeat() == [0, 1, 2, 3]
+    assert b.heartbeat() == []
+    # a died, nothing is handed over until its leases run out
+    clock.now += 29
+    assert b.heartbeat() == []
+    clock.now += 2
+    assert b.heartbeat() == [0, 1, 2, 3]
+    assert not a.holds(0)
+
+def test_heartbeat_rebalances(db_setup):
+    clock = Clock()
+    a = manager('a', clock)
+    b = manager('b', clock)
+    assert len(a.heartbeat()) == 4
+    assert len(b.heartbeat()) == 0
+    assert len(a.heartbeat()) == 2
+    assert len(b.heartbeat()) == 2
+    b.release_all()
+    assert len(a.heartbeat()) == 4
+
+def test_worker_keeps_order_and_stops_on_failure(single_user):
+    clock = Clock()
+    outbound = OutboundController(db)
+    for body in ('one', 'two', 'three'):
+        outbound.enqueue(1, body)
+    seen = []
+    def handler(row):
+        if row.body == 'two' and 'two' not in seen:
+            seen.append(row.body)
+            raise RuntimeError
+        seen.append(row.body)
+    worker = QueueWorker(db, 'outbound_messages', handler,
+                         manager('a', clock, NUM_PARTITIONS), done_status='sent',
+                         retry_delay=5)
+    assert worker.run_once() == 1
+    # nothing gets ahead of 'two' while it waits for its next go
+    assert worker.run_once() == 0
+    clock.now += 5
+    assert worker.run_once() == 2
+    assert seen == ['one', 'two', 'two', 'three']
+    assert worker.run_once() == 0
+
+def test_worker_backs_off_and_gives_up_on_a_failing_row(single_user):
+    clock = Clock()
+    outbound = OutboundController(db)
+    for body in ('bad', 'good'):
+        outbound.enqueue(1, body)
+    seen = []
+    def handler(row):
+        seen.append(row.body)
+        if row.body == 'bad':
+            raise RuntimeError
+    worker = QueueWorker(db, 'outbound_messages', handler,
+                         manager('a', clock, NUM_PARTITIONS), done_status='sent',
+                         max_attempts=3, retry_delay=5, max_retry_delay=8)
+    assert worker.run_once() == 0
+    row = db.query("select * from outbound_messages where body = 'bad'").first()
+    assert (row.attempts, row.retry_at) == (1, clock.now + 5)
+    clock.now += 5
+    assert worker.run_once() == 0
+    row = db.query("select * from outbound_messages where body = 'bad'").first()
+    assert (row.attempts, row.retry_at) == (2, clock.now + 8)
+    clock.now += 8
+    # third strike, and 'good' goes out right behind it
+    assert worker.run_once() == 1
+    assert seen == ['bad', 'bad', 'bad', 'good']
+    rows = db.query('select body, status from outbound_messages order by id')
+    assert [(r.body, r.status) for r in rows] == [('bad', 'failed'),
+                                                  ('good', 'sent')]
+
+def test_complete_only_once(single_user):
+    clock = Clock()
+    OutboundController(db).enqueue(1, 'one')
+    a = manager('a', clock, NUM_PARTITIONS)
+    a.heartbeat()
+    worker = QueueWorker(db, 'outbound_messages', Mock(), a, done_status='sent')
+    row = db.query('select id from outbound_messages').first()
+    assert worker.complete(row.id, partition_for(1))
+    assert not worker.complete(row.id, partition_for(1))
+
+def test_worker_fenced_on_lost_lease(single_user):
+    clock = Clock()
+    OutboundController(db).enqueue(1, 'one')
+    a = manager('a', clock, NUM_PARTITIONS)
+    worker = QueueWorker(db, 'outbound_messages', Mock(), a, done_status='sent')
+    partition = partition_for(1)
+    a.heartbeat()
+    clock.now += 31
+    b = manager('b', clock, NUM_PARTITIONS)
+    assert b.claim(partition)
+    assert worker.drain(partition) == 0
+    row = db.query('select status from outbound_messages').first()
+    assert row.status == 'pending'
+
+def test_worker_waits_on_wakeup_when_idle(db_setup):
+    wakeup = Mock(name='wakeup')
+    worker = QueueWorker(db, 'outbound_messages', Mock(),
+                         manager('a', Clock()), wakeup=wakeup)
+    hook = Mock(name='hook')
+    worker.hooks.append(hook)
+    worker.run(should_stop=Mock(side_effect=[False, True]), idle_sleep=5)
+    wakeup.wait.assert_called_once_with(5)
+    hook.assert_called_once_with()
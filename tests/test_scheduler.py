@@ -0,0 +1,249 @@
+import random
+from unittest.mock import Mock
+
+import pytest
+from mastodon import MastodonAPIError, MastodonUnauthorizedError
+
+from sms_gateway.controllers.scheduled import ScheduledPostController, CHANNEL
+from sms_gateway.controllers.user import UserController, TokenRevoked
+from sms_gateway.models.user import VALID, REVOKED
+from sms_gateway.queue import LeaseManager
+from sms_gateway.scheduler import TimerWheel, Scheduler, RETRY_DELAY
+from sms_gateway.storage import backend_for
+
+from tests.helpers import db, db_setup, single_user
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_timer_wheel_fires_on_time():
+    rng = random.Random(1)
+    wheel = TimerWheel(0, slots=8, levels=3)
+    due = {i: rng.uniform(0, 500) for i in range(1000)}
+    for key, when in due.items():
+        wheel.add(key, when)
+    assert len(wheel) == 1000
+    fired = {}
+    for now in range(0, 512):
+        for key in wheel.advance(now):
+            fired[key] = now
+    assert fired == {key: int(when) for key, when in due.items()}
+    assert len(wheel) == 0
+
+def test_timer_wheel_past_and_far_timers():
+    wheel = TimerWheel(100, slots=8, levels=2)
+    wheel.add('late', 50)
+    assert wheel.advance(100) == ['late']
+    # added while the wheel is partway around
+    wheel.add('a', 160)
+    wheel.add('b', 130.5)
+    assert wheel.advance(129) == []
+    assert wheel.advance(159) == ['b']
+    assert wheel.advance(160) == ['a']
+    with pytest.raises(ValueError):
+        wheel.add('too far', 161 + 64)
+
+def client_for(clients):
+    def get_masto_client(user):
+        if user.revoked:
+            raise TokenRevoked
+        return clients.setdefault(user.id, Mock(name='mastodon'))
+    return get_masto_client
+
+def setup(clock, **kwargs):
+    user_controller = UserController(db)
+    clients = {}
+    user_controller.get_masto_client = Mock(side_effect=client_for(clients))
+    controller = ScheduledPostController(db, clock=clock)
+    scheduler = Scheduler(db, LeaseManager(db, 'scheduled', owner='a',
+                                           clock=clock),
+                          controller=controller,
+                          user_controller=user_controller, clock=clock,
+                          **kwargs)
+    scheduler.leases.setup()
+    return scheduler, controller, clients
+
+def posted(clients, user_id=1):
+    return [c[0][0] for c in clients[user_id].status_post.call_args_list] \
+        if user_id in clients else []
+
+def test_scheduler_posts_when_due(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock)
+    user = scheduler.user_controller.get_by_id(single_user)
+    assert controller.schedule(user, 'SM1', 'first', 10)
+    assert controller.schedule(user, 'SM2', 'much later', 3600)
+    assert not controller.schedule(user, 'SM1', 'first', 10)
+
+    assert scheduler.run_once() == 0
+    # only what's due within the window is in memory
+    assert len(scheduler.wheel) == 1
+    clock.now += 10
+    assert scheduler.run_once() == 1
+    assert posted(clients) == ['first']
+    clients[1].status_post.assert_called_once_with('first',
+                                                   idempotency_key='SM1')
+    assert controller.get('SM1').status == 'posted'
+
+    # the window moves along as time passes
+    for _ in range(8):
+        clock.now += 450
+        scheduler.run_once()
+    assert posted(clients) == ['first', 'much later']
+    assert controller.getstats() == {'posted': 2}
+
+def test_scheduler_picks_up_new_posts_when_notified(single_user):
+    clock = Clock()
+    backend = backend_for(db)
+    scheduler, controller, clients = setup(clock,
+                                           wakeup=backend.listen(CHANNEL))
+    user = scheduler.user_controller.get_by_id(single_user)
+    scheduler.run_once()
+    controller.schedule(user, 'SM1', 'soon', 5)
+    # returns as soon as the notification gets here
+    scheduler.idle(5)
+    scheduler.run_once()
+    assert len(scheduler.wheel) == 1
+    clock.now += 5
+    assert scheduler.run_once() == 1
+
+def test_scheduler_rescans_for_missed_posts(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock, rescan_interval=30)
+    user = scheduler.user_controller.get_by_id(single_user)
+    scheduler.run_once()
+    controller.schedule(user, 'SM1', 'soon', 60)
+    # a post whose id was handed out before one we've already seen
+    scheduler.last_id = controller.max_id()
+    clock.now += 30
+    scheduler.run_once()
+    assert len(scheduler.wheel) == 1
+    clock.now += 30
+    assert scheduler.run_once() == 1
+
+def test_scheduler_catches_up_after_restart(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock)
+    user = scheduler.user_controller.get_by_id(single_user)
+    for i in range(5):
+        controller.schedule(user, 'SM{0}'.format(i), 'post {0}'.format(i),
+                            60 * (i + 1))
+    scheduler.run_once()
+    clock.now += 60
+    assert scheduler.run_once() == 1
+    scheduler.leases.release_all()
+
+    # nobody was around while the rest came due
+    clock.now += 3600
+    scheduler, controller, clients = setup(clock)
+    assert scheduler.run_once() == 4
+    assert posted(clients) == ['post 1', 'post 2', 'post 3', 'post 4']
+    # one client for the whole batch
+    assert scheduler.user_controller.get_masto_client.call_count == 1
+
+def test_scheduler_retries_failed_posts(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock)
+    user = scheduler.user_controller.get_by_id(single_user)
+    controller.schedule(user, 'SM1', 'first', 10)
+    controller.schedule(user, 'SM2', 'second', 10)
+    mastodon = clients[1] = Mock(name='mastodon')
+    mastodon.status_post = Mock(side_effect=[Exception('down'), None, None])
+    clock.now += 10
+    assert scheduler.run_once() == 0
+    # nothing gets posted ahead of the one that failed
+    assert mastodon.status_post.call_count == 1
+    assert controller.getstats() == {'pending': 2}
+    clock.now += RETRY_DELAY
+    assert scheduler.run_once() == 2
+    assert controller.getstats() == {'posted': 2}
+
+def test_scheduler_gives_up_on_failing_posts(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock, max_attempts=2)
+    user = scheduler.user_controller.get_by_id(single_user)
+    for i, body in enumerate(['too long', 'broken', 'fine']):
+        controller.schedule(user, 'SM{0}'.format(i), body, 10)
+    mastodon = clients[1] = Mock(name='mastodon')
+    mastodon.status_post = Mock(side_effect=[
+        MastodonAPIError('Mastodon API returned error', 422,
+                         'Unprocessable Entity', 'Text is too long'),
+        Exception('down'), Exception('down'), None])
+    clock.now += 10
+    # turned down for good, and no retry is going to change that
+    assert scheduler.run_once() == 0
+    assert controller.get('SM0').status == 'failed'
+    assert controller.get('SM1').status == 'pending'
+    clock.now += RETRY_DELAY
+    assert scheduler.run_once() == 0
+    assert controller.get('SM1').status == 'failed'
+    # the post behind them doesn't wait forever
+    clock.now += RETRY_DELAY
+    assert scheduler.run_once() == 1
+    assert controller.getstats() == {'failed': 2, 'posted': 1}
+
+def test_scheduler_leaves_revoked_users_alone(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock, rescan_interval=30)
+    user = scheduler.user_controller.get_by_id(single_user)
+    controller.schedule(user, 'SM1', 'soon', 10)
+    scheduler.run_once()
+    scheduler.user_controller.set_token_status(user, REVOKED)
+    clock.now += 10
+    assert scheduler.run_once() == 0
+    # nothing to do for them until they log in again
+    for _ in range(3):
+        clock.now += RETRY_DELAY
+        assert scheduler.run_once() == 0
+        assert len(scheduler.wheel) == 0
+    scheduler.user_controller.set_token_status(user, VALID)
+    clock.now += 30
+    assert scheduler.run_once() == 1
+    assert controller.getstats() == {'posted': 1}
+
+def test_scheduler_revokes_rejected_tokens(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock)
+    user = scheduler.user_controller.get_by_id(single_user)
+    controller.schedule(user, 'SM1', 'first', 10)
+    mastodon = clients[1] = Mock(name='mastodon')
+    mastodon.status_post = Mock(side_effect=MastodonUnauthorizedError())
+    clock.now += 10
+    assert scheduler.run_once() == 0
+    assert scheduler.user_controller.get_by_id(single_user).revoked
+    assert controller.get('SM1').status == 'pending'
+    assert len(scheduler.wheel) == 0
+
+def test_scheduler_works_through_a_backlog_a_part_at_a_time(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock)
+    user = scheduler.user_controller.get_by_id(single_user)
+    for i in range(7):
+        controller.schedule(user, 'SM{0}'.format(i), 'post {0}'.format(i), 10)
+    # nobody was around while they came due
+    clock.now += 3600
+    scheduler, controller, clients = setup(clock, load_batch=2, max_armed=3)
+    assert scheduler.run_once() == 3
+    assert len(scheduler.wheel) == 0
+    for expected in (3, 1):
+        clock.now += 1
+        assert scheduler.run_once() == expected
+    assert posted(clients) == ['post {0}'.format(i) for i in range(7)]
+
+def test_scheduler_gives_up_when_there_is_never_a_client(single_user):
+    clock = Clock()
+    scheduler, controller, clients = setup(clock, max_attempts=2)
+    user = scheduler.user_controller.get_by_id(single_user)
+    controller.schedule(user, 'SM1', 'first', 10)
+    controller.schedule(user, 'SM2', 'second', 10)
+    scheduler.user_controller.get_masto_client.side_effect = \
+        Exception('no domain')
+    clock.now += 10
+    assert scheduler.run_once() == 0
+    clock.now += RETRY_DELAY
+    assert scheduler.run_once() == 0
+    assert controller.getstats() == {'failed': 1, 'pending': 1}
@@ -0,0 +1,19 @@
+from sms_gateway.sms import is_gsm7, segment_count
+
+def test_is_gsm7():
+    assert is_gsm7('hello @foo@my.domain!')
+    assert not is_gsm7('hello 🐘')
+
+def test_segment_count_gsm7():
+    assert segment_count('a' * 160) == 1
+    assert segment_count('a' * 161) == 2
+    assert segment_count('a' * 306) == 2
+    assert segment_count('a' * 307) == 3
+
+def test_segment_count_extended_counts_twice():
+    assert segment_count('{' * 80) == 1
+    assert segment_count('{' * 81) == 2
+
+def test_segment_count_ucs2():
+    assert segment_count('🐘' * 35) == 1
+    assert segment_count('é' + 'ж' * 70) == 2
@@ -0,0 +1,40 @@
+from twilio.request_validator import RequestValidator
+
+from sms_gateway import app
+from sms_gateway.blueprints.sms import is_valid_twilio_request
+
+FORM = {'MessageSid': 'SM1', 'From': '+15555550100', 'Body': 'hi'}
+
+
+def webhook(signature=None):
+    headers = {}
+    if signature is not None:
+        headers['X-Twilio-Signature'] = signature
+    return app.test_request_context('/sms', method='POST', data=FORM,
+                                    headers=headers,
+                                    base_url='https://gateway.test')
+
+
+def test_unsigned_requests_turned_away_without_auth_token(monkeypatch):
+    monkeypatch.delenv('TWILIO_AUTH_TOKEN', raising=False)
+    monkeypatch.delenv('TWILIO_SKIP_VALIDATION', raising=False)
+    with webhook():
+        assert not is_valid_twilio_request()
+
+
+def test_skip_validation_lets_unsigned_requests_through(monkeypatch):
+    monkeypatch.delenv('TWILIO_AUTH_TOKEN', raising=False)
+    monkeypatch.setenv('TWILIO_SKIP_VALIDATION', '1')
+    with webhook():
+        assert is_valid_twilio_request()
+
+
+def test_only_signed_requests_get_through(monkeypatch):
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', 'secret')
+    monkeypatch.delenv('TWILIO_SKIP_VALIDATION', raising=False)
+    signature = RequestValidator('secret').compute_signature(
+        'https://gateway.test/sms', FORM)
+    with webhook(signature):
+        assert is_valid_twilio_request()
+    with webhook('forged'):
+        assert not is_valid_twilio_request()
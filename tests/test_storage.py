@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from sms_gateway.controllers.outbound import OutboundController, CHANNEL
+from sms_gateway.digest import Digest
+from sms_gateway.queue import LeaseManager
+from sms_gateway.storage import get_backend, backend_for, SQLiteBackend, \
+        PostgresBackend, Statement
+from tests.helpers import db_setup, single_user, db
+
+postgres_only = pytest.mark.skipif(
+    backend_for(db).dialect != 'postgresql',
+    reason='set TEST_DATABASE_URL to a postgresql:// database to run these')
+
+
+def test_get_backend():
+    assert isinstance(get_backend('sqlite:///:memory:'), SQLiteBackend)
+    assert isinstance(get_backend('postgresql://localhost/sms'), PostgresBackend)
+    assert isinstance(get_backend('postgresql+psycopg2://localhost/sms'),
+                      PostgresBackend)
+    with pytest.raises(ValueError):
+        get_backend('mysql://localhost/sms')
+
+def test_translate():
+    create = 'CREATE TABLE things (id INTEGER PRIMARY KEY, n INTEGER NOT NULL)'
+    assert get_backend('sqlite://').translate(create) == create
+    assert get_backend('postgresql://localhost/sms').translate(create) == \
+        'CREATE TABLE things (id SERIAL PRIMARY KEY, n INTEGER NOT NULL)'
+    timestamps = 'CREATE TABLE things (at REAL NOT NULL)'
+    assert get_backend('sqlite://').translate(timestamps) == timestamps
+    assert get_backend('postgresql://localhost/sms').translate(timestamps) == \
+        'CREATE TABLE things (at DOUBLE PRECISION NOT NULL)'
+    per_dialect = dict(sqlite='select 1', postgresql='select 2')
+    assert get_backend('sqlite://').translate(per_dialect) == 'select 1'
+
+def test_table_exists(db_setup):
+    backend = backend_for(db_setup)
+    assert backend.table_exists(db_setup, 'users')
+    assert not backend.table_exists(db_setup, 'nope')
+
+def test_bulk_load(single_user):
+    backend = backend_for(db)
+    backend.bulk_load(db, 'outbound_messages',
+                      ['user_id', 'body', 'segments', 'partition_id'],
+                      [(1, 'plain', 1, 0), (1, '', 1, 0),
+                       (1, 'a "quoted",\nmultiline 🐘', 1, 0)])
+    rows = db.query('''
+    select body, status from outbound_messages order by id
+    ''', fetchall=True)
+    assert [r.body for r in rows] == ['plain', '', 'a "quoted",\nmultiline 🐘']
+    assert [r.status for r in rows] == ['pending'] * 3
+
+def test_listener_wakes_up(db_setup):
+    backend = backend_for(db_setup)
+    listener = backend.listen(CHANNEL)
+    try:
+        assert not listener.wait(0.01)
+        threading.Timer(0.05, backend.notify, args=(db_setup, CHANNEL)).start()
+        start = time.monotonic()
+        assert listener.wait(5)
+        assert time.monotonic() - start < 1
+    finally:
+        listener.close()
+
+def test_listener_keeps_notifications_until_waited_on(single_user):
+    backend = backend_for(db)
+    listener = backend.listen(CHANNEL)
+    try:
+        OutboundController(db).enqueue_digests(
+            [Digest(user_id=1, body='hello', segments=1)])
+        time.sleep(0.1)
+        assert listener.wait(0)
+        assert not listener.wait(0.01)
+    finally:
+        listener.close()
+
+@postgres_only
+def test_postgres_ids(db_setup):
+    db_setup.query('''
+    insert into domains (domain, client_id, client_secret)
+    values ('a.domain', 'a', 'b')
+    ''')
+    assert db_setup.query('select id from domains').first().id == 1
+
+def test_statement():
+    statement = Statement('s', 'select a from t where b = $1 and c = $2 or d = $1')
+    assert statement.params == 2
+    assert statement.sqlite_sql == \
+        'select a from t where b = ?1 and c = ?2 or d = ?1'
+
+def test_execute(single_user):
+    backend = backend_for(db)
+    statement = Statement('test_user_by_uuid', '''
+    select id, "user" from users where uuid = $1
+    ''')
+    for _ in range(2):
+        assert backend.execute(db, statement, (single_user,)).fetchone() == \
+            (1, 'foo')
+    assert backend.execute(db, statement, ('nope',)).fetchone() is None
+
+@postgres_only
+def test_execute_leaves_no_transaction_open(single_user):
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+    backend = backend_for(db)
+    statement = Statement('test_user_id', 'select id from users where uuid = $1')
+    conn = db.db.connection.connection
+    for _ in range(2):
+        assert backend.execute(db, statement, (single_user,)).fetchone() == (1,)
+        assert conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    # but it doesn't commit anybody else's transaction either
+    with db.transaction() as transaction:
+        db.query("update users set phone = '+15555550100'")
+        backend.execute(db, statement, (single_user,)).fetchone()
+        transaction.rollback()
+    assert db.query('select phone from users').first().phone is None
+
+@postgres_only
+def test_timestamps_keep_their_seconds(db_setup):
+    # a 4 byte float only gets within a couple of minutes of today's time
+    leases = LeaseManager(db, 'outbound', owner='a', partitions=1,
+                          lease_seconds=30, clock=time.time)
+    leases.setup()
+    assert leases.claim(0)
+    assert leases.holds(0)
+    row = db.query('select expires_at from queue_leases').first()
+    assert 29 < row.expires_at - time.time() <= 30
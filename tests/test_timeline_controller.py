@@ -0,0 +1,107 @@
+from unittest.mock import Mock
+
+from sms_gateway.cache import TTLCache, SingleFlight
+from sms_gateway.controllers.timeline import TimelineController, NOTHING_NEW, \
+        NOT_MENTIONS
+from sms_gateway.controllers.user import UserController
+
+from tests.helpers import db, db_setup, single_user
+
+def status(id, text='hi'):
+    return {'id': id, 'content': '<p>{0}</p>'.format(text),
+            'account': {'acct': 'bar@other.domain'}}
+
+def controller(client):
+    user_controller = UserController(db)
+    user_controller.get_masto_client = Mock(return_value=client)
+    return TimelineController(db, user_controller=user_controller,
+                              cache=TTLCache(30), flights=SingleFlight())
+
+def test_fetch_moves_cursor(single_user):
+    client = Mock(name='mastodon')
+    client.timeline = Mock(return_value=[status(12, 'newer'), status(11, 'older')])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    replies = c.fetch(user, 'home')
+    assert replies == ['@bar@other.domain: newer\n@bar@other.domain: older']
+    client.timeline.assert_called_once_with('home', min_id=None, max_id=None,
+                                            limit=5)
+    cursor = c.get_cursor(user, 'home')
+    assert cursor.since_id == '12' and cursor.max_id == '11'
+
+    # pages forward from the cursor, instead of skipping to the newest
+    client.timeline = Mock(return_value=[])
+    assert c.fetch(user, 'home') == [NOTHING_NEW]
+    client.timeline.assert_called_once_with('home', min_id='12', max_id=None,
+                                            limit=5)
+
+def test_fetch_older(single_user):
+    client = Mock(name='mastodon')
+    client.timeline = Mock(return_value=[status(12), status(11)])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    c.fetch(user, 'home')
+    client.timeline = Mock(return_value=[status(10), status(9)])
+    c.fetch(user, 'home', older=True)
+    client.timeline.assert_called_once_with('home', min_id=None, max_id='11',
+                                            limit=5)
+    cursor = c.get_cursor(user, 'home')
+    assert cursor.since_id == '12' and cursor.max_id == '9'
+
+def test_fetch_is_cached(single_user):
+    client = Mock(name='mastodon')
+    client.timeline = Mock(return_value=[status(12)])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    first = c.load(user, 'home', None, None)
+    second = c.load(user, 'home', None, None)
+    assert first == second
+    assert client.timeline.call_count == 1
+
+def test_local_timeline_cached_per_user(single_user):
+    client = Mock(name='mastodon')
+    client.timeline = Mock(return_value=[status(12, 'new'), status(11, 'old')])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    db.query('''
+    insert into users (uuid, "user", auth_token, domain_id)
+    values ('other', 'other', 'token', 1)
+    ''')
+    other = c.user_controller.get_by_id('other')
+    c.set_cursor(c.get_cursor(user, 'local')._replace(since_id='10'))
+    c.set_cursor(c.get_cursor(other, 'local')._replace(since_id='10'))
+    c.fetch(user, 'local')
+    c.fetch(other, 'local')
+    # each with their own token, since instances filter the local timeline
+    # by who's asking
+    assert client.timeline.call_count == 2
+    client.timeline.assert_called_with('local', min_id='10', max_id=None,
+                                       limit=5)
+
+def test_newest_local_page_shared_per_instance(single_user):
+    client = Mock(name='mastodon')
+    client.timeline = Mock(return_value=[status(12, 'new')])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    db.query('''
+    insert into users (uuid, "user", auth_token, domain_id)
+    values ('other', 'other', 'token', 1)
+    ''')
+    other = c.user_controller.get_by_id('other')
+    assert c.fetch(user, 'local') == c.fetch(other, 'local')
+    assert client.timeline.call_count == 1
+    # but home timelines are everyone's own
+    c.fetch(user, 'home')
+    c.fetch(other, 'home')
+    assert client.timeline.call_count == 3
+
+def test_mentions_use_notification_ids(single_user):
+    client = Mock(name='mastodon')
+    client.notifications = Mock(return_value=[
+        {'id': 50, 'type': 'favourite', 'status': status(3)},
+        {'id': 40, 'type': 'mention', 'status': status(2, 'hey')}])
+    c = controller(client)
+    user = c.user_controller.get_by_id(single_user)
+    assert c.fetch(user, 'mentions') == ['@bar@other.domain: hey']
+    assert c.get_cursor(user, 'mentions').since_id == '40'
+    assert client.notifications.call_args[1]['exclude_types'] == NOT_MENTIONS
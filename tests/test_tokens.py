@@ -0,0 +1,158 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import requests
+from mastodon import MastodonUnauthorizedError
+
+import pytest
+
+from sms_gateway.cache import RecentIds
+from sms_gateway.controllers.inbound import InboundController
+from sms_gateway.controllers.user import UserController, TokenRevoked
+from sms_gateway.models.domain import Domain
+from sms_gateway.models.user import VALID, REVOKED
+from sms_gateway.tokens import TokenSweeper
+
+from tests.helpers import db, db_setup, single_user
+
+class Clock(object):
+    def __init__(self, now=100000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class FakeSession(object):
+    """
+    Answers like an instance would for tokens named after what happened to
+    them, and keeps track of how many checks each instance had going at once
+    """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = {}
+        self.most_active = {}
+        self.checked = []
+
+    def get(self, url, headers, timeout):
+        domain = url.split('/')[2]
+        token = headers['Authorization'][len('Bearer '):]
+        with self.lock:
+            self.active[domain] = self.active.get(domain, 0) + 1
+            self.most_active[domain] = max(self.most_active.get(domain, 0),
+                                           self.active[domain])
+            self.checked.append(token)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active[domain] -= 1
+        if token.startswith('down'):
+            raise requests.ConnectionError()
+        status = {'revoked': 401, 'broken': 500}.get(token.split('-')[0], 200)
+        return Mock(status_code=status, ok=status < 400)
+
+def add_users(tokens, domain_id=1):
+    for token in tokens:
+        db.query('''
+        insert into users (uuid, "user", auth_token, domain_id)
+        values (:uuid, :user, :auth_token, :domain_id)
+        ''', uuid=token, user=token, auth_token=token, domain_id=domain_id)
+
+def statuses():
+    rows = db.query('''
+    select auth_token, token_status, token_checked_at from users
+    ''', fetchall=True)
+    return {row.auth_token: (row.token_status, row.token_checked_at)
+            for row in rows}
+
+def sweeper(clock, session=None, **kwargs):
+    return TokenSweeper(db, session=session or FakeSession(), clock=clock,
+                        **kwargs)
+
+def test_sweep_saves_what_instances_say(single_user):
+    add_users(['revoked-1', 'broken-1', 'down-1'])
+    clock = Clock()
+    s = sweeper(clock, sweep_interval=3600)
+    assert s.sweep_batch() == 4
+    assert statuses() == {
+        'efgh': (VALID, clock.now),
+        'revoked-1': (REVOKED, clock.now),
+        'broken-1': (VALID, clock.now),
+        'down-1': (VALID, clock.now),
+    }
+    # nothing's due again until the sweep interval is up, and revoked
+    # tokens never are
+    assert s.sweep_batch() == 0
+    clock.now += 3600
+    assert s.sweep_batch() == 3
+
+def test_sweep_spreads_instances_out(single_user):
+    db.query('''
+    insert into domains (domain, client_id, client_secret)
+    values ('big.instance', 'a', 'b')
+    ''')
+    add_users(['big-{0}'.format(i) for i in range(30)], domain_id=2)
+    session = FakeSession(delay=0.01)
+    s = sweeper(Clock(), session=session, per_instance_batch=10,
+                per_instance_concurrency=2)
+    # the small instance's user gets in alongside the big one's first ten
+    assert s.sweep_batch() == 11
+    assert 'efgh' in session.checked
+    assert session.most_active['big.instance'] <= 2
+    assert s.sweep_batch() == 10
+    assert s.sweep_batch() == 10
+    assert s.sweep_batch() == 0
+
+def test_sweep_doesnt_starve_small_instances(single_user):
+    db.query('''
+    insert into domains (domain, client_id, client_secret)
+    values ('big.instance', 'a', 'b')
+    ''')
+    add_users(['big-{0}'.format(i) for i in range(30)], domain_id=2)
+    # the small instance's token was checked last, so it sorts behind every
+    # one of the big instance's
+    db.query("update users set token_checked_at = 1 where auth_token = 'efgh'")
+    session = FakeSession()
+    s = sweeper(Clock(), session=session, batch_size=10, per_instance_batch=5)
+    assert s.sweep_batch() == 6
+    assert 'efgh' in session.checked
+
+def test_sweep_leaves_replaced_tokens_alone(single_user):
+    add_users(['revoked-1'])
+    user_controller = UserController(db)
+    user = user_controller.get_by_id('revoked-1')
+    s = sweeper(Clock())
+    checks = [(user.id, 'revoked-1', REVOKED, 1.0)]
+    user_controller.update(user, Domain(1, 'my.domain', 'a', 'b'), 'new-token')
+    user_controller.save_token_checks(checks)
+    assert statuses()['new-token'] == (VALID, 0)
+
+def test_revoked_users_get_skipped(single_user):
+    add_users(['revoked-1'])
+    user_controller = UserController(db)
+    for uuid, phone in ((single_user, '+15555550100'),
+                        ('revoked-1', '+15555550101')):
+        db.query('update users set phone = :phone where uuid = :uuid',
+                 phone=phone, uuid=uuid)
+    s = sweeper(Clock())
+    s.sweep_batch()
+    user = user_controller.get_by_id('revoked-1')
+    assert user.revoked
+    with pytest.raises(TokenRevoked):
+        user_controller.get_masto_client(user)
+    assert [u.uuid for u, _ in user_controller.get_sms_users()] == [single_user]
+    # logging in again brings them back
+    user = user_controller.update(user, Domain(1, 'my.domain', 'a', 'b'), 'new')
+    assert not user.revoked
+
+def test_inbound_drops_messages_for_dead_tokens(single_user):
+    user_controller = UserController(db)
+    client = Mock(name='mastodon')
+    client.status_post = Mock(side_effect=MastodonUnauthorizedError())
+    user_controller.get_masto_client = Mock(return_value=client)
+    controller = InboundController(db, user_controller=user_controller,
+                                   recent_ids=RecentIds())
+    controller.receive('SM1', user_controller.get_by_id(single_user), 'hello')
+    assert controller.process_pending() == 1
+    assert controller.get('SM1').status == 'dropped'
+    assert user_controller.get_by_id(single_user).revoked
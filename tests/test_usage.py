@@ -0,0 +1,208 @@
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from sms_gateway.cache import RecentIds
+from sms_gateway.controllers.inbound import InboundController, QuotaExceeded
+from sms_gateway.controllers.outbound import OutboundController, SENT, \
+        THROTTLED
+from sms_gateway.controllers.usage import UsageController
+from sms_gateway.controllers.user import UserController
+from sms_gateway.models.outbound import OutboundMessage
+from sms_gateway.queue import LeaseManager, QueueWorker, Skip
+from sms_gateway.usage import UsageMeter, UsageLog, TokenBucket, Counts, \
+        INBOUND, OUTBOUND
+
+from tests.helpers import db, db_setup, single_user
+
+# 2018-01-01T00:00:00Z
+NOW = 1514764800.0
+TODAY = '2018-01-01'
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1, 2, 0.0)
+    assert bucket.take(2)
+    assert not bucket.take(1)
+    bucket.refill(1800.0, 2, 2)
+    assert bucket.take(1)
+    assert not bucket.take(1)
+    bucket.refill(10 * 3600.0, 2, 2)
+    assert bucket.tokens == 2
+
+def test_consume_throttles():
+    clock = Clock()
+    meter = UsageMeter(default_burst=3, default_per_hour=3600, clock=clock)
+    assert meter.consume(1, 1, INBOUND, 2)
+    assert not meter.consume(1, 1, INBOUND, 2)
+    # other users have buckets of their own
+    assert meter.consume(2, 1, INBOUND, 2)
+    clock.now += 1
+    assert meter.consume(1, 1, OUTBOUND, 2)
+    counts = meter.counts[(1, TODAY)]
+    assert (counts.inbound_messages, counts.inbound_segments,
+            counts.outbound_messages, counts.outbound_segments,
+            counts.throttled) == (1, 2, 1, 2, 1)
+
+def test_long_messages_wait_for_a_full_bucket():
+    clock = Clock()
+    meter = UsageMeter(default_burst=3, default_per_hour=3600, clock=clock)
+    assert meter.consume(1, 1, OUTBOUND, 10)
+    assert not meter.consume(1, 1, OUTBOUND, 10)
+    clock.now += 3
+    assert meter.consume(1, 1, OUTBOUND, 10)
+
+def test_domain_limits():
+    meter = UsageMeter(default_burst=10, clock=Clock())
+    meter.limits = {2: (1, None)}
+    assert meter.consume(1, 2, INBOUND, 1)
+    assert not meter.consume(1, 2, INBOUND, 1)
+    assert meter.consume(2, 1, INBOUND, 5)
+
+def test_flush(single_user):
+    clock = Clock()
+    meter = UsageMeter(clock=clock)
+    controller = UsageController(db, clock=clock)
+    controller.set_limits(1, burst=5, per_hour=60)
+    meter.consume(1, 1, INBOUND, 1)
+    meter.flush(controller)
+    meter.consume(1, 1, OUTBOUND, 3)
+    meter.flush(controller)
+    assert controller.get_usage(1, TODAY) == dict(
+        inbound_messages=1, inbound_segments=1, outbound_messages=1,
+        outbound_segments=3, throttled=0)
+    assert meter.limits == {1: (5, 60)}
+    stats = controller.getstats()
+    assert stats == [dict(domain='my.domain', day=TODAY, inbound_segments=1,
+                          outbound_segments=3, throttled=0)]
+
+def test_flush_keeps_what_failed_to_save():
+    meter = UsageMeter(clock=Clock())
+    controller = Mock(name='controller')
+    controller.save.side_effect = RuntimeError
+    meter.consume(1, 1, INBOUND, 1)
+    with pytest.raises(RuntimeError):
+        meter.flush(controller)
+    controller.save.side_effect = None
+    controller.get_limits.return_value = {}
+    meter.flush(controller)
+    assert controller.save.call_count == 2
+    assert meter.unsaved == []
+
+def test_save_is_idempotent(single_user):
+    controller = UsageController(db)
+    counts = Counts(1)
+    counts.add(INBOUND, 2, True)
+    assert controller.save('batch', {(1, TODAY): counts})
+    assert not controller.save('batch', {(1, TODAY): counts})
+    assert controller.get_usage(1, TODAY)['inbound_segments'] == 2
+
+def test_save_raises_when_counts_dont_fit(single_user):
+    controller = UsageController(db)
+    counts = Counts(None)
+    counts.add(INBOUND, 2, True)
+    with pytest.raises(IntegrityError):
+        controller.save('batch', {(1, TODAY): counts})
+    # nothing got saved, including the batch's name
+    counts.domain_id = 1
+    assert controller.save('batch', {(1, TODAY): counts})
+    assert controller.get_usage(1, TODAY)['inbound_segments'] == 2
+
+def test_prune(single_user):
+    clock = Clock()
+    controller = UsageController(db, clock=clock)
+    controller.save('old', {})
+    clock.now += 100
+    controller.prune(50)
+    assert controller.save('old', {})
+
+def test_log_recovers_counts_of_dead_process(single_user, tmpdir):
+    clock = Clock()
+    controller = UsageController(db)
+    dead = UsageMeter(UsageLog(str(tmpdir)), clock=clock)
+    dead.consume(1, 1, INBOUND, 2)
+    dead.consume(1, 1, OUTBOUND, 1)
+    dead.log.file.close()
+
+    meter = UsageMeter(UsageLog(str(tmpdir)), clock=clock)
+    meter.consume(1, 1, INBOUND, 1)
+    meter.flush(controller)
+    assert controller.get_usage(1, TODAY)['inbound_messages'] == 2
+    assert controller.get_usage(1, TODAY)['outbound_segments'] == 1
+    assert tmpdir.listdir() == []
+
+def test_log_segments_are_not_saved_twice(single_user, tmpdir):
+    controller = UsageController(db)
+    dead = UsageMeter(UsageLog(str(tmpdir)), clock=Clock())
+    dead.consume(1, 1, INBOUND, 2)
+    # the process died after saving but before removing its log
+    name, counts = dead.take()
+    controller.save(name, counts)
+
+    UsageMeter(UsageLog(str(tmpdir)), clock=Clock()).flush(controller)
+    assert controller.get_usage(1, TODAY)['inbound_messages'] == 1
+
+def test_log_skips_segments_in_use(tmpdir):
+    meter = UsageMeter(UsageLog(str(tmpdir)), clock=Clock())
+    meter.consume(1, 1, INBOUND, 1)
+    assert UsageLog(str(tmpdir)).orphans() == []
+
+def test_inbound_over_quota(single_user):
+    meter = UsageMeter(default_burst=1)
+    controller = InboundController(db, recent_ids=RecentIds(), meter=meter)
+    user = UserController(db).get_by_id(single_user)
+    assert controller.receive('SM1', user, 'hello')
+    with pytest.raises(QuotaExceeded):
+        controller.receive('SM2', user, 'hello')
+    assert controller.get('SM2') is None
+
+def test_outbound_over_quota(single_user):
+    db.query("update users set phone = '+15555550100'")
+    twilio = Mock(name='twilio')
+    meter = UsageMeter(default_burst=1)
+    controller = OutboundController(db, twilio=twilio, meter=meter)
+    controller.enqueue(1, 'hello')
+    message = OutboundMessage.fromrecord(
+        db.query('select * from outbound_messages').first())
+    controller.send(message)
+    with pytest.raises(Skip) as skip:
+        controller.send(message)
+    assert skip.value.status == THROTTLED
+    assert twilio.messages.create.call_count == 1
+
+def test_throttled_message_is_not_marked_sent(single_user):
+    db.query("update users set phone = '+15555550100'")
+    twilio = Mock(name='twilio')
+    controller = OutboundController(db, twilio=twilio,
+                                    meter=UsageMeter(default_burst=1,
+                                                    clock=Clock()))
+    controller.enqueue(1, 'one')
+    controller.enqueue(1, 'two')
+    leases = LeaseManager(db, 'outbound')
+    leases.setup()
+    worker = QueueWorker(db, 'outbound_messages',
+                         lambda row: controller.send(
+                             OutboundMessage.fromrecord(row)),
+                         leases, done_status=SENT)
+    assert worker.run_once() == 2
+    assert controller.getstats()['statuses'] == {'sent': 1, 'throttled': 1}
+
+def test_inbound_retry_is_only_counted_once(single_user):
+    meter = UsageMeter(clock=Clock())
+    user = UserController(db).get_by_id(single_user)
+    assert InboundController(db, recent_ids=RecentIds(),
+                             meter=meter).receive('SM1', user, 'hello')
+    # the retry lands on a process that hasn't seen it
+    assert not InboundController(db, recent_ids=RecentIds(),
+                                 meter=meter).receive('SM1', user, 'hello')
+    assert meter.counts[(user.id, TODAY)].inbound_messages == 1
+    assert meter.buckets[user.id].tokens == meter.default_burst - 1
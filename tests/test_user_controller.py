@@ -80,7 +80,7 @@ def test_begin_authorize_no_user(user_controller):
     with pytest.raises(ValueError):
         user_controller.begin_authorize(None, 'http://example.com')
 
-def test_create(user_controller, db_setup):
+def test_create(user_controller, single_domain):
     domain = Domain(id=1, client_id='01234', client_secret='ghefcdab',
             domain='my.domain')
     user = user_controller.create('foo', domain, 'abcdefgh')
@@ -149,3 +149,61 @@ def test_update_using_create_or_update(user_controller, single_user):
     assert new_user.user == user.user
     assert new_user.auth_token == 'newauthtoken'
     assert new_user.domain_id == user.domain_id
+
+def test_begin_authorize_binds_state(user_controller, single_domain):
+    user_controller.mastodon.auth_request_url = Mock(name='auth_request_url',
+            return_value='https://my.domain/oauth/authorize?client_id=abcd')
+    redirect_uri, session = user_controller.begin_authorize("foo@my.domain",
+            "http://example.com")
+    assert redirect_uri == \
+        'https://my.domain/oauth/authorize?client_id=abcd&state={0}'.format(
+            session['uuid'])
+
+def test_get_register_uri_cached(user_controller, single_domain):
+    user_controller.mastodon.auth_request_url = Mock(name='auth_request_url',
+            return_value='https://my.domain/oauth/authorize?client_id=abcd')
+    user_controller.domain_controller.get_or_insert = Mock(name='get_or_insert',
+            wraps=user_controller.domain_controller.get_or_insert)
+    first = user_controller.get_register_uri('my.domain', 'http://example.com')
+    second = user_controller.get_register_uri('my.domain', 'http://example.com')
+    assert first == second
+    user_controller.mastodon.auth_request_url.assert_called_once_with(
+            scopes=['read', 'write'],
+            redirect_uris='http://example.com/redirect')
+    user_controller.domain_controller.get_or_insert.assert_called_once_with(
+            'my.domain', 'http://example.com')
+
+def test_get_register_uri_cached_per_host(user_controller, single_domain):
+    user_controller.mastodon.auth_request_url = Mock(name='auth_request_url',
+            return_value='https://my.domain/oauth/authorize?client_id=abcd')
+    user_controller.get_register_uri('my.domain', 'http://example.com')
+    user_controller.get_register_uri('my.domain', 'http://other.example.com')
+    assert user_controller.mastodon.auth_request_url.call_count == 2
+
+def test_digest_interval(user_controller, single_user):
+    user = user_controller.get_by_id(single_user)
+    assert user_controller.get_digest_interval(user) == 300
+    user_controller.set_digest_interval(user, 60)
+    assert user_controller.get_digest_interval(user) == 60
+
+def test_digest_interval_negative(user_controller, single_user):
+    user = user_controller.get_by_id(single_user)
+    with pytest.raises(ValueError):
+        user_controller.set_digest_interval(user, -1)
+
+def test_get_by_phone(user_controller, single_user):
+    user = user_controller.get_by_id(single_user)
+    assert user_controller.get_by_phone('+15555550100') is None
+    user_controller.set_phone(user, '+15555550100')
+    assert user_controller.get_by_phone('+15555550100').uuid == single_user
+
+def test_get_by_row_id(user_controller, single_user):
+    assert user_controller.get_by_row_id(1).uuid == single_user
+    with pytest.raises(UserNotFound):
+        user_controller.get_by_row_id(2)
+
+def test_get_sms_users(user_controller, single_user):
+    assert user_controller.get_sms_users() == []
+    user = user_controller.get_by_id(single_user)
+    user_controller.set_phone(user, '+15555550100')
+    assert user_controller.get_sms_users() == [(user, 300)]
@@ -1,7 +1,15 @@
-from sms_gateway.models.user import User
+from sms_gateway.models.user import User, VALID
 from uuid import uuid4
 
 def test_get_id():
     uuid = uuid4()
-    u = User(id=1, uuid=uuid, user='foo', auth_token='abcd', domain_id=1)
+    u = User(id=1, uuid=uuid, user='foo', auth_token='abcd', domain_id=1,
+             token_status=VALID)
     assert u.uuid == uuid   
+
+def test_compact():
+    u = User(id=1, uuid='abcd', user='foo', auth_token='abcd', domain_id=1,
+             token_status=VALID)
+    assert not hasattr(u, '__dict__')
+    assert u.is_authenticated and u.is_active and not u.is_anonymous
+    assert u.get_id() == 'abcd'
@@ -0,0 +1,19 @@
+"""
+Runs a queue worker, `python worker.py inbound` or `python worker.py
+outbound`. Start as many of them as you like, on as many machines as you like;
+they split the queue's partitions between themselves
+"""
+if __name__ == '__main__':
+    import logging
+    import sys
+    from sms_gateway.migrations import migrate
+    from sms_gateway.utils import get_db
+    from sms_gateway.workers import WORKERS
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2 or sys.argv[1] not in WORKERS:
+        sys.exit('usage: worker.py {0}'.format('|'.join(sorted(WORKERS))))
+
+    db = get_db()
+    migrate(db)
+    WORKERS[sys.argv[1]](db).run()